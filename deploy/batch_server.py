@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dynamic-batching inference server: one CPU box serves the scans of several robots (or lidars) with one InferenceEngine.
+"RTinference.py" runs one "/terrasentia/scan" stream at batch size 1, here every source connects to a local TCP socket
+and the requests of all the sources are grouped:
+    - a reader thread per connection queues the scans (source, sequence, ranges, arrival time)
+    - the batcher thread takes the first waiting scan and adds the next ones until max_batch scans or max_wait seconds
+      after the first one, then runs engine.predict_batch (one render, one forward and one bulk deprocess per batch)
+    - the lines of each scan are sent back on the connection of its source, with the sequence of the request
+Wire format (little endian), a source sends REQUEST + num_beams float32 ranges and reads RESPONSE:
+    - REQUEST: sequence (uint32), num_beams (uint32)
+    - RESPONSE: sequence (uint32), m1, m2, b1, b2 (float64)
+Scans with different numbers of beams are batched separately. A request of more than MAX_BEAMS beams closes the
+connection, as a batch that fails in the engine closes the connections of its sources (the batcher keeps running).
+
+The load generator runs 1 to 16 client processes (each one a robot publishing at --rate Hz and waiting for its lines)
+and reports the throughput, the p50/p99 latency and the mean batch size for each number of clients:
+    python3 batch_server.py --clients 1 2 4 8 16 --seconds 10 --runid 02-02-2024_00-45-55
+    python3 batch_server.py --serve --port 5555 --runid 02-02-2024_00-45-55
+
+@author: Felipe-Tommaselli
+"""
+
+import time
+import queue
+import socket
+import struct
+import argparse
+import threading
+import multiprocessing as mp
+
+import numpy as np
+
+from scan_publisher import load_recorded_scans, synthetic_scans
+
+HOST = '127.0.0.1'
+PORT = 5555
+MAX_BATCH = 16
+MAX_WAIT = 0.005 # s, after the first scan of a batch
+REQUEST = struct.Struct('<II') # sequence, num_beams
+RESPONSE = struct.Struct('<I4d') # sequence, m1, m2, b1, b2
+MAX_BEAMS = 8192 # the lidars have 1081 beams
+
+def recv_exact(connection, size):
+    ''' Read exactly size bytes (None if the connection was closed). '''
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = connection.recv_into(view[received:])
+        if count == 0:
+            return None
+        received += count
+    return buffer
+
+############### SERVER ###############
+
+class Source:
+    ''' One connected client: its socket and the lock of its responses. '''
+
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self.lock = threading.Lock()
+
+    def send(self, sequence, lines):
+        with self.lock:
+            self.connection.sendall(RESPONSE.pack(sequence, *lines))
+
+    def close(self):
+        ''' Close the connection: the reader thread stops and the client gets a ConnectionError. '''
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError: # already closed
+            pass
+        self.connection.close()
+
+
+class BatchServer:
+    ''' TCP server grouping the scans of all the sources into engine.predict_batch calls. '''
+
+    def __init__(self, engine, host=HOST, port=PORT, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        ''' Constructor of the class. port=0: any free port (see self.address after start()). '''
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batch_sizes = []
+        self.sources = []
+        self._stop_event = threading.Event()
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.address = self.server.getsockname()
+        self.threads = []
+
+    def start(self):
+        ''' Accept and batch in background threads. '''
+        self.server.listen()
+        for target in (self.accept, self.batch):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        print(f'Batch server on {self.address[0]}:{self.address[1]} (max batch {self.max_batch}, '
+              f'max wait {1e3 * self.max_wait:.1f} ms)')
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self.server.close()
+        for source in list(self.sources):
+            source.close()
+        for thread in self.threads:
+            thread.join(timeout=1.0)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    ############ CONNECTIONS ############
+
+    def accept(self):
+        while not self._stop_event.is_set():
+            try:
+                connection, address = self.server.accept()
+            except OSError: # closed by stop()
+                break
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            source = Source(connection, address)
+            self.sources.append(source)
+            threading.Thread(target=self.read, args=(source,), daemon=True).start()
+
+    def read(self, source):
+        ''' Queue the scans of one source until it disconnects (or sends more than MAX_BEAMS beams). '''
+        try:
+            while not self._stop_event.is_set():
+                header = recv_exact(source.connection, REQUEST.size)
+                if header is None:
+                    break
+                sequence, num_beams = REQUEST.unpack(header)
+                if num_beams > MAX_BEAMS:
+                    print(f'{source.address}: request of {num_beams} beams (max {MAX_BEAMS}), closing')
+                    break
+                payload = recv_exact(source.connection, 4 * num_beams)
+                if payload is None:
+                    break
+                ranges = np.frombuffer(payload, dtype=np.float32)
+                self.requests.put((source, sequence, ranges))
+        except OSError:
+            pass
+        finally:
+            source.close()
+            try:
+                self.sources.remove(source)
+            except ValueError: # already removed
+                pass
+
+    ############ BATCHING ############
+
+    def collect(self):
+        ''' First waiting request (blocking) and the next ones until max_batch or max_wait. '''
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def batch(self):
+        while not self._stop_event.is_set():
+            batch = self.collect()
+            # one forward per number of beams (usually all the lidars are the same)
+            groups = {}
+            for request in batch:
+                groups.setdefault(len(request[2]), []).append(request)
+            for requests in groups.values():
+                try:
+                    lines = self.engine.predict_batch(np.stack([ranges for _, _, ranges in requests]))
+                except Exception as error:
+                    # the sources of the batch get a ConnectionError instead of waiting forever
+                    print(f'Batch of {len(requests)} scans failed: {error!r}')
+                    for source, _, _ in requests:
+                        source.close()
+                    continue
+                self.batch_sizes.append(len(requests))
+                for (source, sequence, _), line in zip(requests, lines):
+                    try:
+                        source.send(sequence, line.tolist())
+                    except OSError: # the source disconnected
+                        pass
+
+############### CLIENT ###############
+
+class BatchClient:
+    ''' One source: sends a scan and waits for its lines. '''
+
+    def __init__(self, host=HOST, port=PORT):
+        self.connection = socket.create_connection((host, port))
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sequence = 0
+
+    def predict(self, ranges):
+        ''' LaserScan ranges -> [m1, m2, b1, b2]. '''
+        ranges = np.ascontiguousarray(ranges, dtype=np.float32)
+        self.sequence += 1
+        self.connection.sendall(REQUEST.pack(self.sequence, len(ranges)) + ranges.tobytes())
+        response = recv_exact(self.connection, RESPONSE.size)
+        if response is None:
+            raise ConnectionError('the batch server closed the connection')
+        sequence, *lines = RESPONSE.unpack(response)
+        if sequence != self.sequence:
+            raise RuntimeError(f'response {sequence} for the request {self.sequence}')
+        return lines
+
+    def close(self):
+        self.connection.close()
+
+############### LOAD GENERATOR ###############
+
+def run_client(address, scans, rate, seconds, start, results):
+    ''' One robot (process): a scan every 1 / rate seconds (or as soon as the lines arrive), returns the latencies. '''
+    client = BatchClient(*address)
+    period = 1 / rate if rate else 0.0
+    while time.time() < start: # all the clients start together
+        time.sleep(0.001)
+    latencies = []
+    next_time = time.perf_counter()
+    end = next_time + seconds
+    while time.perf_counter() < end:
+        sent = time.perf_counter()
+        client.predict(scans[len(latencies) % len(scans)])
+        latencies.append(time.perf_counter() - sent)
+        next_time += period
+        time.sleep(max(0.0, next_time - time.perf_counter()))
+    client.close()
+    results.put(latencies)
+
+def load_test(server, scans, num_clients, rate, seconds):
+    ''' num_clients processes against the server, returns the throughput and latency statistics. '''
+    context = mp.get_context('spawn')
+    results = context.Queue()
+    start = time.time() + 2.0 # time to spawn the processes
+    clients = [context.Process(target=run_client, args=(server.address, scans, rate, seconds, start, results))
+               for _ in range(num_clients)]
+    batches = len(server.batch_sizes)
+    for client in clients:
+        client.start()
+    latencies = np.concatenate([results.get() for _ in clients]) * 1000
+    for client in clients:
+        client.join()
+    sizes = server.batch_sizes[batches:]
+    return {
+        'clients': num_clients,
+        'requests': int(len(latencies)),
+        'throughput': len(latencies) / seconds,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_batch': float(np.mean(sizes)) if sizes else 0.0,
+    }
+
+if __name__ == '__main__':
+    from lidar_pipeline import build_model
+    from inference_engine import InferenceEngine
+
+    parser = argparse.ArgumentParser(description='Dynamic-batching inference server and its load generator.')
+    parser.add_argument('--serve', action='store_true', help='only run the server (until Ctrl+C)')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max-wait-ms', type=float, default=1e3 * MAX_WAIT)
+    parser.add_argument('--runid', default=None, help='model_{runid}.pth (random weights if not given)')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    parser.add_argument('--scans', default=None, help='recorded scans csv (get_ros_data.py format)')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--rate', type=float, default=40.0, help='scans/s of each client (0: as fast as possible)')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    if args.runid is not None:
+        engine = InferenceEngine.from_runid(args.runid)
+    else:
+        print('No trained model, using random weights.')
+        engine = InferenceEngine(build_model(), mean=[0.0] * 4, std=[1.0] * 4)
+
+    port = args.port if args.serve else 0
+    with BatchServer(engine, args.host, port, args.max_batch, 1e-3 * args.max_wait_ms) as server:
+        if args.serve:
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+        else:
+            scans = load_recorded_scans(args.scans) if args.scans is not None else synthetic_scans(100)
+            scans = [np.asarray(scan.ranges, dtype=np.float32) for scan in scans]
+            print(f"{'clients':>8}{'requests':>10}{'scans/s':>10}{'p50 (ms)':>10}{'p99 (ms)':>10}{'batch':>8}")
+            for num_clients in args.clients:
+                result = load_test(server, scans, num_clients, args.rate, args.seconds)
+                print(f"{result['clients']:>8}{result['requests']:>10}{result['throughput']:>10.1f}"
+                      f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['mean_batch']:>8.2f}")
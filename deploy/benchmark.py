@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the scan -> lines pipeline (no ROS needed).
+The recorded scans (the "Crop_Data{fid}.csv" written by "src/test/get_ros_data.py") are wrapped in a fake LaserScan
+and replayed through each stage of "lidar_pipeline.py":
+scan filter ("src/scan_filter.py"), polar conversion, rasterization (matplotlib and the fast rasterizer), tensor prep,
+model forward (one entry per backend), deprocessing and plotting (cv2 lines and the magma overlay of "overlay.py").
+The raw-scan models (inputs='scan' backbones, e.g. scan_cnn) skip the rendering and plotting stages: filter, tensor of
+the ranges, forward and deprocess. The scans without any beam are skipped (and counted).
+
+For each stage the p50/p95/p99 latency (ms) and the throughput (frames/s) are reported, and the results are saved in
+"assets/benchmarks/benchmark_{runid}.json" with the git commit, so regressions can be compared across commits:
+    python3 benchmark.py --scans ../datasets/Crop_Data5.csv
+    python3 benchmark.py --compare ../assets/benchmarks/benchmark_{old_runid}.json
+
+Without a recorded csv, synthetic crop row scans are generated. Without a trained model (--model), the network runs
+with random weights (the latency does not depend on the weights). The scan filter is always timed, --filter adds it
+to the end to end total.
+
+@author: Felipe-Tommaselli
+"""
+
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import torch
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from lidar_pipeline import DEFAULT_BACKBONE, build_model, load_model, model_file, read_params, polar_to_cartesian, rasterize, prepare_tensor, \
+    predictions_to_lines, draw_lines
+from scan_publisher import load_recorded_scans, synthetic_scans
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from rasterizer import Rasterizer
+from overlay import OverlayRenderer
+from model_factory import input_kind
+from scan_filter import ScanFilter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+############### BACKENDS ###############
+
+def eager_backend(model, example):
+    return model
+
+def torchscript_backend(model, example):
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(model, example))
+
+def quantized_backend(model, example):
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+BACKENDS = {
+    'eager': eager_backend,
+    'torchscript': torchscript_backend,
+    'quantized': quantized_backend,
+}
+
+############### STATISTICS ###############
+
+def summarize(times):
+    ''' Latency percentiles (ms) and throughput (frames/s) for a list of durations in seconds. '''
+    ms = np.asarray(times) * 1000
+    return {
+        'n': int(len(ms)),
+        'mean_ms': float(np.mean(ms)),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'throughput_fps': float(1000 / np.mean(ms)) if np.mean(ms) > 0 else float('inf'),
+    }
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+############### BENCHMARK ###############
+
+def run_benchmark(scans, model, mean, std, backends, warmup=5, scan_filter=False, inputs='image'):
+    ''' Replay the scans through all the stages, returns {stage: statistics}. scan_filter: filter stage in the total,
+    inputs: 'image' (rendered scans) or 'scan' (raw ranges, no rendering stage) model, as the InferenceEngine. '''
+    if inputs == 'scan':
+        stages = ['filter', 'tensor'] + [f'forward_{name}' for name in backends] + ['deprocess']
+        pipeline = ['tensor', f'forward_{backends[0]}', 'deprocess']
+        example = torch.zeros((1, 1, len(scans[0].ranges)))
+    else:
+        stages = ['filter', 'polar', 'rasterize', 'rasterize_fast', 'tensor'] + \
+            [f'forward_{name}' for name in backends] + ['deprocess', 'plot', 'plot_overlay']
+        # end to end with the first backend (the one the ROS node uses)
+        pipeline = ['polar', 'rasterize', 'tensor', f'forward_{backends[0]}', 'deprocess', 'plot']
+        example = torch.zeros((1, 1, 224, 224))
+        plt.subplots(figsize=(8, 5), frameon=True) # same figure of the ROS node
+    times = {stage: [] for stage in stages}
+
+    runners = {name: BACKENDS[name](model, example) for name in backends}
+    rasterizer = Rasterizer()
+    density_filter = ScanFilter()
+    overlay = OverlayRenderer(size=224, show=False)
+    empty = 0
+
+    for i, scan in enumerate(scans):
+        if len(scan.ranges) == 0: # no beam at all: nothing to filter, render or infer
+            empty += 1
+            continue
+        sample = {}
+        _, sample['filter'] = timed(density_filter, scan.ranges)
+
+        if inputs == 'scan':
+            image, sample['tensor'] = timed(lambda ranges: torch.tensor(ranges, dtype=torch.float32)[None, None],
+                                            scan.ranges)
+        else:
+            (xl, yl), sample['polar'] = timed(polar_to_cartesian, scan.ranges)
+            rendered, sample['rasterize'] = timed(rasterize, xl, yl)
+            if rendered is None: # no return in the scan: nothing to infer (the ROS node skips it too)
+                empty += 1
+                continue
+            _, sample['rasterize_fast'] = timed(rasterizer.render_scan, scan.ranges)
+            (image, raw_image), sample['tensor'] = timed(prepare_tensor, rendered)
+
+        with torch.no_grad():
+            for name, runner in runners.items():
+                predictions, sample[f'forward_{name}'] = timed(runner, image)
+
+        response, sample['deprocess'] = timed(predictions_to_lines, predictions, mean, std)
+        if inputs == 'image':
+            _, sample['plot'] = timed(draw_lines, response, raw_image)
+            _, sample['plot_overlay'] = timed(overlay.compose, raw_image[:, :, 1], response)
+
+        if i >= warmup:
+            for stage in stages:
+                times[stage].append(sample[stage])
+
+    if empty:
+        print(f'{empty} empty scans skipped (no point to rasterize)')
+    results = {stage: summarize(values) for stage, values in times.items()}
+    if scan_filter:
+        pipeline.insert(0, 'filter')
+    results['total'] = summarize(np.sum([times[stage] for stage in pipeline], axis=0))
+    return results
+
+def print_results(results, reference=None):
+    header = f"{'stage':<22}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'fps':>10}"
+    if reference is not None:
+        header += f"{'p50 diff':>12}"
+    print(header)
+    for stage, stats in results.items():
+        line = f"{stage:<22}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['throughput_fps']:>10.1f}"
+        if reference is not None and stage in reference:
+            old = reference[stage]['p50_ms']
+            line += f"{100 * (stats['p50_ms'] - old) / old:>+11.1f}%" if old > 0 else f"{'-':>12}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the scan -> lines pipeline.')
+    parser.add_argument('--scans', default=None, help='recorded scans csv (get_ros_data.py format)')
+    parser.add_argument('--num', type=int, default=200, help='number of scans to replay')
+    parser.add_argument('--warmup', type=int, default=5, help='first scans not recorded')
+    parser.add_argument('--runid', default=None, help='model_{runid}.pth and params.json entry')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads')
+    parser.add_argument('--backbone', default=DEFAULT_BACKBONE, help='backbone of the random weights model')
+    parser.add_argument('--output', default=os.path.join(ROOT, 'assets', 'benchmarks'))
+    parser.add_argument('--filter', action='store_true', help='include the scan filter in the total')
+    parser.add_argument('--compare', default=None, help='previous benchmark json to compare with')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    ############ SCANS ############
+    if args.scans is not None:
+        scans = load_recorded_scans(args.scans)
+        scans = [scans[i % len(scans)] for i in range(args.num + args.warmup)]
+    else:
+        scans = synthetic_scans(args.num + args.warmup)
+
+    ############ MODEL ############
+    params = read_params(os.path.join(ROOT, 'models', 'params.json'), query_id=args.runid)
+    model_path = model_file(os.path.join(ROOT, 'models'), args.runid)
+    if args.runid is not None and os.path.exists(model_path):
+        backbone = params['backbone'] if params is not None else DEFAULT_BACKBONE
+        input_size = params['input_size'] if params is not None else 224
+        model = load_model(model_path, backbone, input_size)
+    else:
+        print(f'No trained model, using random weights ({args.backbone}).')
+        backbone = args.backbone
+        model = build_model(backbone)
+        model.eval()
+
+    mean = [params[f'mean{i}'] for i in range(4)] if params is not None else [0.0] * 4
+    std = [params[f'std{i}'] for i in range(4)] if params is not None else [1.0] * 4
+
+    ############ RUN ############
+    results = run_benchmark(scans, model, mean, std, args.backends, warmup=args.warmup,
+                            scan_filter=args.filter, inputs=input_kind(backbone))
+
+    reference = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            reference = json.load(file)['stages']
+    print_results(results, reference)
+
+    ############ SAVE ############
+    runid = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+    report = {
+        'id': runid,
+        'commit': git_commit(),
+        'scans': args.scans if args.scans is not None else 'synthetic',
+        'num_scans': args.num,
+        'model': args.runid,
+        'backbone': backbone,
+        'scan_filter': args.filter,
+        'torch': torch.__version__,
+        'threads': torch.get_num_threads(),
+        'machine': platform.platform(),
+        'processor': platform.processor(),
+        'stages': results,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f'benchmark_{runid}.json')
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(f'Saved benchmark results to:\n{path}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact transport of the 224x224 scan image in the RTInference service.
+The original response sends the image as float32[] (self.image.flatten().tolist(): 50176 python floats, ~200 KB)
+and the client rebuilds it with np.array(image).reshape((224, 224)). The image is uint8 and almost binary, so:
+    - 'uint8': raw bytes (4x smaller than float32)
+    - 'zlib': uint8 + zlib (the white background compresses very well)
+    - 'png': uint8 + png (cv2.imencode)
+    - preview: downsample factor (1, 2 or 4) before encoding, for the live plots
+The uint8[] field of a ROS message arrives as "bytes" in python, decode_image() wraps it with np.frombuffer (zero copy
+for 'uint8', one buffer for 'zlib').
+
+    python3 image_codec.py  # prints the payload size of each encoding
+
+@author: Felipe-Tommaselli
+"""
+
+import zlib
+import cv2
+import numpy as np
+
+ENCODINGS = ('uint8', 'zlib', 'png')
+ZLIB_LEVEL = 1 # fastest, the gain of higher levels is small on these images
+PNG_COMPRESSION = 1
+
+def to_uint8(image):
+    ''' Any (224, 224) image (float 0-255, torch tensor (1, 1, 224, 224), uint8) -> contiguous uint8 (H, W). '''
+    image = np.asarray(image)
+    image = np.squeeze(image)
+    if image.dtype != np.uint8:
+        image = np.clip(image, 0, 255).astype(np.uint8)
+    return np.ascontiguousarray(image)
+
+def encode_image(image, encoding='zlib', preview=1):
+    ''' Returns (payload bytes, height, width) of the encoded image. '''
+    image = to_uint8(image)
+    if preview > 1:
+        height, width = image.shape[0] // preview, image.shape[1] // preview
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    height, width = image.shape
+
+    if encoding == 'uint8':
+        payload = image.tobytes()
+    elif encoding == 'zlib':
+        payload = zlib.compress(image.tobytes(), ZLIB_LEVEL)
+    elif encoding == 'png':
+        ok, buffer = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+        if not ok:
+            raise ValueError('png encoding failed')
+        payload = buffer.tobytes()
+    else:
+        raise ValueError(f'unknown encoding: {encoding} (use one of {ENCODINGS})')
+    return payload, height, width
+
+def decode_image(payload, encoding, height, width):
+    ''' Payload (bytes) -> (height, width) uint8 array. Read only for 'uint8' and 'zlib' (no copy). '''
+    if encoding == 'uint8':
+        buffer = payload
+    elif encoding == 'zlib':
+        buffer = zlib.decompress(payload)
+    elif encoding == 'png':
+        image = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        return image.reshape((height, width))
+    else:
+        raise ValueError(f'unknown encoding: {encoding} (use one of {ENCODINGS})')
+    return np.frombuffer(buffer, dtype=np.uint8).reshape((height, width))
+
+def decode_float_list(image, size=224):
+    ''' Legacy float32[] response -> (size, size) array. '''
+    return np.asarray(image, dtype=np.float32).reshape((size, size))
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import time
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+    from rasterizer import Rasterizer
+    from scan_publisher import synthetic_scans
+
+    image = Rasterizer().render_scan(synthetic_scans(1)[0].ranges)
+    legacy = len(image.astype(np.float32).flatten().tolist()) * 4
+    print(f"{'encoding':<16}{'bytes':>10}{'ratio':>10}{'enc+dec (ms)':>14}")
+    print(f"{'float32 list':<16}{legacy:>10}{1:>10.1f}{'-':>14}")
+    for preview in (1, 2, 4):
+        for encoding in ENCODINGS:
+            start = time.perf_counter()
+            for _ in range(100):
+                payload, height, width = encode_image(image, encoding, preview)
+                decoded = decode_image(payload, encoding, height, width)
+            elapsed = (time.perf_counter() - start) * 10
+            name = encoding if preview == 1 else f'{encoding} /{preview}'
+            print(f'{name:<16}{len(payload):>10}{legacy / len(payload):>10.1f}{elapsed:>14.3f}')
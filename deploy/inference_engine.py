@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ROS-free inference engine: LaserScan ranges -> crop lines (m1, m2, b1, b2).
+All the scan -> lines pipeline lives here (model, mean and std of "params.json", rasterization, deprocess), so it can
+be imported, tested and benchmarked without ROS. "RTinference.py" is only the ROS adapter around this class.
+
+    engine = InferenceEngine.from_runid('02-02-2024_00-45-55')
+    m1, m2, b1, b2 = engine.predict(scan.ranges)
+    lines = engine.predict_batch(scans) # (N, 4)
+
+With in_graph=True the deprocessing (normalized outputs -> m and b) is appended to the model as a DeprocessLayer, so
+forward() already returns the lines.
+
+Two renderers are available:
+    - 'raster': the vectorized numpy rasterizer ("src/rasterizer.py"), default
+    - 'matplotlib': the original plot -> png -> imread path ("lidar_pipeline.py"), kept as the reference
+The raw-scan models (inputs='scan', e.g. scan_cnn of "src/model_factory.py") take the ranges directly: nothing is
+rendered and "image" is not updated.
+An optional scan_filter (e.g. ScanFilter of "src/scan_filter.py": isolated returns and far clutter removed) is applied
+to the ranges before both inputs.
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import cv2
+import torch
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from rasterizer import Rasterizer
+from pre_process import PreProcess, DeprocessLayer
+
+from model_factory import input_kind
+from lidar_pipeline import load_model, model_file, read_params, polar_to_cartesian, rasterize
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class InferenceEngine:
+    ''' Scan -> lines pipeline with a single model forward per call (batch 1 or batch N). '''
+
+    def __init__(self, model, mean, std, renderer='raster', device='cpu', in_graph=False, inputs='image',
+                 scan_filter=None):
+        ''' Constructor of the class. inputs: 'image' (rendered scans) or 'scan' (raw ranges) model.
+        scan_filter: optional callable ranges -> ranges applied before the rendering (or the raw-scan model). '''
+        self.device = torch.device(device)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.in_graph = in_graph
+        if in_graph:
+            model = DeprocessLayer.append(model, self.mean, self.std)
+        self.model = model.to(self.device)
+        self.model.eval()
+
+        if renderer not in ('raster', 'matplotlib'):
+            raise ValueError(f'unknown renderer: {renderer}')
+        if inputs not in ('image', 'scan'):
+            raise ValueError(f'unknown inputs: {inputs}')
+        self.renderer = renderer
+        self.inputs = inputs
+        self.scan_filter = scan_filter
+        self.rasterizer = Rasterizer()
+
+        # last rendered image (224, 224) uint8, used by the ROS service and the plots
+        self.image = np.full((224, 224), 255, dtype=np.uint8)
+
+    @classmethod
+    def from_runid(cls, runid, models_dir=os.path.join(ROOT, 'models'), **kwargs):
+        ''' Load "model_{runid}.pth" or ".pt" (backbone of the "params.json" entry) and the mean and std of the runid. '''
+        result = read_params(os.path.join(models_dir, 'params.json'), query_id=runid)
+        if result is None:
+            raise KeyError(f'No params.json entry for the runid {runid}')
+        model = load_model(model_file(models_dir, runid), backbone=result['backbone'],
+                           input_size=result['input_size'])
+        mean = [result['mean0'], result['mean1'], result['mean2'], result['mean3']]
+        std = [result['std0'], result['std1'], result['std2'], result['std3']]
+        kwargs.setdefault('inputs', input_kind(result['backbone']))
+        return cls(model, mean, std, **kwargs)
+
+    ############### RENDER ###############
+
+    def filter(self, ranges):
+        ''' (B,) or (N, B) ranges with the scan_filter applied (unchanged without a filter). '''
+        if self.scan_filter is None:
+            return ranges
+        return self.scan_filter(ranges)
+
+    def render(self, ranges):
+        ''' One scan -> (224, 224) uint8 image (green channel). '''
+        if self.renderer == 'raster':
+            return self.rasterizer.render_scan(ranges)
+
+        xl, yl = polar_to_cartesian(tuple(ranges))
+        image = rasterize(xl, yl)
+        if image is None: # no return in the scan: blank image, as the raster renderer
+            return np.full((224, 224), 255, dtype=np.uint8)
+        image = cv2.resize(image, (224, 224), interpolation=cv2.INTER_LINEAR)
+        return image[:, :, 1]
+
+    def render_batch(self, scans):
+        ''' (N, B) scans -> (N, 224, 224) uint8 images. '''
+        if self.renderer == 'raster':
+            return self.rasterizer.render_scans(scans)
+        return np.stack([self.render(ranges) for ranges in scans])
+
+    ############### INFERENCE ###############
+
+    def forward(self, images):
+        ''' (N, 224, 224) uint8 images (or (N, B) float32 ranges) -> (N, 3 or 4) network outputs (normalized w and q),
+        or the (N, 4) lines with in_graph=True. '''
+        tensor = torch.from_numpy(np.ascontiguousarray(images)).to(self.device)
+        tensor = tensor.unsqueeze(1).float()
+        with torch.inference_mode():
+            predictions = self.model(tensor)
+        return predictions.cpu().numpy()
+
+    def deprocess(self, predictions):
+        ''' (N, 3) or (N, 4) normalized (w1, [w2], q1, q2) -> (N, 4) lines (m1, m2, b1, b2). '''
+        if self.in_graph:
+            # already deprocessed by the DeprocessLayer
+            return np.asarray(predictions, dtype=np.float64)
+        return PreProcess.standard_deprocess_batch(predictions, self.mean, self.std)
+
+    def predict(self, ranges):
+        ''' LaserScan ranges -> [m1, m2, b1, b2]. '''
+        ranges = self.filter(ranges)
+        if self.inputs == 'scan':
+            scans = np.asarray(ranges, dtype=np.float32)[None]
+            return self.deprocess(self.forward(scans))[0].tolist()
+        self.image = self.render(ranges)
+        return self.deprocess(self.forward(self.image[None]))[0].tolist()
+
+    def predict_batch(self, scans):
+        ''' (N, B) LaserScan ranges -> (N, 4) lines, one model forward for the whole batch. '''
+        scans = self.filter(scans)
+        if self.inputs == 'scan':
+            return self.deprocess(self.forward(np.asarray(scans, dtype=np.float32)))
+        images = self.render_batch(scans)
+        self.image = images[-1]
+        return self.deprocess(self.forward(images))
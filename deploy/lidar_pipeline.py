@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ROS-free stages of the scan -> lines pipeline used by "RTinference.py".
+Each function is one step of the real-time loop, so the same code runs in the ROS node and in the offline
+benchmark ("benchmark.py"):
+1. polar_to_cartesian: LaserScan ranges -> (x, y) points in meters
+2. rasterize: points -> BGR image with matplotlib (the same plot used to generate the training images)
+3. prepare_tensor: BGR image -> (1, 1, 224, 224) float tensor (green channel only)
+4. the model forward itself (see load_model)
+5. deprocess: network output (w1, q1, q2) -> (m1, m2, b1, b2) with the mean and std of "params.json"
+6. draw_lines: draw both lines on the 224x224 BGR image
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import cv2
+import json
+import torch
+import numpy as np
+import matplotlib.pyplot as plt
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import model_factory
+from model_factory import DEFAULT_BACKBONE, model_file
+
+POINT_WIDTH = 18
+TEMP_IMAGE = 'temp_image'
+
+############### MODEL LOAD ###############
+
+def build_model(backbone=DEFAULT_BACKBONE):
+    ''' Model of "src/model_factory.py" (MobileNetV2 with 1 channel input and the 3 outputs head by default). '''
+    return model_factory.build_model(backbone)
+
+def load_model(path, backbone=DEFAULT_BACKBONE, input_size=224):
+    ''' Load the "model_{runid}.pth" state dict (or TorchScript ".pt") on CPU and set the model to evaluation mode. '''
+    return model_factory.load_model(path, backbone, input_size=input_size)
+
+def read_params(filename='./models/params.json', query_id=None):
+    ''' Returns the mean and std entry of "params.json" for the runid (None if not found).
+    The file is a list of entries (one per training), older versions stored a single dict. '''
+    try:
+        with open(filename, 'r') as file:
+            data = json.load(file)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+    entries = data if isinstance(data, list) else [data]
+    # the last entry wins, the dataloader appends one entry per run
+    for entry in reversed(entries):
+        if query_id is None or entry.get('id') == query_id:
+            try:
+                params = {key: entry[key] for key in ['id', 'mean0', 'mean1', 'mean2', 'mean3',
+                                                      'std0', 'std1', 'std2', 'std3']}
+            except KeyError:
+                return None
+            # older entries have no backbone/input_size: mobilenet_v2 at 224
+            params['backbone'], params['input_size'] = model_factory.model_info(entry)
+            return params
+    return None
+
+############### DATA EXTRACTION ###############
+
+def polar_to_cartesian(lidar):
+    ''' Convert the LaserScan ranges (0 to 180 degrees) to cartesian points. '''
+    min_angle = np.deg2rad(0)
+    max_angle = np.deg2rad(180) # lidar range
+    angle = np.linspace(min_angle, max_angle, len(lidar), endpoint = False)
+
+    # convert polar to cartesian:
+    # x = r * cos(theta)
+    # y = r * sin(theta)
+    # where r is the distance from the lidar (x in lidar)
+    # and angle is the step between the angles measure in each distance (angle(lidar.index(x))
+    xl = [x*np.cos(angle[lidar.index(x)]) for x in lidar]
+    yl = [y*np.sin(angle[lidar.index(y)]) for y in lidar]
+
+    # take all the "inf" off
+    xl = [10.0 if value == 'inf' else value for value in xl]
+    yl = [10.0 if value == 'inf' else value for value in yl]
+
+    return xl, yl
+
+def rasterize(xl, yl, temp_image=TEMP_IMAGE):
+    ''' Plot the points with matplotlib (current figure) and read it back as a BGR image.
+    Returns None if there is no point to plot. '''
+    if len(xl) == 0:
+        return None
+
+    plt.cla()
+    plt.plot(xl,yl, '.', markersize=POINT_WIDTH, color='black')
+    plt.axis('off')
+    plt.xlim([-1.5, 1.5])
+    plt.ylim([0, 2.2])
+    plt.grid(False)
+
+    plt.gca().spines['top'].set_visible(False)
+    plt.gca().spines['right'].set_visible(False)
+    plt.gca().spines['bottom'].set_visible(False)
+    plt.gca().spines['left'].set_visible(False)
+
+    plt.tight_layout()
+    plt.gcf().set_size_inches(5.07, 5.07)
+    plt.gcf().canvas.draw()
+
+    plt.savefig(temp_image)
+
+    image = cv2.imread(temp_image + '.png')
+    os.remove(temp_image + '.png')
+    return image
+
+def prepare_tensor(image):
+    ''' Returns the (1, 1, 224, 224) float tensor for the model and the resized BGR image for the plot. '''
+    # convert image to numpy
+    image = np.array(image)
+
+    # crop image to 224x224 in the pivot point (112 to each side)
+    # image = image[100:400, :, :]
+    image = cv2.resize(image, (224, 224), interpolation=cv2.INTER_LINEAR)
+
+    raw_image = image
+    image = image[:,:, 1]
+
+    # add one more layer to image: [1, 1, 224, 224] as batch size
+    image = np.expand_dims(image, axis=0)
+    image = np.expand_dims(image, axis=0)
+
+    # convert to torch
+    image = torch.from_numpy(image).float()
+    return image, raw_image
+
+############### INFERENCE AND PLOT ##############
+
+def deprocess(label, mean, std):
+    ''' Returns the deprocessed label: (w1, q1, q2) or (w1, w2, q1, q2) -> [m1, m2, b1, b2]. '''
+
+    if len(label) == 3:
+        # we suppose m1 = m2, so we can use the same deprocess
+        w1, q1, q2 = label
+        w2 = w1
+    elif len(label) == 4:
+        w1, w2, q1, q2 = label
+
+    # DEPROCESS THE LABEL
+    w1 = (w1 * std[0]) + mean[0]
+    w2 = (w2 * std[1]) + mean[1]
+    q1 = (q1 * std[2]) + mean[2]
+    q2 = (q2 * std[3]) + mean[3]
+
+    m1 = 1/w1
+    m2 = 1/w2
+    b1 = -q1/w1
+    b2 = -q2/w2
+
+    return [m1, m2, b1, b2]
+
+def predictions_to_lines(predictions, mean, std):
+    ''' Convert the model output tensor (batch 1) to [m1, m2, b1, b2]. '''
+    # correct different format inputs
+    predictions = predictions.to('cpu').cpu().detach().numpy().tolist()[0]
+    if len(predictions) == 3:
+        w1, q1, q2 = predictions
+        w2 = w1
+    elif len(predictions) == 4:
+        w1, w2, q1, q2 = predictions
+    else:
+        w1, w2, q1, q2 = [None, None, None, None]
+
+    # deprocess
+    if not any(e is None for e in [w1, w2, q1, q2]): # enter only if there is no None in the list
+        m1, m2, b1, b2 = deprocess([w1, w2, q1, q2], mean, std)
+    else:
+        m1, m2, b1, b2 = [w1, w2, q1, q2] # Can't use this data
+
+    return [m1, m2, b1, b2]
+
+def draw_lines(response, raw_image, line_color=(0, 0, 255), line_thickness=2):
+    ''' Draw both lines (y = m*x + b) on the BGR image (in place). '''
+    m1, m2, b1, b2 = response
+
+    # Calculate the endpoints of the line
+    x11 = 0
+    y11 = int(m1 * x11 + b1)
+
+    x12 = raw_image.shape[1]  # Width of the image
+    y12 = int(m1 * x12 + b1)
+
+    # Draw the line on the image
+    cv2.line(raw_image, (x11, y11), (x12, y12), line_color, line_thickness)
+
+    # Calculate the endpoints of the line
+    x21 = 0
+    y21 = int(m2 * x21 + b2)
+
+    x22 = raw_image.shape[1]  # Width of the image
+    y22 = int(m2 * x22 + b2)
+
+    cv2.line(raw_image, (x21, y21), (x22, y22), line_color, line_thickness)
+
+    return raw_image
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Overlay renderer for the deploy visualizers: scan image + predicted lines -> BGR frame, only NumPy and OpenCV.
+It reproduces the matplotlib plot used until now in "showLiveRTInference.py" and "show_inference_video.py":
+    plt.imshow(image, cmap='magma', norm=PowerNorm(gamma=16), alpha=0.65) + the red lines
+but the PowerNorm and the colormap are a 256 entries lookup table computed once (per vmin/vmax), so each frame is a
+table lookup, a resize and two cv2.line, instead of a full matplotlib figure redraw with plt.pause.
+
+    overlay = OverlayRenderer(show=True, record='inference.mp4')
+    overlay.update(image, [m1, m2, b1, b2], title='Inference 10/200')
+    overlay.close()
+
+show=False is the headless mode (no window, e.g. in the ROS node or over ssh), record saves an mp4 with
+cv2.VideoWriter. The lines are given in the 224x224 pixels coordinates: y = m*x + b.
+
+@author: Felipe-Tommaselli
+"""
+
+import cv2
+import numpy as np
+from matplotlib import colormaps
+
+IMAGE_SIZE = 224 #px
+LINE_LIMIT = 10000 # px, far endpoints are clipped before the int conversion
+
+def colormap_lut(name='magma', alpha=0.65, background=(255, 255, 255)):
+    ''' (256, 3) BGR uint8 table of a matplotlib colormap blended over the background (the imshow alpha). '''
+    rgba = colormaps[name](np.linspace(0, 1, 256))
+    rgb = rgba[:, :3] * 255
+    blended = alpha * rgb + (1 - alpha) * np.asarray(background, dtype=np.float64)[::-1]
+    return np.round(blended[:, ::-1]).astype(np.uint8) # RGB -> BGR
+
+def power_norm_lut(gamma, vmin, vmax):
+    ''' (256,) colormap index of each uint8 value, same as PowerNorm(gamma) + the 256 colors of the colormap. '''
+    values = np.arange(256, dtype=np.float64)
+    if vmax <= vmin:
+        normalized = np.zeros(256)
+    else:
+        normalized = np.clip((values - vmin) / (vmax - vmin), 0, 1) ** gamma
+    # matplotlib: int(x * N) with x = 1 -> N - 1
+    return np.clip((normalized * 256).astype(np.int64), 0, 255)
+
+def line_endpoints(m, b, width=IMAGE_SIZE, height=IMAGE_SIZE):
+    ''' Two points of the line y = m*x + b on the image borders (float), None if the line can not be drawn. '''
+    if not (np.isfinite(m) and np.isfinite(b)):
+        return None
+    if abs(m) >= 1:
+        # almost vertical (the usual crop line): use the top and bottom borders
+        x0, x1 = (0 - b) / m, (height - b) / m
+        points = ((x0, 0.0), (x1, float(height)))
+    else:
+        points = ((0.0, b), (float(width), m * width + b))
+    return tuple((float(np.clip(x, -LINE_LIMIT, LINE_LIMIT)), float(np.clip(y, -LINE_LIMIT, LINE_LIMIT)))
+                 for x, y in points)
+
+
+class OverlayRenderer:
+    ''' Compose (and show/record) the frames of the scan image with the predicted lines. '''
+
+    def __init__(self, size=448, gamma=16, alpha=0.65, cmap='magma', show=True, record=None, fps=10,
+                 window='RTInference', line_color=(0, 0, 255), line_thickness=2):
+        ''' Constructor of the class. size: output frame size (px). '''
+        self.size = size
+        self.gamma = gamma
+        self.show = show
+        self.window = window
+        self.line_color = line_color
+        self.line_thickness = line_thickness
+        self.colors = colormap_lut(cmap, alpha)
+        self._luts = {} # (vmin, vmax) -> (256, 3) BGR table
+
+        self.writer = None
+        if record is not None:
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            self.writer = cv2.VideoWriter(record, fourcc, fps, (size, size))
+
+    def lut(self, vmin, vmax):
+        ''' BGR color of each uint8 value for the PowerNorm autoscaled in (vmin, vmax). '''
+        key = (int(vmin), int(vmax))
+        if key not in self._luts:
+            self._luts[key] = self.colors[power_norm_lut(self.gamma, *key)]
+        return self._luts[key]
+
+    def compose(self, image, lines, title=None):
+        ''' (H, W) scan image (uint8 or float 0-255) + [m1, m2, b1, b2] -> (size, size, 3) BGR frame. '''
+        image = np.squeeze(np.asarray(image))
+        if image.dtype != np.uint8:
+            image = np.clip(image, 0, 255).astype(np.uint8)
+
+        # PowerNorm autoscale (as imshow): vmin and vmax of the image
+        frame = self.lut(image.min(), image.max())[image]
+        frame = cv2.resize(frame, (self.size, self.size), interpolation=cv2.INTER_NEAREST)
+
+        ############ LINES ############
+        scale = self.size / IMAGE_SIZE
+        m1, m2, b1, b2 = lines
+        for m, b in ((m1, b1), (m2, b2)):
+            endpoints = line_endpoints(m, b)
+            if endpoints is None:
+                continue
+            (x0, y0), (x1, y1) = endpoints
+            start = (int(round(x0 * scale)), int(round(y0 * scale)))
+            end = (int(round(x1 * scale)), int(round(y1 * scale)))
+            cv2.line(frame, start, end, self.line_color, self.line_thickness, lineType=cv2.LINE_AA)
+
+        if title is not None:
+            cv2.putText(frame, title, (8, 22), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1, cv2.LINE_AA)
+        return frame
+
+    def update(self, image, lines, title=None, delay=1):
+        ''' Compose the frame, show it (unless headless) and record it. Returns the frame. '''
+        frame = self.compose(image, lines, title)
+        if self.writer is not None:
+            self.writer.write(frame)
+        if self.show:
+            cv2.imshow(self.window, frame)
+            cv2.waitKey(delay)
+        return frame
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+        if self.show:
+            cv2.destroyWindow(self.window)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the "/terrasentia/scan" publisher, to load-test the inference on a dev box without ROS.
+The ScanPublisher thread calls a callback (as rospy.Subscriber does) with FakeLaserScan messages at a fixed rate,
+from the recorded scans ("Crop_Data{fid}.csv" from "src/test/get_ros_data.py") or from synthetic crop rows.
+
+Running this script does the same loop as "RTinference.py" (latest scan only, processed at the node rate or as
+fast as possible) and reports the processed fps, the dropped scans and the scan -> lines latency:
+    python3 scan_publisher.py --rate 40 --seconds 10 --runid 02-02-2024_00-45-55
+
+@author: Felipe-Tommaselli
+"""
+
+import csv
+import time
+import argparse
+import threading
+
+import numpy as np
+
+NUM_BEAMS = 1081
+
+class FakeLaserScan:
+    ''' Stand-in for "sensor_msgs.msg.LaserScan" with the fields used by the pipeline. '''
+
+    def __init__(self, ranges, angle_min=0.0, angle_max=np.pi, range_min=0.05, range_max=10.0, stamp=None):
+        self.ranges = tuple(float(r) for r in ranges)
+        self.angle_min = angle_min
+        self.angle_max = angle_max
+        self.angle_increment = (angle_max - angle_min) / len(self.ranges)
+        self.range_min = range_min
+        self.range_max = range_max
+        self.stamp = stamp
+
+############### SCANS ###############
+
+def load_recorded_scans(csv_path):
+    ''' Read the scans csv (timestamp, ranges...) from "get_ros_data.py" as a list of FakeLaserScan. '''
+    scans = []
+    with open(csv_path, 'r') as file:
+        reader = csv.reader(file)
+        next(reader) # header
+        for row in reader:
+            if len(row) < 2: # empty lines between the messages
+                continue
+            scans.append(FakeLaserScan([float(r) for r in row[1:]]))
+    return scans
+
+def synthetic_scans(num_scans, num_beams=NUM_BEAMS, seed=0):
+    ''' Two noisy crop rows (left and right) seen from the middle of the corridor. '''
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, np.pi, num_beams, endpoint=False)
+    scans = []
+    for _ in range(num_scans):
+        half_width = rng.uniform(0.3, 0.45)
+        heading = np.radians(rng.uniform(-15, 15))
+        # distance along each beam to the row lines x = +-half_width (rotated by the heading)
+        cos = np.cos(angles - heading)
+        with np.errstate(divide='ignore'):
+            ranges = np.abs(half_width / cos)
+        ranges += rng.normal(0, 0.03, num_beams)
+        ranges[ranges > 10.0] = np.inf
+        ranges[rng.random(num_beams) < 0.3] = np.inf # leaves and gaps between the stalks
+        scans.append(FakeLaserScan(ranges))
+    return scans
+
+
+class ScanPublisher(threading.Thread):
+    ''' Calls callback(scan) at "rate" Hz in a background thread, cycling through the scans. '''
+
+    def __init__(self, callback, scans, rate=40.0, duration=None):
+        ''' Constructor of the class. duration in seconds (None: until stop()). '''
+        super().__init__(daemon=True)
+        self.callback = callback
+        self.scans = scans
+        self.period = 1 / rate
+        self.duration = duration
+        self.published = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        start = time.perf_counter()
+        next_time = start
+        while not self._stop_event.is_set():
+            now = time.perf_counter()
+            if self.duration is not None and now - start >= self.duration:
+                break
+            scan = self.scans[self.published % len(self.scans)]
+            self.callback(FakeLaserScan(scan.ranges, stamp=now))
+            self.published += 1
+            next_time += self.period
+            self._stop_event.wait(max(0.0, next_time - time.perf_counter()))
+        self._stop_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+############### LOAD TEST ###############
+
+class LatestScan:
+    ''' Same mechanism of the ROS node: the callback only keeps the last message. '''
+
+    def __init__(self):
+        self.data = None
+        self.received = 0
+        self._lock = threading.Lock()
+
+    def callback(self, data):
+        with self._lock:
+            self.data = data
+            self.received += 1
+
+    def take(self):
+        with self._lock:
+            data, self.data = self.data, None
+        return data
+
+def load_test(engine, scans, rate, seconds, node_rate=None):
+    ''' Publish at "rate" Hz and process the latest scan in a loop (at "node_rate" Hz, None: as fast as possible). '''
+    latest = LatestScan()
+    publisher = ScanPublisher(latest.callback, scans, rate=rate, duration=seconds)
+    latencies = []
+
+    publisher.start()
+    while not publisher.stopped():
+        loop_start = time.perf_counter()
+        data = latest.take()
+        if data is not None:
+            engine.predict(data.ranges)
+            latencies.append(time.perf_counter() - data.stamp)
+        if node_rate is not None:
+            time.sleep(max(0.0, 1 / node_rate - (time.perf_counter() - loop_start)))
+        elif data is None:
+            time.sleep(0.0005)
+    publisher.join()
+
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'published': publisher.published,
+        'processed': len(latencies),
+        'dropped': publisher.published - len(latencies),
+        'fps': len(latencies) / seconds,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else float('nan'),
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else float('nan'),
+    }
+
+if __name__ == '__main__':
+    from lidar_pipeline import build_model
+    from inference_engine import InferenceEngine
+
+    parser = argparse.ArgumentParser(description='Load test of the inference engine with a fake scan publisher.')
+    parser.add_argument('--scans', default=None, help='recorded scans csv (get_ros_data.py format)')
+    parser.add_argument('--rate', type=float, default=40.0, help='publisher rate (Hz)')
+    parser.add_argument('--node-rate', type=float, default=None, help='node loop rate (Hz), default: free running')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--runid', default=None, help='model_{runid}.pth (random weights if not given)')
+    parser.add_argument('--renderer', default='raster', choices=['raster', 'matplotlib'])
+    args = parser.parse_args()
+
+    scans = load_recorded_scans(args.scans) if args.scans is not None else synthetic_scans(100)
+    if args.runid is not None:
+        engine = InferenceEngine.from_runid(args.runid, renderer=args.renderer)
+    else:
+        print('No trained model, using random weights.')
+        engine = InferenceEngine(build_model(), mean=[0.0] * 4, std=[1.0] * 4, renderer=args.renderer)
+
+    if args.renderer == 'matplotlib':
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        plt.subplots(figsize=(8, 5), frameon=True)
+
+    result = load_test(engine, scans, args.rate, args.seconds, node_rate=args.node_rate)
+    print(f"published: {result['published']} .. processed: {result['processed']} .. dropped: {result['dropped']}")
+    print(f"fps: {result['fps']:.1f} .. latency p50: {result['p50_ms']:.2f} ms .. p99: {result['p99_ms']:.2f} ms")
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-process deploy mode: the rasterization and the model forward run in two processes (no GIL shared between them)
+connected by shared-memory ring buffers (multiprocessing.shared_memory), instead of one "RTinference.py" process.
+
+    scans ring (N, 1081) float32 -> preprocess process (filter + rasterizer) -> frames ring (N, 224, 224) uint8
+    -> inference process (model forward + deprocess) -> results ring (N, 4) float64 -> node
+
+SharedRing (one writer and one reader process): fixed number of slots (>= 2), each with a sequence number and a
+stamp (the time of the scan):
+    - the writer fills the next slot in place (reserve() returns a view of the slot, the rasterizer renders into it)
+      and publishes it with commit(); a full ring overwrites its oldest slot (drop oldest, the writer never waits)
+    - the reader keeps its own tail: read() returns the view of the oldest slot newer than the tail (the overwritten
+      ones are counted as dropped) and pins it, so the writer takes the other slots until release(). The inference
+      reads the frames zero-copy (torch.from_numpy of the view) during its whole forward
+    - the pin handshake (reader: pin, then check the sequence; writer: mark the slot, then check the pin) is a Dekker
+      pattern on plain numpy loads and stores, without memory fences: the store -> load reordering of x86 can let both
+      sides take the same slot. Torn slots are not prevented but detected: release() checks the sequence of the slot
+      (seqlock), the data of a torn slot is discarded and counted as torn (not as dropped)
+By default the inference takes the newest frame (latest=True, the latest scan only of "RTinference.py"), the older
+ones are dropped.
+The process that creates the rings unlinks them; the stop event ends the loops of both processes (clean shutdown, also
+on Ctrl+C). Only image models: the inference process refuses the raw-scan models (inputs='scan'), and the scan filter
+runs in the preprocess process (filter_scans), before the rasterizer.
+
+    pipeline = ShmPipeline(runid).start()
+    pipeline.submit(scan.ranges, stamp) # in the scan callback
+    result = pipeline.poll() # (sequence, stamp, [m1, m2, b1, b2]) or None
+    pipeline.stop()
+
+Benchmark against the single-process pipeline ("scan_publisher.py" load test, latest scan only):
+    python3 shm_ring.py --rate 40 --seconds 10 --runid 02-02-2024_00-45-55
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from scan_publisher import NUM_BEAMS, ScanPublisher, load_recorded_scans, synthetic_scans
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from rasterizer import Rasterizer, IMAGE_SIZE
+
+SLOTS = 4
+POLL = 0.0002 # s, sleep of a reader waiting for a slot
+ALIGN = 64 # bytes, start of the slots
+
+
+class SharedRing:
+    ''' Ring of "slots" arrays of the same shape and dtype in one shared memory block, one writer and one reader. '''
+
+    def __init__(self, shape, dtype, slots=SLOTS, name=None):
+        ''' Constructor of the class. name=None: create a new block, else attach to the block of another process. '''
+        if slots < 2:
+            raise ValueError('a ring needs at least 2 slots (one read while the other one is written)')
+        self.shape, self.dtype, self.slots = tuple(shape), np.dtype(dtype), slots
+        header = 8 * (2 + 2 * slots) # head, pinned, sequences, stamps
+        self.offset = -(-header // ALIGN) * ALIGN
+        size = self.offset + slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        self.owner = name is None
+        # the processes attached are started by the owner: they share its resource tracker, only the owner unlinks
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+
+        buffer = self.memory.buf
+        self.head = np.ndarray((1,), dtype=np.int64, buffer=buffer) # last committed sequence (0: none)
+        self.pinned = np.ndarray((1,), dtype=np.int64, buffer=buffer, offset=8) # slot used by the reader (-1: none)
+        self.sequences = np.ndarray((slots,), dtype=np.int64, buffer=buffer, offset=16) # 0: empty, -1: being written
+        self.stamps = np.ndarray((slots,), dtype=np.float64, buffer=buffer, offset=8 * (2 + slots))
+        self.data = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=buffer, offset=self.offset)
+        if self.owner:
+            self.head[0] = 0
+            self.pinned[0] = -1
+            self.sequences[:] = 0
+        self.tail = 0 # last sequence read by this process
+        self.dropped = 0 # overwritten before being read
+        self.torn = 0 # overwritten while being read (detected by release())
+
+    @property
+    def spec(self):
+        ''' Arguments to attach to the ring from another process. '''
+        return {'shape': self.shape, 'dtype': self.dtype.str, 'slots': self.slots, 'name': self.memory.name}
+
+    ############ WRITER ############
+
+    def reserve(self):
+        ''' (sequence, view) of the oldest slot not pinned by the reader, to be filled in place and published with
+        commit(). Never waits: the oldest frame is dropped. No fence between the mark and the pin check: the reader
+        detects a slot taken anyway in release(). '''
+        sequence = int(self.head[0]) + 1
+        for slot in np.argsort(self.sequences, kind='stable'):
+            if slot == self.pinned[0]:
+                continue
+            previous = self.sequences[slot]
+            self.sequences[slot] = -1 # being written: the reader skips it
+            if self.pinned[0] != slot:
+                return sequence, self.data[slot]
+            self.sequences[slot] = previous # pinned meanwhile, still intact: take the next one
+        raise RuntimeError('no free slot') # only one slot can be pinned
+
+    def commit(self, sequence, stamp):
+        slot = int(np.flatnonzero(self.sequences == -1)[0])
+        self.stamps[slot] = stamp
+        self.sequences[slot] = sequence
+        self.head[0] = sequence
+
+    def push(self, array, stamp):
+        ''' Copy an array into the next slot, returns its sequence. '''
+        sequence, view = self.reserve()
+        view[...] = array
+        self.commit(sequence, stamp)
+        return sequence
+
+    ############ READER ############
+
+    def read(self, timeout=None, stop=None, latest=False):
+        ''' (sequence, stamp, view) of the oldest slot newer than the last one read (latest=True: the newest slot, the
+        older ones are dropped), or None after timeout seconds (or once stop is set). The slot is pinned (not
+        overwritten) until release(). '''
+        self.release()
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            if self.head[0] > self.tail:
+                sequences = self.sequences.copy()
+                newer = sequences > self.tail
+                if np.any(newer):
+                    sequence = int(sequences[newer].max() if latest else sequences[newer].min())
+                    slot = int(np.flatnonzero(sequences == sequence)[0])
+                    self.pinned[0] = slot
+                    if self.sequences[slot] == sequence: # not taken by the writer before the pin
+                        self.dropped += sequence - self.tail - 1
+                        self.tail = sequence
+                        return sequence, float(self.stamps[slot]), self.data[slot]
+                    self.pinned[0] = -1
+                    continue
+            if (stop is not None and stop.is_set()) or (deadline is not None and time.perf_counter() > deadline):
+                return None
+            time.sleep(POLL)
+
+    def release(self):
+        ''' Unpin the slot of the last read(): True if its data was consistent (never overwritten, seqlock check),
+        False if it was torn (counted in self.torn, the data read from it must be discarded). '''
+        slot = int(self.pinned[0])
+        if slot < 0:
+            return True
+        self.pinned[0] = -1
+        consistent = bool(self.sequences[slot] == self.tail)
+        self.torn += not consistent
+        return consistent
+
+    def close(self):
+        ''' Release the views and the block (and unlink it if this process created it). '''
+        del self.head, self.pinned, self.sequences, self.stamps, self.data
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+############### PROCESSES ###############
+
+def preprocess_process(scans_spec, frames_spec, stop, stats, filter_scans=False):
+    ''' scans ring -> (scan filter) -> rasterizer rendering into the frames ring, in place. '''
+    scans, frames = SharedRing(**scans_spec), SharedRing(**frames_spec)
+    rasterizer = Rasterizer()
+    if filter_scans:
+        from scan_filter import ScanFilter
+        rasterizer.scan_filter = ScanFilter()
+    rendered = 0
+    item = view = None
+    try:
+        while not stop.is_set():
+            item = scans.read(timeout=0.1, stop=stop)
+            if item is None:
+                continue
+            sequence, stamp, ranges = item
+            ranges = np.array(ranges) # the scan is small: copy and unpin it at once
+            if not scans.release(): # torn scan
+                continue
+            slot_sequence, view = frames.reserve()
+            rasterizer.render_scans(ranges[None], out=view[None])
+            frames.commit(slot_sequence, stamp)
+            rendered += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stats.put({'rendered': rendered, 'scans_dropped': scans.dropped, 'scans_torn': scans.torn})
+        item = view = None # no view of the blocks left before closing them
+        scans.close()
+        frames.close()
+
+def inference_process(frames_spec, results_spec, stop, stats, runid=None, threads=None, latest=True):
+    ''' frames ring -> zero-copy model forward -> deprocess -> results ring. latest: newest frame only (as the latest
+    scan of "RTinference.py"), else all the frames still in the ring in order. Reports an error (stats) and returns
+    for a raw-scan model: the frames are rendered images. '''
+    import torch
+    from lidar_pipeline import build_model
+    from inference_engine import InferenceEngine
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if runid is not None:
+        engine = InferenceEngine.from_runid(runid)
+    else:
+        engine = InferenceEngine(build_model(), mean=[0.0] * 4, std=[1.0] * 4)
+    if engine.inputs != 'image':
+        stats.put({'error': f'the model of {runid} takes raw scans (inputs={engine.inputs!r}), the shared-memory '
+                            f'pipeline only runs image models'})
+        return
+    frames, results = SharedRing(**frames_spec), SharedRing(**results_spec)
+    stats.put({'ready': True})
+    inferred = 0
+    item = image = None
+    try:
+        while not stop.is_set():
+            item = frames.read(timeout=0.1, stop=stop, latest=latest)
+            if item is None:
+                continue
+            sequence, stamp, image = item
+            # image[None] is a view of the shared memory: torch.from_numpy in forward() does not copy it
+            lines = engine.deprocess(engine.forward(image[None]))[0]
+            if not frames.release(): # torn: overwritten during the forward despite the pin
+                continue
+            results.push(lines, stamp)
+            inferred += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stats.put({'inferred': inferred, 'frames_dropped': frames.dropped, 'frames_torn': frames.torn})
+        item = image = None # no view of the blocks left before closing them
+        frames.close()
+        results.close()
+
+
+class ShmPipeline:
+    ''' Node side of the multi-process mode: owns the rings and the preprocess and inference processes. '''
+
+    def __init__(self, runid=None, slots=SLOTS, num_beams=NUM_BEAMS, filter_scans=False, threads=None, latest=True):
+        self.scans = SharedRing((num_beams,), np.float32, slots)
+        self.frames = SharedRing((IMAGE_SIZE, IMAGE_SIZE), np.uint8, slots)
+        self.results = SharedRing((4,), np.float64, slots)
+        context = mp.get_context('spawn') # no torch state inherited from the node
+        self.stop_event = context.Event()
+        self.stats = context.Queue()
+        self.processes = [
+            context.Process(target=preprocess_process, daemon=True,
+                            args=(self.scans.spec, self.frames.spec, self.stop_event, self.stats, filter_scans)),
+            context.Process(target=inference_process, daemon=True,
+                            args=(self.frames.spec, self.results.spec, self.stop_event, self.stats, runid, threads,
+                                  latest)),
+        ]
+        self.summary = {}
+
+    def start(self, timeout=120.0):
+        ''' Start the processes and wait for the model to be loaded. Raises ValueError for a raw-scan model. '''
+        for process in self.processes:
+            process.start()
+        ready = self.stats.get(timeout=timeout)
+        if 'error' in ready:
+            self.stop()
+            raise ValueError(ready['error'])
+        self.summary.update(ready)
+        return self
+
+    def submit(self, ranges, stamp=None):
+        ''' Queue a scan (never blocks: a full ring drops its oldest scan). '''
+        return self.scans.push(np.asarray(ranges, dtype=np.float32), time.perf_counter() if stamp is None else stamp)
+
+    def poll(self, timeout=0.0):
+        ''' (sequence, stamp, [m1, m2, b1, b2]) of the next result, or None. '''
+        item = self.results.read(timeout=timeout)
+        if item is None:
+            return None
+        sequence, stamp, lines = item
+        lines = lines.tolist()
+        return (sequence, stamp, lines) if self.results.release() else None
+
+    def stop(self, timeout=5.0):
+        ''' Stop the loops, join the processes (terminate them if they hang) and unlink the rings. '''
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        while not self.stats.empty():
+            self.summary.update(self.stats.get())
+        for ring in (self.scans, self.frames, self.results):
+            ring.close()
+        return self.summary
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+############### BENCHMARK ###############
+
+def load_test(pipeline, scans, rate, seconds):
+    ''' Publish at "rate" Hz into the pipeline and collect the results (statistics of scan_publisher.load_test). '''
+    lock = threading.Lock()
+    def callback(data):
+        with lock:
+            pipeline.submit(data.ranges, data.stamp)
+    publisher = ScanPublisher(callback, scans, rate=rate, duration=seconds)
+    latencies = []
+
+    publisher.start()
+    while not publisher.stopped():
+        result = pipeline.poll(timeout=0.01)
+        if result is not None:
+            latencies.append(time.perf_counter() - result[1]) # perf_counter: CLOCK_MONOTONIC, the same in all processes
+    publisher.join()
+
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'published': publisher.published,
+        'processed': len(latencies),
+        'dropped': publisher.published - len(latencies),
+        'fps': len(latencies) / seconds,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else float('nan'),
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else float('nan'),
+    }
+
+if __name__ == '__main__':
+    import scan_publisher
+    from lidar_pipeline import build_model
+    from inference_engine import InferenceEngine
+
+    parser = argparse.ArgumentParser(description='Shared-memory multi-process pipeline vs the single-process one.')
+    parser.add_argument('--scans', default=None, help='recorded scans csv (get_ros_data.py format)')
+    parser.add_argument('--rate', type=float, default=40.0, help='publisher rate (Hz)')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--slots', type=int, default=SLOTS)
+    parser.add_argument('--runid', default=None, help='model_{runid}.pth (random weights if not given)')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads of the inference process')
+    parser.add_argument('--filter', action='store_true', help='ScanFilter in the preprocessing')
+    parser.add_argument('--in-order', action='store_true', help='infer all the frames in the ring, not the newest')
+    args = parser.parse_args()
+
+    scans = load_recorded_scans(args.scans) if args.scans is not None else synthetic_scans(100)
+    results = {}
+
+    ############ SINGLE PROCESS ############
+    if args.runid is not None:
+        engine = InferenceEngine.from_runid(args.runid)
+    else:
+        print('No trained model, using random weights.')
+        engine = InferenceEngine(build_model(), mean=[0.0] * 4, std=[1.0] * 4)
+    if args.filter:
+        from scan_filter import ScanFilter
+        engine.scan_filter = ScanFilter()
+    results['single process'] = scan_publisher.load_test(engine, scans, args.rate, args.seconds)
+    del engine
+
+    ############ SHARED MEMORY ############
+    pipeline = ShmPipeline(args.runid, slots=args.slots, num_beams=len(scans[0].ranges), filter_scans=args.filter,
+                           threads=args.threads, latest=not args.in_order).start()
+    try:
+        results['shared memory'] = load_test(pipeline, scans, args.rate, args.seconds)
+    finally:
+        summary = pipeline.stop()
+    print(f"rings: {summary.get('scans_dropped', 0)} scans and {summary.get('frames_dropped', 0)} frames dropped, "
+          f"{summary.get('scans_torn', 0)} scans and {summary.get('frames_torn', 0)} frames torn")
+
+    print(f"{'mode':<16}{'published':>10}{'processed':>10}{'dropped':>10}{'fps':>8}{'p50 (ms)':>10}{'p99 (ms)':>10}")
+    for mode, result in results.items():
+        print(f"{mode:<16}{result['published']:>10}{result['processed']:>10}{result['dropped']:>10}"
+              f"{result['fps']:>8.1f}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}")
@@ -2,39 +2,57 @@
 
 import os
 import sys
+import time
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import PowerNorm
 import colorful as cf
-import matplotlib
-matplotlib.use('TkAgg')
 import rospy
 from inference.srv import RTInferenceService
 from inference.srv import RTInferenceServiceShow
 #~/catkin_ws/src/terrasentia_navigation/inference/scripts
 
+from image_codec import decode_image, decode_float_list
+from overlay import OverlayRenderer
 
 global SHOW
 SHOW = True
+global COMPACT
+COMPACT = False # use the RTInferenceCompact service (uint8/zlib/png image, see image_codec.py)
+global ENCODING
+ENCODING = 'zlib'
+global PREVIEW
+PREVIEW = 1 # image downsample factor (1, 2 or 4)
+global HEADLESS
+HEADLESS = False # no window (only the recording)
+global RECORD
+RECORD = None # path of the mp4 recording, e.g. 'live_inference.mp4'
 
 class clientRTInference:
     def __init__(self):
         rospy.init_node('client_node')
-        rospy.wait_for_service('rt_inference_service')
+        if COMPACT:
+            from wp_gen.srv import RTInferenceCompact
+            rospy.wait_for_service('RTInferenceCompact')
+        else:
+            rospy.wait_for_service('rt_inference_service')
         
-        fig, _ = plt.subplots(figsize=(8, 5), frameon=True)
+        self.overlay = OverlayRenderer(show=not HEADLESS, record=RECORD, fps=2)
         self.delay = 0.5
         while True:
             try:
                 # Create a service proxy
-                if SHOW:
+                if COMPACT:
+                    rt_inference_service = rospy.ServiceProxy('RTInferenceCompact', RTInferenceCompact)
+                elif SHOW:
                     rt_inference_service = rospy.ServiceProxy('rt_inference_service', RTInferenceServiceShow)
                 else:       
                     rt_inference_service = rospy.ServiceProxy('rt_inference_service', RTInferenceService)
                 
                 # Call the service with the request
-                response = rt_inference_service()
+                if COMPACT:
+                    response = rt_inference_service(show=SHOW, encoding=ENCODING, preview=PREVIEW)
+                else:
+                    response = rt_inference_service()
                 
                 # Access the response fields
                 m1 = response.left_line.m
@@ -42,56 +60,30 @@ class clientRTInference:
 
                 m2 = response.right_line.m
                 b2 = response.right_line.b
-                if SHOW:
-                    image = response.image
+                if SHOW and COMPACT:
+                    image = decode_image(response.image, response.encoding, response.height, response.width)
+                elif SHOW:
+                    image = decode_float_list(response.image)
                 else: 
-                    image = np.zeros(224*224)
+                    image = np.zeros((224, 224))
 
                 rospy.loginfo(cf.green('Message received by the client!'))
                 print(f"Response: m1={m1:.2f}, m2={m2:.2f}, b1={b1:.2f}, b2={b2:.2f}")
                 
             except rospy.ServiceException as e:
                 rospy.logerr("Service call failed: %s" % e)
+                self.overlay.close()
                 sys.exit("Exiting the script")
 
-            x = np.arange(224)
-            y1p, y2p, image = self.prepare_plot(x, [m1, m2, b1, b2], image)
             if SHOW:
-                self.show(x, y1p, y2p, image)
+                self.show([m1, m2, b1, b2], image)
 
 
-    def prepare_plot(self, x, predictions, image):
-        # line equations explicitly
-
-        # get the slopes and intercepts
-        m1p, m2p, b1p, b2p = predictions
-
-        # get the x and y coordinates of the lines
-        y1p = m1p*x + b1p
-        y2p = m2p*x + b2p
-
-        image = np.array(image)
-        image = image.reshape((224, 224))
-
-        return y1p, y2p, image
-
-
-    def show(self, x, y1p, y2p, image):
-        
-        linewidth = 2.5
-
-        plt.plot(x, y1p, color='red', label='Predicted', linewidth=linewidth)
-        plt.plot(x, y2p, color='red', linewidth=linewidth)
-
-        border_style = dict(facecolor='none', edgecolor='black', linewidth=2)
-        plt.gca().add_patch(plt.Rectangle((0, 0), 1, 1, **border_style, transform=plt.gcf().transFigure))
-        plt.legend(loc='upper right', prop={'size': 9, 'family': 'Ubuntu'})
-        plt.imshow(image, cmap='magma', norm=PowerNorm(gamma=16), alpha=0.65)
-        plt.axis('off')
-        
-        plt.draw()
-        plt.pause(self.delay)
-        plt.clf()  
+    def show(self, predictions, image):
+        # the preview images are smaller than 224x224, the overlay keeps the lines in the 224 pixels coordinates
+        self.overlay.update(image, predictions, delay=int(self.delay * 1000))
+        if HEADLESS:
+            time.sleep(self.delay)
 
 
 if __name__ == "__main__":
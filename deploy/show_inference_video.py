@@ -4,10 +4,13 @@ import cv2
 import torch
 import numpy as np
 import math 
-import matplotlib.pyplot as plt
-from matplotlib.colors import PowerNorm
-import seaborn as sns 
-import torchvision.models as models
+import sys
+
+from overlay import OverlayRenderer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import model_factory
+from model_factory import DEFAULT_BACKBONE
 
 device = torch.device("cpu")
 
@@ -16,27 +19,14 @@ print(os.getcwd())
 
 global fid
 fid = 5
+global HEADLESS
+HEADLESS = False # no window (only the recording)
+global RECORD
+RECORD = None # path of the mp4 recording, e.g. 'inference_video.mp4'
 
-def load_model():
-    ########### MOBILE NET ########### 
-    model = models.mobilenet_v2()
-    model.features[0][0] = torch.nn.Conv2d(1, 32, kernel_size=3, stride=2, padding=1, bias=False)
-
-    # MobileNetV2 uses a different attribute for the classifier
-    num_ftrs = model.classifier[1].in_features
-    model.classifier[1] = torch.nn.Sequential(
-    torch.nn.Linear(num_ftrs, 512),
-    torch.nn.BatchNorm1d(512),
-    torch.nn.ReLU(inplace=True),
-    torch.nn.Linear(512, 3)
-    )
-
+def load_model(backbone=DEFAULT_BACKBONE):
     path = os.getcwd() + '/models/' + 'model_0005_30-01-2024_02-31-35.pth'
-    checkpoint = torch.load(path, map_location='cpu')  # Load to CPU
-    model.load_state_dict(checkpoint)
-    model.eval()
-
-    return model
+    return model_factory.load_model(path, backbone)
 
 def get_data(t:int, path: str):
     image = cv2.imread(os.path.join(path, f"image{t}.png"))
@@ -99,40 +89,18 @@ def inference(image, model):
 
     return predictions
 
-def prepare_plot(x, predictions, image):
+def prepare_plot(predictions, image):
     # convert the predictions to numpy array
     predictions = predictions.to('cpu').cpu().detach().numpy()
     predictions = deprocess(image=image, label=predictions[0].tolist())
 
-
     # convert image to cpu 
     image = image.to('cpu').cpu().detach().numpy()
-    # image it is shape (1, 1, 507, 507), we need to remove the first dimension
+    # image it is shape (1, 1, 224, 224), we need to remove the first dimensions
     image = image[0][0]
 
-    # line equations explicitly
-
-    # get the slopes and intercepts
-    m1p, m2p, b1p, b2p = predictions
-
-    # get the x and y coordinates of the lines
-    y1p = m1p*x + b1p
-    y2p = m2p*x + b2p
-
-    return y1p, y2p, image
-
-def show(x, y1p, y2p, image):
-    linewidth = 2.5
-
-    ax.plot(x, y1p, color='red', label='Predicted', linewidth=linewidth)
-    ax.plot(x, y2p, color='red', linewidth=linewidth)
-
-    border_style = dict(facecolor='none', edgecolor='black', linewidth=2)
-    ax.add_patch(plt.Rectangle((0, 0), 1, 1, **border_style, transform=ax.transAxes))
-    plt.legend(loc='upper right', prop={'size': 9, 'family': 'Ubuntu'})
-    ax.imshow(image, cmap='magma', norm=PowerNorm(gamma=16), alpha=0.65)
-    ax.axis('off')
-    plt.show()
+    # line equations explicitly: slopes and intercepts [m1, m2, b1, b2]
+    return predictions, image
 
 if __name__ == '__main__':
 
@@ -144,44 +112,14 @@ if __name__ == '__main__':
     print(f"Number of files in the folder: {file_count}")
 
     ########## PLOT ########## 
-    plt.ion()
-
-    fig, ax = plt.subplots(figsize=(8, 5), frameon=True)
-    x = np.arange(0, 224)
-    linewidth = 2.5
-
-    # create the lines with rand values
-    line1, = ax.plot(x, x, color='red', label='Predicted', linewidth=linewidth)
-    line2, = ax.plot(x, x, color='red', linewidth=linewidth)
-    image = np.zeros((224, 224)) # empty blank (224, 224) image
-
-    border_style = dict(facecolor='none', edgecolor='black', linewidth=2)
-    ax.add_patch(plt.Rectangle((0, 0), 1, 1, **border_style, transform=ax.transAxes))
-    plt.legend(loc='upper right', prop={'size': 9, 'family': 'Ubuntu'})
-    ax.axis('off')
-    ax.imshow(image, cmap='magma', norm=PowerNorm(gamma=16), alpha=0.65)
+    overlay = OverlayRenderer(show=not HEADLESS, record=RECORD, fps=20)
 
     for t in range(2, file_count, 20):
         image = get_data(t, path)
         predictions = inference(image, model)
-        y1p, y2p, image = prepare_plot(x, predictions, image)
-
-        # updating data values
-        line1.set_xdata(x)
-        line1.set_ydata(y1p)
-        line2.set_xdata(x)
-        line2.set_ydata(y2p)
-
-        #print("y1p:", y1p[0])
-        #print("y2p:", y2p[0])
-
-        ax.imshow(image, cmap='magma', norm=PowerNorm(gamma=16), alpha=0.65)
-
-        plt.title(f"Inference {int(t//2)}/{file_count}", fontsize=22)
+        lines, image = prepare_plot(predictions, image)
 
         # drawing updated values
-        fig.canvas.draw()
-
-        fig.canvas.flush_events()
-        time.sleep(0.05)
+        overlay.update(image, lines, title=f"Inference {int(t//2)}/{file_count}", delay=50)
 
+    overlay.close()
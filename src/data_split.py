@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reproducible train/val split of a dataset, stratified by the line geometry of the artificial generator.
+The csv only has (m1, m2, b1, b2), so the generator parameters are recovered from the labels:
+    - angle: rotation of the lines in degrees (atan of w = 1/m, the angle to the vertical), bucketed by ANGLE_BIN
+    - divider: distance between the two parallel lines in pixels (|q2 - q1| * cos(angle)), in DIVIDER_RANGES ranges
+      with the same number of samples (quantiles of the dataset, the label pixels are not the generator pixels)
+Each (angle bucket, divider range) is a stratum, so train and val have the same distribution of both. The strata with
+less samples than needed are merged into their angle bucket (and then into one stratum).
+
+The split is seeded and the index arrays are saved next to the dataset cache ("train{fid}.npz"):
+    "train{fid}.split_seed{seed}_val{30}.npz" or "train{fid}.split_seed{seed}_fold{k}of{n}.npz"
+so every experiment (and every sweep) validates on the same samples. k-fold uses sklearn StratifiedKFold.
+
+    python3 data_split.py ../data/artificial_data/tags/Artificial_Label_Data11.csv ../data/artificial_data/train11
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import numpy as np
+from sklearn.model_selection import StratifiedKFold, train_test_split
+
+from pre_process import PreProcess
+from label_index import LabelIndex, csv_signature
+
+ANGLE_BIN = 5 # degrees
+DIVIDER_RANGES = 3 # quantile ranges of the divider
+
+def line_geometry(labels):
+    ''' (N, 4) csv labels (m1, m2, b1, b2) -> angle (N,) in degrees and divider (N,) in pixels. '''
+    w1, w2, q1, q2 = PreProcess.parametrization_batch(labels).T
+    angle = np.degrees(np.arctan(w1))
+    divider = np.abs(q2 - q1) * np.cos(np.arctan(w1))
+    return angle, divider
+
+def strata(labels, min_count=2, angle_bin=ANGLE_BIN, divider_ranges=DIVIDER_RANGES):
+    ''' Stratum code (N,) of each label: angle bucket x divider range, small strata merged. '''
+    angle, divider = line_geometry(labels)
+    angle_bucket = np.floor(angle / angle_bin).astype(np.int64)
+    edges = np.quantile(divider, np.linspace(0, 1, divider_ranges + 1)[1:-1])
+    divider_range = np.digitize(divider, edges) # 0 .. divider_ranges - 1
+    ranges = divider_ranges + 1 # the last one is the merged "any divider" range of the angle bucket
+    codes = angle_bucket * ranges + divider_range
+
+    # strata too small to be split: merge them into the angle bucket, then into one stratum
+    for fallback in (angle_bucket * ranges + ranges - 1, np.full_like(codes, np.iinfo(np.int64).min)):
+        _, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+        small = counts[inverse] < min_count
+        codes = np.where(small, fallback, codes)
+    return codes
+
+def split_path(train_path, seed, val_fraction=None, fold=None, n_splits=None):
+    ''' Path of the saved split, next to the dataset cache of train_path. '''
+    base = os.path.normpath(train_path)
+    if fold is None:
+        return f'{base}.split_seed{seed}_val{int(round(100 * val_fraction))}.npz'
+    return f'{base}.split_seed{seed}_fold{fold}of{n_splits}.npz'
+
+def stratified_split(labels, val_fraction=0.3, seed=0):
+    ''' (train_idx, val_idx) sorted index arrays, stratified and seeded. '''
+    n_val = int(np.ceil(val_fraction * len(labels)))
+    codes = strata(labels, min_count=2)
+    indices = np.arange(len(labels))
+    try:
+        train_idx, val_idx = train_test_split(indices, test_size=n_val, random_state=seed, stratify=codes)
+    except ValueError:
+        # fewer samples than strata (tiny datasets): plain seeded split
+        train_idx, val_idx = train_test_split(indices, test_size=n_val, random_state=seed)
+    return np.sort(train_idx), np.sort(val_idx)
+
+def kfold_splits(labels, n_splits=5, seed=0):
+    ''' List of the n_splits (train_idx, val_idx), stratified and seeded. '''
+    codes = strata(labels, min_count=n_splits)
+    folds = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    return [(np.sort(train_idx), np.sort(val_idx)) for train_idx, val_idx in folds.split(np.zeros(len(codes)), codes)]
+
+def load_split(csv_path, train_path, val_fraction=0.3, seed=0, fold=None, n_splits=5):
+    ''' (train_idx, val_idx) of the dataset: the saved split if the csv did not change, otherwise a new one (saved).
+    fold=None: stratified train/val split, fold=k: k-th fold of a stratified k-fold. '''
+    path = split_path(train_path, seed, val_fraction, fold, n_splits)
+    signature = csv_signature(csv_path)
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            if np.array_equal(saved['signature'], signature):
+                return saved['train'], saved['val']
+        print(f'The csv changed, recomputing the split {path}')
+
+    labels = LabelIndex.from_csv(csv_path).values
+    if fold is None:
+        train_idx, val_idx = stratified_split(labels, val_fraction, seed)
+    else:
+        train_idx, val_idx = kfold_splits(labels, n_splits, seed)[fold]
+
+    with open(path, 'wb') as file:
+        np.savez(file, train=train_idx, val=val_idx, signature=signature)
+    print(f'Saved the split (train {len(train_idx)}, val {len(val_idx)}) to {path}')
+    return train_idx, val_idx
+
+if __name__ == '__main__':
+    csv_path, train_path = sys.argv[1], sys.argv[2]
+    train_idx, val_idx = load_split(csv_path, train_path)
+    labels = LabelIndex.from_csv(csv_path).values
+    angle, divider = line_geometry(labels)
+    print(f"{'':<8}{'samples':>10}{'angle mean':>12}{'angle std':>12}{'divider mean':>14}")
+    for name, idx in (('train', train_idx), ('val', val_idx)):
+        print(f'{name:<8}{len(idx):>10}{angle[idx].mean():>12.2f}{angle[idx].std():>12.2f}{divider[idx].mean():>14.2f}')
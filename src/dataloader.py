@@ -15,6 +15,8 @@ With that, two processes take place: Data normalization and Dataset creation.
 Difference from 'dataloader.py' and 'test_dataloader.py'
 dataloader.py: loads the entire image dataset once
 test_dataloader.py: load each image at each get_item call
+LazyNnDataLoader: decodes each image on demand in the DataLoader workers and keeps the decoded images in a LRU cache
+of fixed size (MB) in shared memory ("image_cache.py"), for datasets larger than the RAM
 
 @author: Felipe-Tommaselli
 """ 
@@ -39,78 +41,111 @@ from torchvision import datasets
 import torchvision.models as models
 import json
 import copy
+import time
 
 from pre_process import *
+from label_index import LabelIndex
+from image_io import read_image, read_images
+from image_cache import SharedLRUCache
 
 # move from root (\src) to \assets\images
 if os.getcwd().split(r'/')[-1] == 'src':
     os.chdir('..') 
 
+def load_params_entry(runid, filename='./models/params.json'):
+    ''' Returns the "params.json" entry (dict) of the runid, the last one if the runid was saved twice. '''
+    with open(filename, 'r') as file:
+        existing_data = json.load(file)
+    for params in reversed(existing_data):
+        if params['id'] == runid:
+            return params
+    raise KeyError(f'No params.json entry for the runid {runid}')
+
+def load_params(runid, filename='./models/params.json'):
+    ''' Returns the mean and std (w1, w2, q1, q2) saved in "params.json" by the training of the runid. '''
+    params = load_params_entry(runid, filename)
+    mean = np.array([params['mean' + str(i)] for i in range(4)])
+    std = np.array([params['std' + str(i)] for i in range(4)])
+    return mean, std
+
+def save_params(runid, mean, std, filename='./models/params.json'):
+    ''' Append the mean and std (w1, w2, q1, q2) of the runid to "params.json". '''
+    new_params = {
+        'id': runid,  # You can set the appropriate id value
+        'mean0': mean[0],
+        'mean1': mean[1],
+        'mean2': mean[2],
+        'mean3': mean[3],
+        'std0': std[0],
+        'std1': std[1],
+        'std2': std[2],
+        'std3': std[3]
+    }
+
+    with open(filename, 'r') as file:
+        existing_data = json.load(file)
+
+    existing_data.append(new_params)
+    with open(filename, 'w') as file:
+        json.dump(existing_data, file, indent=4)
+
+def update_params(runid, filename='./models/params.json', **fields):
+    ''' Add fields (e.g. backbone, input_size) to the last "params.json" entry of the runid. '''
+    with open(filename, 'r') as file:
+        existing_data = json.load(file)
+    for params in reversed(existing_data):
+        if params['id'] == runid:
+            params.update(fields)
+            break
+    else:
+        raise KeyError(f'No params.json entry for the runid {runid}')
+    with open(filename, 'w') as file:
+        json.dump(existing_data, file, indent=4)
+
+def normalize_labels(labels, runid, mean=None, std=None):
+    ''' (N, 4) csv labels (m1, m2, b1, b2) -> normalized (N, 4) (w1, w2, q1, q2), mean and std.
+    mean, std: None for the ones of the labels. They are saved in "params.json" for the runid (None: not saved). '''
+    ############ PROCESS LABEL ############
+    labels_numpy = np.stack(NnDataLoader.process_label(np.asarray(labels).T), axis=1)
+
+    ############ OBTAIN MEAN AND STD FOR NORMALIZATION ############
+    if mean is None:
+        mean, std = np.mean(labels_numpy, axis=0), np.std(labels_numpy, axis=0)
+    labels_normalized = PreProcess.standard_extract_label_batch(labels_numpy, mean, std)
+
+    ############ SAVE MEAN AND STD IN "params.json" ############
+    if runid is not None:
+        save_params(runid, mean, std)
+    return labels_normalized, mean, std
+
 class NnDataLoader(Dataset):
     ''' Dataset class for the lidar data with images. '''
     
     def __init__(self, csv_path, train_path, runid):
         ''' Constructor of the class. '''
-        labels = pd.read_csv(csv_path)
+        self.index = LabelIndex.from_csv(csv_path)
         self.train_path = train_path
-        self.images = list()
-        self.labels_list = list()
 
         ############ LOAD DATASET ############
-        for idx in range(len(labels)):
-            step = labels.iloc[idx, 0] # step number by the index
-            full_path = os.path.join(self.train_path, 'image'+ str(step) +'.png') 
-
-            ############ PROCESS IMAGE ############
-            image = cv2.imread(full_path, -1)
-            image = cv2.resize(image, (224, 224), interpolation=cv2.INTER_LINEAR)
-            image = image[:, :, 1] # only green channel
-            self.images.append(image)
-
-            ############ PROCESS LABEL ############
-            wq_labels = NnDataLoader.process_label(labels.iloc[idx, 1:])
-            self.labels_list.append(wq_labels) # take step out of labels
-
-        ############ OBTAIN MEAN AND STD FOR NORMALIZATION ############
-        labels_numpy = np.asarray(self.labels_list)
-        self.std = np.std(labels_numpy, axis=0)
-        self.mean = np.mean(labels_numpy, axis=0)
-        
-        ############ SAVE MEAN AND STD IN "params.json" ############
-        new_params = {
-            'id': runid,  # You can set the appropriate id value
-            'mean0': self.mean[0],
-            'mean1': self.mean[1],
-            'mean2': self.mean[2],
-            'mean3': self.mean[3],
-            'std0': self.std[0],
-            'std1': self.std[1],
-            'std2': self.std[2],
-            'std3': self.std[3]
-        }
-
-        if os.getcwd() == 'src':
-            os.chdir('..')
-        filename = './models/params.json'
-
-        with open(filename, 'r') as file:
-            existing_data = json.load(file)
-
-        existing_data.append(new_params)
-        with open(filename, 'w') as file:
-            json.dump(existing_data, file, indent=4)
+        # (N, 224, 224) uint8, decoded and resized by a thread pool (OpenCV releases the GIL), only green channel
+        # fails before decoding anything if an image of the csv is missing
+        start = time.perf_counter()
+        self.images = read_images(self.index.image_paths(self.train_path), progress=True, check=True)
+        print(f'{len(self.images)} images loaded in {time.perf_counter() - start:.1f} s')
+
+        ############ NORMALIZED LABELS, MEAN AND STD ("params.json") ############
+        # all the labels at once (instead of once per __getitem__): (N, 4) (m1, m2, b1, b2) -> (N, 4) (w1, w2, q1, q2)
+        self.labels_normalized, self.mean, self.std = normalize_labels(self.index.values, runid)
 
 
     def __len__(self) -> int:
         ''' Returns the length of the dataset (based on the labels). '''
-        return len(self.labels_list)
+        return len(self.labels_normalized)
 
     def __getitem__(self, idx: int) -> dict:
         ''' Returns the sample image of the dataset. '''
         image = copy.deepcopy(self.images[idx])
-        labels = copy.deepcopy(self.labels_list[idx])
-        
-        labels = PreProcess.standard_extract_label(labels, self.mean, self.std)
+        labels = self.labels_normalized[idx].tolist()
         #image = PreProcess.contours_image(image)  #! visual, bad results 
 
         #? CHECKPOINT!
@@ -151,28 +186,64 @@ class NnDataLoader(Dataset):
 
 
 
+class LazyNnDataLoader(Dataset):
+    ''' Dataset class for the lidar data with images, decoded on demand with a shared LRU cache (low RAM). '''
+
+    def __init__(self, csv_path, train_path, runid, cache_mb=2048, multiprocessing_context=None):
+        ''' Constructor of the class. Only the labels are loaded, the images are decoded by the workers.
+        multiprocessing_context: same start method as the DataLoader (None: default). '''
+        self.index = LabelIndex.from_csv(csv_path)
+        self.paths = self.index.image_paths(train_path)
+
+        ############ NORMALIZED LABELS, MEAN AND STD ("params.json") ############
+        self.labels_normalized, self.mean, self.std = normalize_labels(self.index.values, runid)
+
+        ############ IMAGE CACHE (shared by the DataLoader workers) ############
+        self.cache = SharedLRUCache(len(self.paths), capacity_mb=cache_mb, context=multiprocessing_context)
+        print(f'image cache: {self.cache.capacity} of {len(self.paths)} images ({cache_mb} MB)')
+
+    def __len__(self) -> int:
+        ''' Returns the length of the dataset (based on the labels). '''
+        return len(self.paths)
+
+    def __getitem__(self, idx: int) -> dict:
+        ''' Returns the sample image of the dataset (from the cache or decoded from the png). '''
+        image = self.cache.get(idx)
+        if image is None:
+            image = read_image(self.paths[idx])
+            self.cache.put(idx, image)
+
+        #! suppose m1 = m2
+        w1, w2, q1, q2 = self.labels_normalized[idx].tolist()
+        labels = [w1, q1, q2] # removing w2
+        return {"labels": labels, "image": image, "angle": 0}
+
+    def cache_stats(self):
+        ''' Hit/miss counters of the image cache (all the workers). '''
+        return self.cache.stats()
+
+    def close(self):
+        self.cache.close()
+
+
 class TestNnDataLoader(Dataset):
     ''' Dataset class for the lidar data with images. '''
     
     def __init__(self, csv_path, train_path):
         ''' Constructor of the class. '''
-        self.labels = pd.read_csv(csv_path)
+        self.index = LabelIndex.from_csv(csv_path)
         self.train_path = train_path
 
     def __len__(self) -> int:
         ''' Returns the length of the dataset (based on the labels). '''
         
-        return len(self.labels)
+        return len(self.index)
 
     def __getitem__(self, idx: int) -> dict:
         ''' Returns the sample image of the dataset. '''
 
-        # move from root (\src) to \assets\images
-        if os.getcwd().split(r'/')[-1] == 'src':
-            os.chdir('..') 
-
         # get the step number by the index
-        step = self.labels.iloc[idx, 0]
+        step = self.index.steps[idx]
 
         # full_path = os.path.join(path, 'image'+str(i)+ '_' + str(j) +'.png') # merge path and filename
         full_path = os.path.join(self.train_path, 'image'+ str(step) +'.png') # merge path and filename
@@ -185,7 +256,7 @@ class TestNnDataLoader(Dataset):
         self.image = self.image[:, :, 1] # only green channel
         # to understand the crop, see the image in the assets folder and the lidar_tag.py file
 
-        labels = self.labels.iloc[idx, 1:] # take step out of labels
+        labels = self.index.values[idx] # take step out of labels
 
         # labels = [m1, m2, b1, b2]
         m1, m2, b1, b2 = labels
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Packed dataset cache: all the images of a "train{fid}" folder and the labels of the csv in one ".npz" file.
+    - steps: (N,) int64 step number of each image
+    - images: (N, 224, 224) uint8 (green channel, already resized)
+    - labels: (N, 4) float64 (m1, m2, b1, b2) exactly as in the csv
+Decoding thousands of png files is the slowest part of loading a dataset, with the cache it is done only once:
+    python3 dataset_cache.py ../data/artificial_data/tags/Artificial_Label_Data11.csv ../data/artificial_data/train11
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import numpy as np
+
+from image_io import image_path, read_images
+from label_index import LabelIndex
+
+def default_cache_path(train_path):
+    ''' "data/artificial_data/train11" -> "data/artificial_data/train11.npz" '''
+    return os.path.normpath(train_path) + '.npz'
+
+def read_labels(csv_path):
+    ''' Returns the steps (N,) and the labels (N, 4) of a label csv (step, m1, m2, b1, b2). '''
+    index = LabelIndex.from_csv(csv_path)
+    return index.steps, index.values
+
+def build_cache(csv_path, train_path, cache_path=None, num_workers=None):
+    ''' Decode all the images of the csv and save the cache. Returns the cache path. '''
+    cache_path = cache_path or default_cache_path(train_path)
+    steps, labels = read_labels(csv_path)
+    images = read_images([image_path(train_path, step) for step in steps], num_workers=num_workers)
+    np.savez(cache_path, steps=steps, images=images, labels=labels)
+    print(f'Saved {len(steps)} images to the cache: {cache_path}')
+    return cache_path
+
+def load_cache(cache_path):
+    ''' Returns the steps, images and labels of a cache. '''
+    with np.load(cache_path) as cache:
+        return cache['steps'], cache['images'], cache['labels']
+
+if __name__ == '__main__':
+    build_cache(sys.argv[1], sys.argv[2], cache_path=sys.argv[3] if len(sys.argv) > 3 else None)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Knowledge distillation: a small student (e.g. tiny_cnn at 112x112) learns from the labels and from the outputs of a
+trained teacher ("model_{runid}.pth", mobilenet_v2 by default), for the latency budget of the robot CPU.
+    loss = alpha * L1(student, labels) + (1 - alpha) * L1(student, teacher)
+The teacher outputs are soft targets without label noise, and they are also defined for the hard samples where the
+labels alone are not enough for a small network. The teacher is frozen and runs under torch.no_grad().
+
+The teacher was normalized with the mean and std of its own training, the student with the ones of the new dataset,
+so the teacher outputs are converted to the student normalization (TeacherOutputs).
+
+    teacher = load_teacher(teacher_runid, val_cache.mean, val_cache.std, device)
+    results = train_model(student, ..., teacher=teacher, alpha=0.5)
+    compare_models({'teacher': teacher, 'student': student}, val_cache)
+
+The images stay at 224 (the size of the teacher training), the student reduces them itself (ResizeInput).
+
+@author: Felipe-Tommaselli
+"""
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from dataloader import load_params_entry
+from model_factory import load_model, model_info, model_file, count_params, measure_latency, INPUT_SIZE
+
+OUTPUT_COLUMNS = {3: [0, 2, 3], 4: [0, 1, 2, 3]} # (w1, q1, q2), we suppose m1 = m2
+
+class TeacherOutputs(nn.Module):
+    ''' Frozen teacher, outputs converted from the teacher normalization to the student normalization. '''
+
+    def __init__(self, model, teacher_mean, teacher_std, mean, std):
+        super().__init__()
+        self.model = model.eval()
+        for param in self.model.parameters():
+            param.requires_grad_(False)
+        # y_student = (y_teacher * std_teacher + mean_teacher - mean_student) / std_student
+        scale = np.asarray(teacher_std, dtype=np.float64) / np.asarray(std, dtype=np.float64)
+        shift = (np.asarray(teacher_mean, dtype=np.float64) - np.asarray(mean, dtype=np.float64)) / \
+                np.asarray(std, dtype=np.float64)
+        self.register_buffer('scale', torch.as_tensor(scale, dtype=torch.float32))
+        self.register_buffer('shift', torch.as_tensor(shift, dtype=torch.float32))
+        self.eval()
+
+    def train(self, mode=True):
+        # always in evaluation mode (BatchNorm statistics of the teacher)
+        return super().train(False)
+
+    def forward(self, x):
+        with torch.no_grad():
+            outputs = self.model(x)
+            columns = OUTPUT_COLUMNS[outputs.shape[1]]
+            return outputs * self.scale[columns] + self.shift[columns]
+
+def load_teacher(runid, mean, std, device, models_dir='./models'):
+    ''' Teacher "model_{runid}.pth" (backbone and input size of its "params.json" entry) for the student mean/std. '''
+    entry = load_params_entry(runid, f'{models_dir}/params.json')
+    backbone, input_size = model_info(entry)
+    model = load_model(model_file(models_dir, runid), backbone, input_size=input_size)
+    teacher_mean = [entry['mean' + str(i)] for i in range(4)]
+    teacher_std = [entry['std' + str(i)] for i in range(4)]
+    print(f'Teacher: {runid} ({backbone}, {input_size}x{input_size})')
+    return TeacherOutputs(model, teacher_mean, teacher_std, mean, std).to(device)
+
+def distillation_loss(criterion, outputs, labels, teacher_outputs, alpha):
+    ''' alpha * criterion(outputs, labels) + (1 - alpha) * criterion(outputs, teacher outputs). '''
+    return alpha * criterion(outputs, labels) + (1 - alpha) * criterion(outputs, teacher_outputs)
+
+def compare_models(models, val_cache, batch_size=64, repeat=20):
+    ''' Accuracy (metrics of the cached validation split) and CPU latency of each model (dict name -> model).
+    The latency is measured with 224x224 inputs, the resize of the smaller students is included. '''
+    criterion = nn.L1Loss()
+    rows = []
+    for name, model in models.items():
+        loss, metrics = val_cache.evaluate(model, criterion)
+        model_cpu = model.to('cpu')
+        latency1, _ = measure_latency(model_cpu, 1, INPUT_SIZE, repeat=repeat)
+        latency_n, _ = measure_latency(model_cpu, batch_size, INPUT_SIZE, repeat=max(3, repeat // 4))
+        model.to(val_cache.device)
+        rows.append({'model': name, 'params': count_params(model), 'val_loss': loss, **metrics,
+                     'latency_b1_ms': latency1, f'latency_b{batch_size}_ms': latency_n})
+
+    reference = rows[0]['latency_b1_ms']
+    print(f"{'model':<12}{'params (M)':>12}{'val L1':>10}{'icpt err (px)':>15}{'angle err':>11}{'b1 (ms)':>10}"
+          f"{f'b{batch_size} (ms)':>12}{'speedup':>9}")
+    for r in rows:
+        intercept = (r['intercept_err1'] + r['intercept_err2']) / 2
+        print(f"{r['model']:<12}{r['params'] / 1e6:>12.2f}{r['val_loss']:>10.4f}{intercept:>15.2f}"
+              f"{r['angle_err1']:>11.2f}{r['latency_b1_ms']:>10.2f}{r[f'latency_b{batch_size}_ms']:>12.1f}"
+              f"{reference / r['latency_b1_ms']:>8.1f}x")
+    return rows
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+evaluate.py: runs a trained model ("model_{runid}.pth") over an entire dataset and compares it with the label csv.
+The dataset can be the png folder ("train{fid}") or the packed cache ("train{fid}.npz", see "dataset_cache.py").
+    - the images are decoded by a thread pool, one batch ahead of the model (png folder)
+    - the model runs in large batches under torch.inference_mode()
+    - metrics per sample and aggregated (see "metrics.py"): L1 on w/q, angle error and intercept error in pixels
+    - the predicted lines (m1, m2, b1, b2) of every image, deprocessed in one vectorized call
+
+    python3 evaluate.py --runid 02-02-2024_00-45-55 --csv data/artificial_data/tags/Artificial_Label_Data11.csv \
+        --images data/artificial_data/train11
+    python3 evaluate.py --runid 02-02-2024_00-45-55 --cache data/artificial_data/train11.npz
+
+The per sample table is saved in "analytics/eval_{runid}_{name}.csv" and the aggregate in
+"analytics/eval_{runid}_{name}.json", name: the png folder ("train11") or the cache file ("train11.npz").
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+from dataloader import *
+from dataset_cache import read_labels, load_cache
+from image_io import image_path, read_images
+from metrics import line_errors, summarize_errors
+from model_factory import load_model, model_info, model_file
+
+def iter_png_batches(paths, batch_size, num_workers=None):
+    ''' Yields (start, images) batches, decoding the next batch while the current one is used. '''
+    starts = list(range(0, len(paths), batch_size))
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        future = prefetch.submit(read_images, paths[0:batch_size], num_workers=num_workers) if starts else None
+        for k, start in enumerate(starts):
+            images = future.result()
+            if k + 1 < len(starts):
+                nxt = starts[k + 1]
+                future = prefetch.submit(read_images, paths[nxt:nxt + batch_size], num_workers=num_workers)
+            yield start, images
+
+def iter_array_batches(images, batch_size):
+    for start in range(0, len(images), batch_size):
+        yield start, images[start:start + batch_size]
+
+def predict(model, batches, num_samples, device):
+    ''' Run the model over all the batches, returns the (N, outputs) normalized predictions. '''
+    outputs = None
+    model.eval()
+    with torch.inference_mode():
+        for start, images in batches:
+            tensor = torch.from_numpy(np.ascontiguousarray(images)).to(device)
+            tensor = tensor.unsqueeze(1).float()
+            prediction = model(tensor).cpu().numpy()
+            if outputs is None:
+                outputs = np.empty((num_samples, prediction.shape[1]), dtype=np.float32)
+            outputs[start:start + len(prediction)] = prediction
+    return outputs
+
+def evaluate(model, steps, labels, batches, mean, std, device):
+    ''' Returns the per sample table (DataFrame) and the aggregate metrics (dict). '''
+    # labels as the network sees them: (m1, m2, b1, b2) csv -> (w1, w2, q1, q2)
+    labels_wq = np.stack(NnDataLoader.process_label(np.asarray(labels).T), axis=1)
+
+    outputs = predict(model, batches, len(steps), device)
+    errors = line_errors(outputs, labels_wq, mean, std)
+
+    table = pd.DataFrame({'step': steps})
+    for i in range(outputs.shape[1]):
+        table[f'output{i}'] = outputs[:, i]
+    # predicted lines (m1, m2, b1, b2) in the csv convention (matplotlib y axis, see NnDataLoader.process_label)
+    lines = PreProcess.standard_deprocess_batch(outputs, mean, std)
+    for i, name in enumerate(['m1', 'm2', 'b1', 'b2']):
+        table['pred_' + name] = -lines[:, i] if i < 2 else 224 - lines[:, i]
+    for name, values in errors.items():
+        table[name] = values
+    return table, summarize_errors(errors)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate a trained model over an entire dataset.')
+    parser.add_argument('--runid', required=True, help='model_{runid}.pth and params.json entry')
+    parser.add_argument('--csv', default=None, help='label csv (png folder mode)')
+    parser.add_argument('--images', default=None, help='png folder "train{fid}"')
+    parser.add_argument('--cache', default=None, help='packed cache "train{fid}.npz" (instead of --csv/--images)')
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--workers', type=int, default=None, help='decoding threads (default: all cores)')
+    parser.add_argument('--output', default=os.path.join(os.getcwd(), 'analytics'))
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print('Using {} device'.format(device))
+
+    ############ MODEL ############
+    backbone, input_size = model_info(load_params_entry(args.runid))
+    path = model_file(os.getcwd() + '/models', args.runid) # .pth or TorchScript .pt
+    model = load_model(path, backbone, input_size=input_size).to(device)
+    mean, std = load_params(args.runid)
+
+    ############ DATA ############
+    if args.cache is not None:
+        steps, images, labels = load_cache(args.cache)
+        batches = iter_array_batches(images, args.batch_size)
+        name = os.path.basename(args.cache)
+    elif args.csv is not None and args.images is not None:
+        steps, labels = read_labels(args.csv)
+        paths = [image_path(args.images, step) for step in steps]
+        batches = iter_png_batches(paths, args.batch_size, num_workers=args.workers)
+        name = os.path.basename(os.path.normpath(args.images))
+    else:
+        sys.exit('Give --cache or both --csv and --images')
+
+    ############ EVALUATION ############
+    start = time.perf_counter()
+    table, summary = evaluate(model, steps, labels, batches, mean, std, device)
+    elapsed = time.perf_counter() - start
+
+    print(f'{len(table)} images in {elapsed:.2f} s ({len(table) / elapsed:.1f} images/s)')
+    print(f"{'metric':<18}{'mean':>10}{'median':>10}{'p95':>10}")
+    for metric, values in summary.items():
+        print(f"{metric:<18}{values['mean']:>10.4f}{values['median']:>10.4f}{values['p95']:>10.4f}")
+
+    ############ SAVE ############
+    os.makedirs(args.output, exist_ok=True)
+    table_path = os.path.join(args.output, f'eval_{args.runid}_{name}.csv')
+    table.to_csv(table_path, index=False)
+    with open(os.path.join(args.output, f'eval_{args.runid}_{name}.json'), 'w') as file:
+        json.dump({'id': args.runid, 'dataset': name, 'samples': len(table), 'seconds': elapsed,
+                   'metrics': summary}, file, indent=4)
+    print(f'Saved the results table to:\n{table_path}')
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LRU cache of decoded images in shared memory, shared by all the DataLoader workers.
+Every worker decodes the pngs it needs ("image_io.py") and puts them in the cache, the next epochs read the decoded
+(224, 224) array from the cache instead of decoding the png again. The memory is bounded:
+    - capacity in MB -> number of slots (one preprocessed image per slot)
+    - when the cache is full, the least recently used slot is replaced
+All the state lives in two multiprocessing.shared_memory blocks, so the cache pickles by name (only the names and the
+lock are sent to the workers, with fork or spawn):
+    - slots: (capacity, 224, 224) uint8 images
+    - tables: slot of each dataset index, index of each slot, last use "tick" of each slot, counters
+A multiprocessing.Lock protects the tables. hits/misses count the lookups of all the processes.
+
+    cache = SharedLRUCache(num_items=len(dataset), capacity_mb=2048)
+    image = cache.get(idx)
+    if image is None:
+        image = read_image(path)
+        cache.put(idx, image)
+    print(cache.stats())
+
+@author: Felipe-Tommaselli
+"""
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+IMAGE_SHAPE = (224, 224)
+
+# counters in the tables block
+CLOCK, HITS, MISSES, USED = range(4)
+NUM_COUNTERS = 4
+
+
+class SharedLRUCache:
+    ''' Bounded LRU cache of (224, 224) uint8 images in shared memory, indexed by the dataset index. '''
+
+    def __init__(self, num_items, capacity_mb=1024, image_shape=IMAGE_SHAPE, context=None):
+        ''' Constructor of the class (the creator owns and unlinks the shared memory).
+        context: multiprocessing start method of the DataLoader workers ('fork', 'spawn', None: default). '''
+        self.num_items = int(num_items)
+        self.image_shape = tuple(image_shape)
+        image_bytes = int(np.prod(self.image_shape))
+        # no more slots than items: a cache bigger than the dataset keeps everything
+        self.capacity = int(max(1, min(self.num_items, capacity_mb * 2**20 // image_bytes)))
+
+        self._slots_shm = shared_memory.SharedMemory(create=True, size=self.capacity * image_bytes)
+        self._tables_shm = shared_memory.SharedMemory(create=True, size=self._tables_size() * 8)
+        self.lock = mp.get_context(context).Lock()
+        self.owner = True
+        self._map()
+
+        self._slot_of[:] = -1
+        self._index_of[:] = -1
+        self._ticks[:] = 0
+        self._counters[:] = 0
+
+    def _tables_size(self):
+        return self.num_items + 2 * self.capacity + NUM_COUNTERS
+
+    def _map(self):
+        ''' Numpy views of the shared memory blocks. '''
+        self._images = np.ndarray((self.capacity,) + self.image_shape, dtype=np.uint8, buffer=self._slots_shm.buf)
+        tables = np.ndarray((self._tables_size(),), dtype=np.int64, buffer=self._tables_shm.buf)
+        self._slot_of = tables[:self.num_items] # dataset index -> slot (-1: not cached)
+        self._index_of = tables[self.num_items:self.num_items + self.capacity] # slot -> dataset index (-1: free)
+        self._ticks = tables[self.num_items + self.capacity:self.num_items + 2 * self.capacity] # slot -> last use
+        self._counters = tables[self.num_items + 2 * self.capacity:]
+
+    ############ PICKLE (DataLoader workers) ############
+
+    def __getstate__(self):
+        return {'num_items': self.num_items, 'image_shape': self.image_shape, 'capacity': self.capacity,
+                'slots': self._slots_shm.name, 'tables': self._tables_shm.name, 'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.num_items = state['num_items']
+        self.image_shape = state['image_shape']
+        self.capacity = state['capacity']
+        self.lock = state['lock']
+        self.owner = False
+        # the workers share the resource tracker of the main process, which unlinks the blocks if it dies
+        self._slots_shm = shared_memory.SharedMemory(name=state['slots'])
+        self._tables_shm = shared_memory.SharedMemory(name=state['tables'])
+        self._map()
+
+    ############ CACHE ############
+
+    def get(self, idx):
+        ''' Copy of the cached image of the dataset index, None on a miss. '''
+        with self.lock:
+            slot = self._slot_of[idx]
+            if slot < 0:
+                self._counters[MISSES] += 1
+                return None
+            self._counters[CLOCK] += 1
+            self._ticks[slot] = self._counters[CLOCK]
+            self._counters[HITS] += 1
+            return self._images[slot].copy()
+
+    def put(self, idx, image):
+        ''' Store the image of the dataset index, replacing the least recently used slot when full. '''
+        with self.lock:
+            if self._slot_of[idx] >= 0:
+                return # already stored by another worker
+            # free slots have tick 0, so they are used before any eviction
+            slot = int(np.argmin(self._ticks))
+            old = self._index_of[slot]
+            if old >= 0:
+                self._slot_of[old] = -1
+            else:
+                self._counters[USED] += 1
+            self._images[slot] = image
+            self._index_of[slot] = idx
+            self._slot_of[idx] = slot
+            self._counters[CLOCK] += 1
+            self._ticks[slot] = self._counters[CLOCK]
+
+    def __contains__(self, idx):
+        return self._slot_of[idx] >= 0
+
+    def stats(self):
+        ''' Hit/miss counters of all the processes and the cache occupation. '''
+        with self.lock:
+            hits, misses, used = (int(self._counters[k]) for k in (HITS, MISSES, USED))
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / lookups if lookups else 0.0,
+                'used': used, 'capacity': self.capacity,
+                'capacity_mb': self.capacity * int(np.prod(self.image_shape)) / 2**20}
+
+    def reset_stats(self):
+        with self.lock:
+            self._counters[HITS] = 0
+            self._counters[MISSES] = 0
+
+    def close(self):
+        ''' Release the views and the shared memory (unlinked by the owner). '''
+        self._images = self._slot_of = self._index_of = self._ticks = self._counters = None
+        for shm in (self._slots_shm, self._tables_shm):
+            shm.close()
+            if self.owner:
+                shm.unlink()
+        self.owner = False
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Image decoding shared by the datasets and the evaluation.
+Each png is read with OpenCV, resized to 224x224 and only the green channel is kept (same as "dataloader.py").
+OpenCV releases the GIL while decoding and resizing, so a thread pool decodes several images in parallel.
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_SIZE = 224 #px
+
+def image_path(train_path, step):
+    ''' Path of the image of a step: "{train_path}/image{step}.png". '''
+    return os.path.join(train_path, 'image' + str(step) + '.png')
+
+def read_image(path, size=IMAGE_SIZE, out=None):
+    ''' Read one png as a (size, size) uint8 array (green channel). '''
+    image = cv2.imread(path, -1)
+    if image is None:
+        raise FileNotFoundError(f'Could not read the image: {path}')
+    image = cv2.resize(image, (size, size), interpolation=cv2.INTER_LINEAR)
+    image = image[:, :, 1] # only green channel
+    if out is None:
+        return np.ascontiguousarray(image)
+    out[...] = image
+    return out
+
+def missing_paths(paths):
+    ''' Paths of the list that do not exist. '''
+    return [path for path in paths if not os.path.isfile(path)]
+
+def check_paths(paths):
+    ''' Fail fast (before decoding anything) if some image is missing. '''
+    missing = missing_paths(paths)
+    if missing:
+        raise FileNotFoundError(f'{len(missing)} of {len(paths)} images not found, e.g.: {missing[:5]}')
+
+def read_images(paths, size=IMAGE_SIZE, num_workers=None, out=None, progress=False, check=False):
+    ''' Read a list of pngs in parallel into a (N, size, size) uint8 array.
+    progress: print the number of decoded images, check: check that all the files exist before decoding. '''
+    if check:
+        check_paths(paths)
+    if out is None:
+        out = np.empty((len(paths), size, size), dtype=np.uint8)
+    num_workers = num_workers or os.cpu_count()
+    total = len(paths)
+    report = max(256, total // 100) # print every 1% (at most)
+
+    def work(i):
+        read_image(paths[i], size=size, out=out[i])
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        # map() yields in order and raises the first exception
+        for done, _ in enumerate(executor.map(work, range(total)), 1):
+            if progress and (done % report == 0 or done == total):
+                print(f'\rdecoding images: {done}/{total} ({100 * done // total}%)', end='', flush=True)
+    except BaseException:
+        # stop the pending decodes instead of waiting for the whole dataset
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    if progress:
+        print()
+    return out
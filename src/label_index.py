@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Label index of an "Artificial_Label_Data{fid}.csv" (header "step, m1, m2, b1, b2", blank lines are ignored).
+The csv is parsed once into a structured NumPy array and validated:
+    - at least one label, 5 numeric columns
+    - finite m1, m2, b1, b2
+    - unique steps
+The lookups are vectorized (a step or an array of steps, an index or an array of indices), instead of a pandas
+iloc per row. The parsed array is cached next to the csv ("Artificial_Label_Data{fid}.csv.npz"), together with the
+size and modification time of the csv, so the next runs skip the parsing while the csv is unchanged:
+    python3 label_index.py ../data/artificial_data/tags/Artificial_Label_Data11.csv
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import numpy as np
+
+from image_io import image_path
+
+LABEL_DTYPE = np.dtype([('step', np.int64), ('m1', np.float64), ('m2', np.float64),
+                        ('b1', np.float64), ('b2', np.float64)])
+LABEL_NAMES = ['m1', 'm2', 'b1', 'b2']
+CACHE_VERSION = 1
+
+def default_index_path(csv_path):
+    ''' "tags/Artificial_Label_Data11.csv" -> "tags/Artificial_Label_Data11.csv.npz" '''
+    return csv_path + '.npz'
+
+def csv_signature(csv_path):
+    ''' (version, size, mtime in ns) of the csv, saved with the cache to detect a changed csv. '''
+    stat = os.stat(csv_path)
+    return np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def parse_labels(csv_path):
+    ''' Parse the csv into a (N,) LABEL_DTYPE array. Raises ValueError if the csv is not valid. '''
+    try:
+        labels = np.loadtxt(csv_path, delimiter=',', skiprows=1, dtype=LABEL_DTYPE, ndmin=1)
+    except ValueError as e:
+        raise ValueError(f'Invalid label csv {csv_path}: {e}') from e
+    validate_labels(labels, csv_path)
+    return labels
+
+def validate_labels(labels, source='labels'):
+    ''' Raises ValueError for an empty array, non finite labels or repeated steps. '''
+    if len(labels) == 0:
+        raise ValueError(f'{source}: no labels')
+    values = np.stack([labels[name] for name in LABEL_NAMES], axis=1)
+    bad = ~np.all(np.isfinite(values), axis=1)
+    if np.any(bad):
+        raise ValueError(f'{source}: non finite labels at the steps {labels["step"][bad][:10].tolist()}')
+    steps, counts = np.unique(labels['step'], return_counts=True)
+    if np.any(counts > 1):
+        raise ValueError(f'{source}: repeated steps {steps[counts > 1][:10].tolist()}')
+
+
+class LabelIndex:
+    ''' Parsed labels of a csv: steps (N,) int64 and values (N, 4) float64 (m1, m2, b1, b2) in the csv order. '''
+
+    def __init__(self, labels):
+        ''' Constructor of the class. labels: (N,) LABEL_DTYPE array (already validated). '''
+        self.labels = labels
+        self.steps = np.ascontiguousarray(labels['step'])
+        self.values = np.stack([labels[name] for name in LABEL_NAMES], axis=1)
+        # sorted steps -> position, for the lookups by step
+        self._order = np.argsort(self.steps, kind='stable')
+        self._sorted_steps = self.steps[self._order]
+
+    @classmethod
+    def from_csv(cls, csv_path, cache=True):
+        ''' Load the cached index if the csv did not change, otherwise parse the csv (and save the cache). '''
+        index_path = default_index_path(csv_path)
+        signature = csv_signature(csv_path)
+        if cache and os.path.exists(index_path):
+            try:
+                with np.load(index_path) as cached:
+                    if np.array_equal(cached['signature'], signature):
+                        return cls(cached['labels'])
+            except (OSError, KeyError, ValueError) as e:
+                print(f'Ignoring the invalid label cache {index_path}: {e}')
+
+        labels = parse_labels(csv_path)
+        if cache:
+            try:
+                # np.savez adds ".npz" to the name, write through the file object to keep the name
+                with open(index_path, 'wb') as file:
+                    np.savez(file, labels=labels, signature=signature)
+            except OSError as e:
+                print(f'Could not save the label cache {index_path}: {e}')
+        return cls(labels)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def positions(self, steps):
+        ''' Index (position in the csv) of each step. Raises KeyError for unknown steps. '''
+        steps = np.asarray(steps, dtype=np.int64)
+        found = np.searchsorted(self._sorted_steps, steps)
+        found = np.minimum(found, len(self._sorted_steps) - 1)
+        missing = self._sorted_steps[found] != steps
+        if np.any(missing):
+            raise KeyError(f'Unknown steps: {np.atleast_1d(steps[missing])[:10].tolist()}')
+        return self._order[found]
+
+    def by_step(self, steps):
+        ''' (m1, m2, b1, b2) of a step (4,) or of an array of steps (k, 4). '''
+        return self.values[self.positions(steps)]
+
+    def image_paths(self, train_path, idx=None):
+        ''' Image path of each label (or of the indices idx), see image_io.image_path. '''
+        steps = self.steps if idx is None else np.atleast_1d(self.steps[idx])
+        return [image_path(train_path, step) for step in steps]
+
+if __name__ == '__main__':
+    for csv_path in sys.argv[1:]:
+        index = LabelIndex.from_csv(csv_path)
+        print(f'{csv_path}: {len(index)} labels, steps {index.steps.min()}-{index.steps.max()} '
+              f'-> {default_index_path(csv_path)}')
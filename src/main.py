@@ -2,7 +2,12 @@
 # -*- coding: utf-8 -*-
 """
 main.py: runs the neural network inference and generate the model based on the "runid" from the date and time. 
-model: mobilenet v2
+model: mobilenet v2 by default, see "model_factory.py" for the other backbones
+distillation: with "distill_from" (teacher runid) a smaller student is trained, see "distillation.py"
+raw scans: with "scans" (scans csv or npz) a scan model is trained on the LaserScan ranges, see "scan_dataset.py"
+shards: with "shards" (shard folder) the dataset is streamed from the disk (bigger than the RAM), see "shards.py"
+scan images: with "scan_images" (scans csv or npz) the images are rendered and augmented, see "scan_augment.py"
+segments: with "segments" (segments folder) the dataset grows by appended segments, see "segments.py"
 dataloader: see "dataloader.py" and "test_dataloader.py" for further information 
 
 @author: Felipe-Tommaselli
@@ -18,19 +23,63 @@ from datetime import datetime
 import torch.nn as nn
 from torchvision import datasets
 import torchvision.models as models
-from efficientnet_pytorch import EfficientNet
 
 torch.cuda.empty_cache()
 
 from dataloader import *
 from pre_process import *
+from data_split import load_split
+from label_index import LabelIndex
+from validation import CachedValidation
+from model_factory import build_model, NUM_BEAMS, INPUT_SIZE
+from scan_dataset import ScanDataset
+from packed_dataset import PackedDataset
+from point_dataset import PointListDataset
+from shards import ShardedIterableDataset
+from segments import SegmentDataset
+from scan_augment import ScanImageDataset, ScanAugment
+from distillation import load_teacher, distillation_loss, compare_models
 
+############ DEVICE ############
+# Set the device to GPU if available
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-def getData(csv_path, train_path, batch_size, runid, num_workers=0):
-    ''' get images from the folder "data" and return a DataLoader object '''
+
+def getData(csv_path, train_path, batch_size, runid, num_workers=0, lazy=False, cache_mb=2048, seed=0, fold=None,
+            cached_val=False, scans_path=None, packed_levels=None, points_path=None, input_size=224, shards_path=None,
+            segments_path=None, scan_images_path=None, augment=True):
+    ''' get images from the folder "data" and return a DataLoader object 
+    lazy: decode the images on demand with a shared LRU cache of cache_mb MB (LazyNnDataLoader)
+    seed, fold: split of "data_split.py" (fold=None: 70/30 split, fold=k: k-th of 5 folds)
+    cached_val: the validation split is a CachedValidation on the device instead of a DataLoader
+    scans_path: raw scans (csv or npz) of the labels instead of the images of train_path (ScanDataset)
+    packed_levels: 2 (binary) or 4/16 gray levels, the images are kept bit-packed in RAM (PackedDataset)
+    points_path: point list of the generator, rendered at input_size x input_size per batch (PointListDataset)
+    shards_path: shard folder of the same csv, streamed by the workers (ShardedIterableDataset)
+    segments_path: segmented dataset, all the segments of the manifest (SegmentDataset, csv_path is not used)
+    scan_images_path: scans (csv or npz) of the labels, rendered at input_size per batch (ScanImageDataset)
+    augment: scan-space augmentation of the training batches of scan_images_path (ScanAugment.default) '''
+    if shards_path is not None:
+        return getShardedData(csv_path, shards_path, batch_size, runid, num_workers, seed, fold, cached_val)
     
     ############ CREATE DATASET OBJECT ############
-    dataset = NnDataLoader(csv_path, train_path, runid)
+    if scans_path is not None:
+        dataset = ScanDataset(csv_path, scans_path, runid)
+        train_path = scans_path # the split is saved next to the scans
+    elif segments_path is not None:
+        dataset = SegmentDataset(segments_path, runid)
+    elif scan_images_path is not None:
+        scan_augment = ScanAugment.default() if augment else None
+        dataset = ScanImageDataset(csv_path, scan_images_path, runid, augment=scan_augment, size=input_size)
+        train_path = scan_images_path # the split is saved next to the scans
+    elif points_path is not None:
+        dataset = PointListDataset(csv_path, points_path, runid, size=input_size)
+    elif packed_levels is not None:
+        dataset = PackedDataset(csv_path, train_path, runid, levels=packed_levels)
+    elif lazy:
+        dataset = LazyNnDataLoader(csv_path, train_path, runid, cache_mb=cache_mb)
+    else:
+        dataset = NnDataLoader(csv_path, train_path, runid)
 
     ############ DATA AUGMENTATION ############
     #! artificial não se beneficia muito disso
@@ -40,30 +89,68 @@ def getData(csv_path, train_path, batch_size, runid, num_workers=0):
     #print(f'dataset size (w/ augmentation): {len(dataset)}')
 
     ############ DATASET SPLIT (TRAIN & VAL) ############
-    train_size, val_size = int(0.7*len(dataset)), np.ceil(0.3*len(dataset)).astype('int')
-    train_dataset, val_dataset = torch.utils.data.random_split(dataset, [train_size, val_size])
+    # stratified by angle and divider, seeded and saved next to the dataset (same val samples in every run)
+    if segments_path is not None:
+        # split per segment: the appended segments do not change the split of the previous ones
+        train_idx, val_idx = dataset.split(val_fraction=0.3, seed=seed, fold=fold)
+    else:
+        train_idx, val_idx = load_split(csv_path, train_path, val_fraction=0.3, seed=seed, fold=fold)
+    train_size, val_size = len(train_idx), len(val_idx)
+    # the validation split is never augmented
+    val_source = dataset.plain() if hasattr(dataset, 'plain') else dataset
+    train_dataset, val_dataset = Subset(dataset, train_idx), Subset(val_source, val_idx)
     
     ############ DATASET DEFINITION ############
-    train_data = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
-    val_data  = DataLoader(val_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    # packed: the batch is fetched packed and unpacked at once by the collate (in the workers)
+    collate_fn = getattr(dataset, 'collate', None) # None: default collate
+    train_data = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                            collate_fn=collate_fn)
+    if cached_val:
+        val_data = CachedValidation.from_dataset(val_source, val_idx, device)
+    else:
+        val_data  = DataLoader(val_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                               collate_fn=collate_fn)
 
     print(f'train size: {train_size}, val size: {val_size}')
     _ = input('----------------- Press Enter to continue -----------------')
     return train_data, val_data
 
+def getShardedData(csv_path, shards_path, batch_size, runid, num_workers=0, seed=0, fold=None, cached_val=False):
+    ''' Train and val DataLoaders streaming the shards (the same split of "data_split.py", selected by the steps).
+    The shuffle is done by the dataset (shard order and shuffle buffer), not by the DataLoader. '''
+    index = LabelIndex.from_csv(csv_path)
+    train_idx, val_idx = load_split(csv_path, shards_path, val_fraction=0.3, seed=seed, fold=fold)
+    train_dataset = ShardedIterableDataset(shards_path, runid, steps=index.steps[train_idx], seed=seed)
+    train_data = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers)
+    val_dataset = ShardedIterableDataset(shards_path, None, steps=index.steps[val_idx], shuffle_buffer=0)
+    if cached_val:
+        images, labels = val_dataset.materialize()
+        val_data = CachedValidation(images, labels, val_dataset.mean, val_dataset.std, device)
+    else:
+        val_data = DataLoader(val_dataset, batch_size=batch_size, num_workers=num_workers)
+
+    print(f'train size: {len(train_idx)}, val size: {len(val_idx)}')
+    _ = input('----------------- Press Enter to continue -----------------')
+    return train_data, val_data
+
 
-def train_model(model, criterion, optimizer, scheduler, train_loader, val_loader, num_epochs):
+def train_model(model, criterion, optimizer, scheduler, train_loader, val_loader, num_epochs, teacher=None, alpha=0.5):
     ''' Train model function: train (if) and validate (else):
     Forward pass predicts outputs; backward pass adjusts parameters; training optimizes parameters for minimizing loss, 
     while validation assesses model performance on unseen data.
     - Feed forward pass: Input data is passed through the neural network to produce a prediction. 
     - Backward pass: Prediction errors are propagated back through the network to adjust the weights, optimizing the 
     model's performance during training and validating.
+    - Distillation (teacher): the training loss is alpha * loss(labels) + (1 - alpha) * loss(teacher outputs), the
+    validation loss is always the loss on the labels.
     '''
     train_losses = []
     val_losses = []
+    val_metrics = [] # only with the CachedValidation
 
     for epoch in range(num_epochs):
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch) # shards: new shard order and shuffle
         model.train()
         running_loss = 0.0
         ############ TRAINING ############
@@ -72,7 +159,7 @@ def train_model(model, criterion, optimizer, scheduler, train_loader, val_loader
             images, labels = data['image'], data['labels']
             # image dimension: (batch, channels, height, width)
             images = images.type(torch.float32).to(device)
-            images = images.unsqueeze(1)
+            images = images.unsqueeze(1) # scans: (batch, 1, beams)
             # convert to format: tensor([[value1, value2, value3, value4], ...])
             # this is: labels for each image, "batch" times -> shape: (batch, 4)
             labels = [label.type(torch.float32).to(device) for label in labels]
@@ -80,7 +167,10 @@ def train_model(model, criterion, optimizer, scheduler, train_loader, val_loader
             labels = labels.permute(1, 0) 
             ############ MODEL TRAINING ############
             outputs = model(images)
-            loss = criterion(outputs, labels) 
+            if teacher is None:
+                loss = criterion(outputs, labels) 
+            else:
+                loss = distillation_loss(criterion, outputs, labels, teacher(images), alpha)
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
@@ -88,27 +178,38 @@ def train_model(model, criterion, optimizer, scheduler, train_loader, val_loader
             running_loss += loss.item()
         else:
         ############ VALIDATING ############
-            with torch.no_grad():                
-                model.eval() # evaluation mode
-                val_loss = 0
-                for i, data in enumerate(val_loader):
-                    ############ FORMAT CONVERT ############
-                    images, labels = data['image'], data['labels']
-                    images = images.type(torch.float32).to(device)
-                    images = images.unsqueeze(1)
-                    labels = [label.type(torch.float32).to(device) for label in labels]
-                    labels = torch.stack(labels)
-                    labels = labels.permute(1, 0)
-                    outputs = model.forward(images)
-                    val_loss += criterion(outputs, labels).item()
-                    #TODO: calculate MSE
-                val_losses.append(val_loss/len(val_loader))
+            if isinstance(val_loader, CachedValidation):
+                # one pass over the device tensors in large chunks (loss and metrics)
+                val_loss, metrics = val_loader.evaluate(model, criterion)
+                val_losses.append(val_loss)
+                val_metrics.append(metrics)
+            else:
+                with torch.no_grad():                
+                    model.eval() # evaluation mode
+                    val_loss = 0
+                    for i, data in enumerate(val_loader):
+                        ############ FORMAT CONVERT ############
+                        images, labels = data['image'], data['labels']
+                        images = images.type(torch.float32).to(device)
+                        images = images.unsqueeze(1)
+                        labels = [label.type(torch.float32).to(device) for label in labels]
+                        labels = torch.stack(labels)
+                        labels = labels.permute(1, 0)
+                        outputs = model.forward(images)
+                        val_loss += criterion(outputs, labels).item()
+                        #TODO: calculate MSE
+                    val_losses.append(val_loss/len(val_loader))
             pass
         scheduler.step()
         train_losses.append(running_loss/len(train_loader))
         print(f'[{epoch+1}/{num_epochs}] .. Train Loss: {train_losses[-1]:.5f} .. val Loss: {val_losses[-1]:.5f}')
+        if val_metrics:
+            metrics = val_metrics[-1]
+            l1 = ' '.join(f'{name[3:]}={value:.4f}' for name, value in metrics.items() if name.startswith('l1_'))
+            print(f'        L1: {l1} .. intercept err: {metrics["intercept_err1"]:.2f}/{metrics["intercept_err2"]:.2f} px'
+                  f' .. angle err: {metrics["angle_err1"]:.2f} deg')
 
-    results = {'train_losses': train_losses, 'val_losses': val_losses,}
+    results = {'train_losses': train_losses, 'val_losses': val_losses, 'val_metrics': val_metrics}
     return results
 
 def plotResults(results, epochs, lr, runid):
@@ -127,9 +228,6 @@ def plotResults(results, epochs, lr, runid):
 
 if __name__ == '__main__':
     ############ START ############
-    # Set the device to GPU if available
-    global device
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print('Using {} device'.format(device))
 
     ############ RUN ID ############
@@ -143,24 +241,49 @@ if __name__ == '__main__':
     gamma = 0.4
     batch_size = 140 # 140 AWS
     weight_decay = 0 # L2 regularization
+    lazy = False # True for datasets larger than the RAM: images decoded by the workers with a shared LRU cache
+    packed_levels = None # 2: binary images bit-packed in RAM (8x less than uint8), 4/16: gray levels (anti-aliasing)
+    points = None # point list of the generator (e.g. 'data/artificial_data/train12.points.npz'), rendered at input_size
+    scan_images = None # scans csv/npz of the labels (e.g. 'datasets/gazebo/Crop_Data5.csv'): rendered images
+    augment = True # scan_images: rotation, range noise, dropout, clutter and occlusion of the scans (scan_augment.py)
+    segments = None # segmented dataset (e.g. 'data/artificial_data/all.segments'): train11 + train12 + ... appended
+    shards = None # shard folder of the csv (e.g. 'data/artificial_data/train11.shards'): streamed, bigger than the RAM
+    cache_mb = 4096 # size of the decoded images cache (lazy)
+    num_workers = 0
+    seed = 0 # train/val split seed
+    fold = None # None: stratified 70/30 split, 0-4: fold of the stratified 5-fold
+    cached_val = True # validation split cached on the device, evaluated in chunks (no DataLoader)
+    backbone = 'mobilenet_v2' # mobilenet_v2, mobilenet_v3_small, shufflenet_v2, efficientnet_b0, tiny_cnn
+    input_size = 224 # < 224: the model reduces the images itself (e.g. 112 for the students)
+    image_size = None # size of the rendered images (points, scan_images), None: input_size
+    distill_from = None # runid of a trained teacher (e.g. '30-01-2024_02-31-35'): distillation of a smaller student
+    alpha = 0.5 # distillation: weight of the labels loss (1 - alpha: teacher outputs loss)
+    if distill_from is not None:
+        backbone, input_size = 'tiny_cnn', 112 # student
+        image_size = INPUT_SIZE # the teacher sees the images of its training, the student reduces them (ResizeInput)
+        cached_val = True # the teacher/student comparison uses the cached validation split
+    scans = None # scans csv/npz of the labels (e.g. 'datasets/gazebo/Crop_Data5.csv'): raw-scan model, no images
+    if scans is not None:
+        backbone, input_size = 'scan_cnn', NUM_BEAMS # scan_cnn or scan_mlp
+    if distill_from is not None and scans is not None:
+        raise ValueError('The teachers are image models: the distillation needs the images (scans = None)')
 
     ############ DATA ############
     csv_path = os.path.join(os.getcwd(), 'data', 'artificial_data', 'tags', 'Artificial_Label_Data11.csv')
     train_path = os.path.join(os.getcwd(), 'data', 'artificial_data', 'train11')
-    train_data, val_data = getData(batch_size=batch_size, csv_path=csv_path, train_path=train_path, runid=runid)
+    train_data, val_data = getData(batch_size=batch_size, csv_path=csv_path, train_path=train_path, runid=runid, 
+                                   num_workers=num_workers, lazy=lazy, cache_mb=cache_mb, seed=seed, fold=fold,
+                                   cached_val=cached_val, scans_path=scans, packed_levels=packed_levels,
+                                   points_path=points, input_size=image_size or input_size, shards_path=shards,
+                                   segments_path=segments, scan_images_path=scan_images, augment=augment)
 
     ############ MODEL ############
-    model = models.mobilenet_v2()
-
-    ########### MOBILE NET ########### 
-    model.features[0][0] = nn.Conv2d(1, 32, kernel_size=3, stride=2, padding=1, bias=False)
-    num_ftrs = model.classifier[1].in_features
-    model.classifier[1] = nn.Sequential(
-    nn.Linear(num_ftrs, 512),
-    nn.BatchNorm1d(512),
-    nn.ReLU(inplace=True),
-    nn.Linear(512, 3)
-    )
+    # registered backbones: see "model_factory.py" (python3 model_factory.py profiles all of them)
+    model = build_model(backbone, input_size=input_size)
+    teacher = None
+    if distill_from is not None:
+        # mean and std of the new normalization (the cached validation split normalizes with the dataset ones)
+        teacher = load_teacher(distill_from, val_data.mean, val_data.std, device)
 
     # Moving the model to the device (GPU/CPU)
     model = model.to(device)
@@ -176,12 +299,16 @@ if __name__ == '__main__':
     #print(model)
 
     ############ TRAINING ############
-    results = train_model(model=model, criterion=criterion, optimizer=optimizer, scheduler=scheduler, train_loader=train_data, val_loader=val_data, num_epochs=epochs)
+    results = train_model(model=model, criterion=criterion, optimizer=optimizer, scheduler=scheduler, train_loader=train_data, val_loader=val_data, num_epochs=epochs, teacher=teacher, alpha=alpha)
 
     ############ RESULTS ############
     plotResults(results, epochs, lr, runid)
+    if teacher is not None:
+        # accuracy and CPU latency of the student against the teacher (outputs in the student normalization)
+        compare_models({'teacher': teacher, 'student': model}, val_data)
 
     ############ SAVE MODEL ############
     path = os.getcwd() + '/models/' + 'model' + '_' + runid + '.pth'
     torch.save(model.state_dict(), path)
+    update_params(runid, backbone=backbone, input_size=input_size) # the loaders build the same backbone
     print(f'Saved PyTorch Model State to:\n{path}')
\ No newline at end of file
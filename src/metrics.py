@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Evaluation metrics of the line predictions, shared by the evaluation command and the validation in "main.py".
+The lines are in the network parametrization (x = w*y + q, image pixels):
+    - l1_{w1,q1,q2}: L1 error on the normalized network outputs (the training loss, per output)
+    - angle_err{1,2}: angle error of each line in degrees, atan(w) is the angle to the vertical
+    - intercept_err{1,2}: error of q in pixels (x of the line on the border y = 0 of the 224x224 image)
+The network output has 3 values (w1, q1, q2) when we suppose m1 = m2, or 4 values (w1, w2, q1, q2).
+
+@author: Felipe-Tommaselli
+"""
+
+import numpy as np
+
+OUTPUT_NAMES = {3: ['w1', 'q1', 'q2'], 4: ['w1', 'w2', 'q1', 'q2']}
+
+def expand_outputs(outputs):
+    ''' (N, 3) (w1, q1, q2) -> (N, 4) (w1, w1, q1, q2). (N, 4) is returned as it is. '''
+    outputs = np.asarray(outputs, dtype=np.float64)
+    if outputs.shape[1] == 3:
+        # we suppose m1 = m2
+        return outputs[:, [0, 0, 1, 2]]
+    return outputs
+
+def line_errors(outputs, labels_wq, mean, std):
+    ''' Per sample errors.
+    outputs: (N, 3 or 4) normalized network outputs
+    labels_wq: (N, 4) true (w1, w2, q1, q2) before the normalization
+    mean, std: normalization of (w1, w2, q1, q2) from "params.json" '''
+    outputs = np.asarray(outputs, dtype=np.float64)
+    labels_wq = np.asarray(labels_wq, dtype=np.float64)
+    mean = np.asarray(mean, dtype=np.float64)
+    std = np.asarray(std, dtype=np.float64)
+
+    columns = [0, 2, 3] if outputs.shape[1] == 3 else [0, 1, 2, 3]
+    labels_normalized = ((labels_wq - mean) / std)[:, columns]
+    pred_wq = expand_outputs(outputs) * std + mean
+
+    errors = {}
+    for i, name in enumerate(OUTPUT_NAMES[outputs.shape[1]]):
+        errors['l1_' + name] = np.abs(outputs[:, i] - labels_normalized[:, i])
+    errors['l1'] = np.mean(np.abs(outputs - labels_normalized), axis=1)
+
+    angle_error = np.abs(np.degrees(np.arctan(pred_wq[:, :2]) - np.arctan(labels_wq[:, :2])))
+    intercept_error = np.abs(pred_wq[:, 2:] - labels_wq[:, 2:])
+    errors['angle_err1'] = angle_error[:, 0]
+    errors['angle_err2'] = angle_error[:, 1]
+    errors['intercept_err1'] = intercept_error[:, 0]
+    errors['intercept_err2'] = intercept_error[:, 1]
+    return errors
+
+def summarize_errors(errors):
+    ''' Aggregate the per sample errors: mean, median and 95th percentile of each metric. '''
+    summary = {}
+    for name, values in errors.items():
+        summary[name] = {
+            'mean': float(np.mean(values)),
+            'median': float(np.median(values)),
+            'p95': float(np.percentile(values, 95)),
+        }
+    return summary
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Model factory: every network of the project is a registered backbone + the same regression head.
+    - input: (N, 1, size, size) float image (green channel, 0-255), the first conv of each backbone has 1 channel
+    - head: Linear(features, 512) -> BatchNorm1d -> ReLU -> Linear(512, outputs), 3 outputs (w1, q1, q2)
+Registered backbones:
+    - mobilenet_v2: the original model (same state_dict keys, the old "model_{runid}.pth" still load)
+    - mobilenet_v3_small, shufflenet_v2 (x1.0), efficientnet_b0 (torchvision)
+    - tiny_cnn: 5 conv blocks of 3x3, for the smallest latency
+    - scan_cnn, scan_mlp: raw-scan models, the input is the (N, 1, 1081) LaserScan ranges in meters instead of the
+      image (no rasterization, see "scan_dataset.py"), the targets are the same (w1, q1, q2)
+The backbone and the input size of a training are saved in its "params.json" entry, the loaders use mobilenet_v2 at
+224 when they are not there (old entries). Below 224 the model reduces the 224x224 image itself (ResizeInput).
+The models that are not a registered backbone (pruned channels) are saved as TorchScript "model_{runid}.pt".
+
+The profiler measures each backbone: parameters, FLOPs (conv and linear layers, counted with forward hooks) and the
+CPU latency at batch 1 and batch N:
+    python3 model_factory.py --batch 64 --threads 4
+    python3 model_factory.py --backbones mobilenet_v2 tiny_cnn --size 112
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import json
+import time
+import argparse
+import platform
+from datetime import datetime
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.models as models
+
+DEFAULT_BACKBONE = 'mobilenet_v2'
+INPUT_SIZE = 224 #px
+NUM_BEAMS = 1081 # input size of the raw-scan models
+RANGE_CLIP = 3.0 # m, the image shows up to ~2.7 m (xlim [-1.5, 1.5], ylim [0, 2.2])
+NUM_OUTPUTS = 3 # (w1, q1, q2), we suppose m1 = m2
+HEAD_HIDDEN = 512
+
+BACKBONES = {}
+BACKBONE_INPUTS = {} # 'image' (N, 1, size, size) or 'scan' (N, 1, beams)
+
+def register(name, inputs='image'):
+    ''' Decorator: register a builder "builder(num_outputs) -> nn.Module" under the name. '''
+    def decorator(builder):
+        BACKBONES[name] = builder
+        BACKBONE_INPUTS[name] = inputs
+        return builder
+    return decorator
+
+def input_kind(backbone):
+    ''' 'image' or 'scan' input of a backbone ('image' for the models that are not registered, e.g. pruned). '''
+    return BACKBONE_INPUTS.get(backbone, 'image')
+
+def example_input(inputs='image', batch_size=1, input_size=INPUT_SIZE):
+    ''' Random input batch: (N, 1, size, size) image (0-255) or (N, 1, beams) ranges in meters. '''
+    if inputs == 'scan':
+        return torch.rand(batch_size, 1, input_size) * 2 * RANGE_CLIP
+    return torch.rand(batch_size, 1, input_size, input_size) * 255
+
+def build_head(in_features, num_outputs=NUM_OUTPUTS, hidden=HEAD_HIDDEN):
+    ''' Regression head shared by all the backbones. '''
+    return nn.Sequential(
+    nn.Linear(in_features, hidden),
+    nn.BatchNorm1d(hidden),
+    nn.ReLU(inplace=True),
+    nn.Linear(hidden, num_outputs)
+    )
+
+def gray_conv(conv):
+    ''' Same convolution as "conv" with 1 input channel (new weights). '''
+    return nn.Conv2d(1, conv.out_channels, kernel_size=conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                     bias=conv.bias is not None)
+
+############ BACKBONES ############
+
+@register('mobilenet_v2')
+def mobilenet_v2(num_outputs=NUM_OUTPUTS):
+    model = models.mobilenet_v2()
+    model.features[0][0] = nn.Conv2d(1, 32, kernel_size=3, stride=2, padding=1, bias=False)
+    num_ftrs = model.classifier[1].in_features
+    model.classifier[1] = build_head(num_ftrs, num_outputs)
+    return model
+
+@register('mobilenet_v3_small')
+def mobilenet_v3_small(num_outputs=NUM_OUTPUTS):
+    model = models.mobilenet_v3_small()
+    model.features[0][0] = gray_conv(model.features[0][0])
+    model.classifier = build_head(model.classifier[0].in_features, num_outputs)
+    return model
+
+@register('shufflenet_v2')
+def shufflenet_v2(num_outputs=NUM_OUTPUTS):
+    model = models.shufflenet_v2_x1_0()
+    model.conv1[0] = gray_conv(model.conv1[0])
+    model.fc = build_head(model.fc.in_features, num_outputs)
+    return model
+
+@register('efficientnet_b0')
+def efficientnet_b0(num_outputs=NUM_OUTPUTS):
+    model = models.efficientnet_b0()
+    model.features[0][0] = gray_conv(model.features[0][0])
+    model.classifier[1] = build_head(model.classifier[1].in_features, num_outputs)
+    return model
+
+class TinyCNN(nn.Module):
+    ''' Small plain CNN: 5 blocks of conv 3x3 (stride 2) + BN + ReLU, global average pool and the head. '''
+
+    def __init__(self, num_outputs=NUM_OUTPUTS, channels=(16, 32, 64, 96, 128)):
+        super().__init__()
+        layers = []
+        in_channels = 1
+        for out_channels in channels:
+            layers += [nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=2, padding=1, bias=False),
+                       nn.BatchNorm2d(out_channels),
+                       nn.ReLU(inplace=True)]
+            in_channels = out_channels
+        self.features = nn.Sequential(*layers)
+        self.pool = nn.AdaptiveAvgPool2d(1)
+        self.classifier = build_head(in_channels, num_outputs, hidden=128)
+
+    def forward(self, x):
+        x = self.pool(self.features(x))
+        return self.classifier(torch.flatten(x, 1))
+
+@register('tiny_cnn')
+def tiny_cnn(num_outputs=NUM_OUTPUTS):
+    return TinyCNN(num_outputs)
+
+def scan_features(x, clip=RANGE_CLIP):
+    ''' Ranges in meters -> proximity in [0, 1]: 1 at the lidar, 0 at "clip" meters or more (and no return, inf). '''
+    x = torch.nan_to_num(x, nan=clip, posinf=clip, neginf=clip)
+    return 1 - x.clamp(0, clip) / clip
+
+class ScanCNN(nn.Module):
+    ''' Raw-scan model: 5 blocks of conv 1D (kernel 5, stride 2) + BN + ReLU over the beams, pooled to 8 angular
+    sectors (the beam angle matters for the lines, no global pool) and the head. '''
+
+    def __init__(self, num_outputs=NUM_OUTPUTS, channels=(16, 32, 64, 64, 96), sectors=8):
+        super().__init__()
+        layers = []
+        in_channels = 1
+        for out_channels in channels:
+            layers += [nn.Conv1d(in_channels, out_channels, kernel_size=5, stride=2, padding=2, bias=False),
+                       nn.BatchNorm1d(out_channels),
+                       nn.ReLU(inplace=True)]
+            in_channels = out_channels
+        self.features = nn.Sequential(*layers)
+        self.pool = nn.AdaptiveAvgPool1d(sectors)
+        self.classifier = build_head(in_channels * sectors, num_outputs, hidden=128)
+
+    def forward(self, x):
+        x = self.pool(self.features(scan_features(x)))
+        return self.classifier(torch.flatten(x, 1))
+
+class ScanMLP(nn.Module):
+    ''' Raw-scan model: the 1081 beams -> Linear(1081, 256) -> BatchNorm1d -> ReLU and the head. '''
+
+    def __init__(self, num_outputs=NUM_OUTPUTS, num_beams=NUM_BEAMS, hidden=256):
+        super().__init__()
+        self.features = nn.Sequential(
+        nn.Linear(num_beams, hidden),
+        nn.BatchNorm1d(hidden),
+        nn.ReLU(inplace=True)
+        )
+        self.classifier = build_head(hidden, num_outputs, hidden=128)
+
+    def forward(self, x):
+        x = self.features(torch.flatten(scan_features(x), 1))
+        return self.classifier(x)
+
+@register('scan_cnn', inputs='scan')
+def scan_cnn(num_outputs=NUM_OUTPUTS):
+    return ScanCNN(num_outputs)
+
+@register('scan_mlp', inputs='scan')
+def scan_mlp(num_outputs=NUM_OUTPUTS):
+    return ScanMLP(num_outputs)
+
+class ResizeInput(nn.Module):
+    ''' Model trained at a lower resolution: the (N, 1, 224, 224) images are reduced (area) to the input size in the
+    graph, so the rendering, the datasets and the deploy code stay at 224. '''
+
+    def __init__(self, model, input_size):
+        super().__init__()
+        self.model = model
+        self.input_size = input_size
+
+    def forward(self, x):
+        if x.shape[-1] != self.input_size or x.shape[-2] != self.input_size:
+            x = nn.functional.interpolate(x, size=(self.input_size, self.input_size), mode='area')
+        return self.model(x)
+
+############ FACTORY ############
+
+def build_model(backbone=DEFAULT_BACKBONE, num_outputs=NUM_OUTPUTS, input_size=INPUT_SIZE):
+    ''' New (random weights) model of a registered backbone (image models wrapped in ResizeInput below 224). '''
+    if backbone not in BACKBONES:
+        raise ValueError(f'unknown backbone: {backbone} (use one of {sorted(BACKBONES)})')
+    model = BACKBONES[backbone](num_outputs)
+    if input_kind(backbone) == 'image' and input_size != INPUT_SIZE:
+        model = ResizeInput(model, input_size)
+    return model
+
+def model_file(models_dir, runid):
+    ''' Path of the model of the runid: "model_{runid}.pt" (TorchScript, e.g. pruned) if it exists, else ".pth". '''
+    scripted = os.path.join(models_dir, f'model_{runid}.pt')
+    return scripted if os.path.exists(scripted) else os.path.join(models_dir, f'model_{runid}.pth')
+
+def load_model(path, backbone=DEFAULT_BACKBONE, num_outputs=NUM_OUTPUTS, input_size=INPUT_SIZE, map_location='cpu'):
+    ''' Load a "model_{runid}.pth" state dict on CPU and set the model to evaluation mode.
+    A ".pt" file is a TorchScript model (architecture included, e.g. "prune.py"): the backbone is not used. '''
+    if path.endswith('.pt'):
+        model = torch.jit.load(path, map_location=map_location)
+        model.eval()
+        return model
+    model = build_model(backbone, num_outputs, input_size)
+    checkpoint = torch.load(path, map_location=map_location)
+    model.load_state_dict(checkpoint)
+    model.eval()
+    return model
+
+def model_info(entry):
+    ''' (backbone, input size) of a "params.json" entry, the defaults for the entries without them. '''
+    entry = entry or {}
+    return entry.get('backbone', DEFAULT_BACKBONE), int(entry.get('input_size', INPUT_SIZE))
+
+############ PROFILER ############
+
+def count_params(model):
+    return sum(p.numel() for p in model.parameters())
+
+def count_flops(model, input_size=INPUT_SIZE, inputs='image'):
+    ''' FLOPs (2 x multiply-adds) of one input, conv and linear layers only (counted with forward hooks). '''
+    macs = []
+
+    def conv_hook(module, args, output):
+        kernel = int(np.prod(module.kernel_size)) * (module.in_channels // module.groups)
+        macs.append(output[0].numel() * kernel)
+
+    def linear_hook(module, args, output):
+        macs.append(module.in_features * module.out_features)
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, (nn.Conv1d, nn.Conv2d)):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+    model.eval()
+    with torch.inference_mode():
+        model(example_input(inputs, 1, input_size))
+    for hook in hooks:
+        hook.remove()
+    return 2 * sum(macs)
+
+def measure_latency(model, batch_size, input_size=INPUT_SIZE, warmup=3, repeat=10, inputs='image'):
+    ''' Median and p95 CPU latency (ms) of one forward of the batch. '''
+    model.eval()
+    images = example_input(inputs, batch_size, input_size)
+    times = []
+    with torch.inference_mode():
+        for i in range(warmup + repeat):
+            start = time.perf_counter()
+            model(images)
+            if i >= warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times)), float(np.percentile(times, 95))
+
+def profile(backbones=None, input_size=INPUT_SIZE, batch_size=64, warmup=3, repeat=10):
+    ''' Params, FLOPs and latency (batch 1 and batch N) of each backbone. '''
+    results = []
+    for name in backbones or sorted(BACKBONES):
+        model = build_model(name)
+        inputs = input_kind(name)
+        size = NUM_BEAMS if inputs == 'scan' else input_size
+        latency1, latency1_p95 = measure_latency(model, 1, size, warmup, repeat, inputs)
+        latency_n, latency_n_p95 = measure_latency(model, batch_size, size, warmup, max(3, repeat // 3), inputs)
+        results.append({
+            'backbone': name,
+            'params': count_params(model),
+            'flops': count_flops(model, size, inputs),
+            'latency_b1_ms': latency1,
+            'latency_b1_p95_ms': latency1_p95,
+            f'latency_b{batch_size}_ms': latency_n,
+            f'latency_b{batch_size}_p95_ms': latency_n_p95,
+            'images_per_s': 1000 * batch_size / latency_n,
+        })
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Params, FLOPs and CPU latency of the registered backbones.')
+    parser.add_argument('--backbones', nargs='+', default=None, choices=sorted(BACKBONES))
+    parser.add_argument('--size', type=int, default=INPUT_SIZE, help='input image size (px), the scan models use 1081')
+    parser.add_argument('--batch', type=int, default=64, help='batch N of the throughput latency')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', default=None, help='folder of the json report (e.g. assets/benchmarks)')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = profile(args.backbones, args.size, args.batch, repeat=args.repeat)
+    print(f'input {args.size}x{args.size}, {torch.get_num_threads()} threads')
+    print(f"{'backbone':<20}{'params (M)':>12}{'GFLOPs':>10}{'b1 (ms)':>10}{f'b{args.batch} (ms)':>12}{'img/s':>10}")
+    for r in results:
+        print(f"{r['backbone']:<20}{r['params'] / 1e6:>12.2f}{r['flops'] / 1e9:>10.3f}{r['latency_b1_ms']:>10.2f}"
+              f"{r[f'latency_b{args.batch}_ms']:>12.1f}{r['images_per_s']:>10.1f}")
+
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+        runid = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+        path = os.path.join(args.output, f'models_{runid}.json')
+        with open(path, 'w') as file:
+            json.dump({'id': runid, 'input_size': args.size, 'batch': args.batch, 'torch': torch.__version__,
+                       'threads': torch.get_num_threads(), 'machine': platform.platform(), 'models': results},
+                      file, indent=4)
+        print(f'Saved the profile to:\n{path}')
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bit-packed dataset: the rendered images are black markers on a white background, so each pixel needs 1 bit.
+    - levels=2: binary (threshold at 128), 1 bit per pixel -> (224, 28) uint8 per image, 6.1 KB instead of 49 KB
+    - levels=4: 2 bits per pixel (2 bit planes), keeps the anti-aliasing of the resize (12.3 KB)
+Each image is quantized to "levels" gray levels and each bit plane is packed with np.packbits along the rows:
+    bits: (N, planes, 224, 28) uint8
+The images are only unpacked per batch: the dataset has __getitems__, so the DataLoader (and its workers) fetch the
+packed batch at once and "collate" unpacks it with one lookup table (256 -> 8 pixels) for the whole batch. The batch
+has the same format of the default collate of NnDataLoader ("image" (B, 224, 224) uint8 and the list of the 3
+labels (B,)), so the training loop does not change.
+
+The packed file is saved next to the images ("train{fid}.packed2.npz") with the size and modification time of the
+csv, the pngs are decoded only once (by chunks, the uint8 images of the whole dataset are never in memory):
+    python3 packed_dataset.py ../data/artificial_data/tags/Artificial_Label_Data11.csv ../data/artificial_data/train11 2
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from label_index import LabelIndex, csv_signature
+from image_io import IMAGE_SIZE, read_images
+from dataloader import normalize_labels
+
+LEVELS = (2, 4, 16) # 1, 2 or 4 bit planes
+CHUNK = 4096 # images decoded at once while packing
+
+# LUT[byte] -> the 8 bits of the byte (np.packbits order: first pixel in the most significant bit)
+BIT_LUT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+PIXEL_LUT = BIT_LUT * np.uint8(255) # binary images: byte -> the 8 pixels (0 or 255) in one lookup
+
+def bit_planes(levels):
+    if levels not in LEVELS:
+        raise ValueError(f'levels must be one of {LEVELS}, not {levels}')
+    return int(np.log2(levels))
+
+def packed_path(train_path, levels=2):
+    ''' "data/artificial_data/train11" -> "data/artificial_data/train11.packed2.npz" '''
+    return f'{os.path.normpath(train_path)}.packed{levels}.npz'
+
+############ PACK / UNPACK ############
+
+def quantize(images, levels=2):
+    ''' (N, H, W) uint8 -> (N, H, W) uint8 gray level index 0 .. levels-1 (rounded). '''
+    images = images.astype(np.uint16)
+    return ((images * (levels - 1) + 127) // 255).astype(np.uint8)
+
+def dequantize(values, levels=2):
+    ''' Gray level index -> uint8 image (0 .. 255). '''
+    lut = np.round(np.arange(levels) * 255 / (levels - 1)).astype(np.uint8)
+    return lut[values]
+
+def pack_images(images, levels=2):
+    ''' (N, H, W) uint8 images -> (N, planes, H, W / 8) packed bits. '''
+    values = quantize(images, levels)
+    planes = [np.packbits((values >> p) & 1, axis=-1) for p in range(bit_planes(levels))]
+    return np.stack(planes, axis=1)
+
+def unpack_images(bits, levels=2):
+    ''' (N, planes, H, W / 8) packed bits -> (N, H, W) uint8 images, vectorized over the batch. '''
+    n, planes, height, width = bits.shape
+    if planes == 1:
+        return PIXEL_LUT[bits[:, 0]].reshape(n, height, width * 8)
+    unpacked = BIT_LUT[bits].reshape(n, planes, height, width * 8) # (N, planes, H, W) 0/1
+    weights = (1 << np.arange(planes, dtype=np.uint8)).reshape(1, planes, 1, 1)
+    return dequantize((unpacked * weights).sum(axis=1, dtype=np.uint8), levels)
+
+def quantization_error(images, levels=2):
+    ''' Mean absolute error (0-255) and fraction of changed pixels of the packing of the images. '''
+    restored = unpack_images(pack_images(images, levels), levels)
+    difference = np.abs(restored.astype(np.int16) - images.astype(np.int16))
+    return float(difference.mean()), float(np.mean(difference > 0))
+
+############ FILE ############
+
+def build_packed(csv_path, train_path, levels=2, path=None, num_workers=None, chunk=CHUNK):
+    ''' Decode the images of the csv (by chunks), pack them and save the packed file. Returns the path. '''
+    path = path or packed_path(train_path, levels)
+    index = LabelIndex.from_csv(csv_path)
+    paths = index.image_paths(train_path)
+    bits = np.empty((len(paths), bit_planes(levels), IMAGE_SIZE, IMAGE_SIZE // 8), dtype=np.uint8)
+    for start in range(0, len(paths), chunk):
+        images = read_images(paths[start:start + chunk], num_workers=num_workers, check=True)
+        bits[start:start + len(images)] = pack_images(images, levels)
+        print(f'\rpacking images: {start + len(images)}/{len(paths)}', end='', flush=True)
+    print()
+    with open(path, 'wb') as file:
+        np.savez(file, steps=index.steps, bits=bits, labels=index.values, levels=levels,
+                 signature=csv_signature(csv_path))
+    print(f'Saved {len(paths)} packed images ({bits.nbytes / 2**20:.1f} MB) to {path}')
+    return path
+
+def load_packed(csv_path, train_path, levels=2, path=None):
+    ''' steps, bits and labels of the packed file, built (again) if missing or if the csv changed. '''
+    path = path or packed_path(train_path, levels)
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            if np.array_equal(saved['signature'], csv_signature(csv_path)) and int(saved['levels']) == levels:
+                return saved['steps'], saved['bits'], saved['labels']
+        print(f'The csv changed, packing the images again: {path}')
+    build_packed(csv_path, train_path, levels, path)
+    with np.load(path) as saved:
+        return saved['steps'], saved['bits'], saved['labels']
+
+
+class PackedDataset(Dataset):
+    ''' Dataset class for the lidar data with bit-packed images (8x less RAM than NnDataLoader when binary). '''
+
+    def __init__(self, csv_path, train_path, runid, levels=2, path=None):
+        ''' Constructor of the class. levels: 2 (binary) or 4/16 gray levels. '''
+        self.levels = levels
+        self.steps, self.bits, labels = load_packed(csv_path, train_path, levels, path)
+        print(f'{len(self.bits)} packed images loaded ({self.bits.nbytes / 2**20:.1f} MB, {levels} levels)')
+
+        ############ NORMALIZED LABELS, MEAN AND STD ("params.json") ############
+        self.labels_normalized, self.mean, self.std = normalize_labels(labels, runid)
+
+    def __len__(self) -> int:
+        ''' Returns the length of the dataset (based on the labels). '''
+        return len(self.bits)
+
+    def unpack(self, indices):
+        ''' (B, 224, 224) uint8 images of the indices. '''
+        return unpack_images(self.bits[np.asarray(indices)], self.levels)
+
+    def __getitem__(self, idx: int) -> dict:
+        ''' Returns the sample image of the dataset (unpacked), same format as NnDataLoader. '''
+        #! suppose m1 = m2
+        w1, w2, q1, q2 = self.labels_normalized[idx].tolist()
+        return {"labels": [w1, q1, q2], "image": self.unpack([idx])[0], "angle": 0}
+
+    def __getitems__(self, indices):
+        ''' Packed batch (the DataLoader calls it instead of __getitem__ per sample), unpacked by "collate". '''
+        indices = np.asarray(indices)
+        return {"bits": self.bits[indices], "labels": self.labels_normalized[indices], "levels": self.levels}
+
+    @staticmethod
+    def collate(batch):
+        ''' Packed batch -> {"image": (B, 224, 224) uint8, "labels": [w1 (B,), q1 (B,), q2 (B,)], "angle"}. '''
+        images = unpack_images(batch["bits"], batch["levels"])
+        labels = batch["labels"][:, [0, 2, 3]] # removing w2
+        return {"image": torch.from_numpy(images), "labels": list(torch.from_numpy(labels.T.copy())),
+                "angle": torch.zeros(len(images), dtype=torch.int64)}
+
+if __name__ == '__main__':
+    csv_path, train_path = sys.argv[1], sys.argv[2]
+    levels = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    path = build_packed(csv_path, train_path, levels)
+    sample = read_images(LabelIndex.from_csv(csv_path).image_paths(train_path)[:256])
+    for k in LEVELS:
+        error, changed = quantization_error(sample, k)
+        print(f'{k:>3} levels: {bit_planes(k) * IMAGE_SIZE * IMAGE_SIZE / 8 / 1024:.1f} KB per image, '
+              f'mean abs error {error:.2f}, changed pixels {100 * changed:.2f}%')
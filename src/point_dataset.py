@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Point-list dataset: the points sampled by "utils/artificial_generator.py" are saved instead of (or with) the pngs,
+and the images are rendered when the batches are loaded, at any resolution and marker size.
+Ragged format ("train{fid}.points.npz", written and read by "point_list.py"):
+    - xy: (P, 2) float32, the points of all the samples concatenated, in the generator coordinates (0-224, y up)
+    - offsets: (N + 1,) int64, the points of the sample i are xy[offsets[i]:offsets[i + 1]]
+    - labels: (N, 4) float64 (m1, m2, b1, b2) and steps: (N,) int64, the same as the label csv
+About 150 points per sample (~1.2 KB) instead of a ~8 KB png (and 49 KB decoded).
+
+The rendering is the vectorized Rasterizer ("rasterizer.py") with the geometry of the generator plot: data limits
+0-224 on both axes without margin and the scatter marker (s=90 at 58 dpi) as a disk of 4.2 px of radius in the 224
+image (measured on the pngs: 9 px wide, 57 px of area). At a size S the marker radius is scaled by S/224.
+The labels stay in the 224 frame at every resolution (the model outputs do not depend on the input size), so the
+normalization, the metrics and the deploy are the same as the 224 models; train the model with input_size=S.
+
+    python3 point_dataset.py ../data/artificial_data/train12.points.npz 112
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from label_index import LabelIndex
+from rasterizer import Rasterizer, IMAGE_SIZE
+from point_list import save_point_list, load_point_list
+from dataloader import normalize_labels
+
+FRAME = 224 # size of the generator plot (data units)
+POINT_RADIUS = 4.2 # px in a 224 image
+
+def point_rasterizer(size=IMAGE_SIZE, radius=POINT_RADIUS):
+    ''' Rasterizer of the generator geometry (0-224 data limits, no margin), radius given for a 224 image. '''
+    return Rasterizer(size=size, xlim=(0, FRAME), ylim=(0, FRAME), margin=0.0, radius=radius)
+
+def gather(xy, offsets, rows):
+    ''' Points and offsets of the samples "rows" (in that order), without a Python loop. '''
+    starts, ends = offsets[rows], offsets[np.asarray(rows) + 1]
+    lengths = ends - starts
+    new_offsets = np.concatenate(([0], np.cumsum(lengths)))
+    # index of each point: start of its sample + position inside the sample
+    index = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return xy[index], new_offsets
+
+
+class PointListDataset(Dataset):
+    ''' Dataset class for the lidar data with the point lists, rendered at load time (size x size). '''
+
+    def __init__(self, csv_path, points_path, runid, size=IMAGE_SIZE, radius=POINT_RADIUS):
+        ''' Constructor of the class. csv_path: labels csv of the generator, points_path: point list of the same run. '''
+        self.index = LabelIndex.from_csv(csv_path)
+        self.xy, self.offsets, _, steps = load_point_list(points_path)
+        self.rasterizer = point_rasterizer(size, radius)
+
+        ############ CSV ORDER ############
+        order = np.argsort(steps)
+        positions = np.minimum(np.searchsorted(steps, self.index.steps, sorter=order), len(steps) - 1)
+        self.rows = order[positions]
+        missing = steps[self.rows] != self.index.steps
+        if np.any(missing):
+            raise KeyError(f'{np.count_nonzero(missing)} labels without points, e.g. the steps '
+                           f'{self.index.steps[missing][:5].tolist()}')
+        print(f'{len(self.rows)} point lists loaded ({len(self.xy)} points), rendered at {size}x{size}')
+
+        ############ NORMALIZED LABELS, MEAN AND STD ("params.json") ############
+        self.labels_normalized, self.mean, self.std = normalize_labels(self.index.values, runid)
+
+    def __len__(self) -> int:
+        ''' Returns the length of the dataset (based on the labels). '''
+        return len(self.rows)
+
+    def render(self, indices):
+        ''' (B, size, size) uint8 images of the indices, rendered in one Rasterizer call. '''
+        points, offsets = gather(self.xy, self.offsets, self.rows[np.asarray(indices)])
+        return self.rasterizer.render_batch(points, offsets)
+
+    def __getitem__(self, idx: int) -> dict:
+        ''' Returns the sample image of the dataset (rendered), same format as NnDataLoader. '''
+        #! suppose m1 = m2
+        w1, w2, q1, q2 = self.labels_normalized[idx].tolist()
+        return {"labels": [w1, q1, q2], "image": self.render([idx])[0], "angle": 0}
+
+    def __getitems__(self, indices):
+        ''' Rendered batch (the DataLoader calls it instead of __getitem__ per sample), see "collate". '''
+        indices = np.asarray(indices)
+        return {"images": self.render(indices), "labels": self.labels_normalized[indices]}
+
+    @staticmethod
+    def collate(batch):
+        ''' Rendered batch -> {"image": (B, size, size) uint8, "labels": [w1 (B,), q1 (B,), q2 (B,)], "angle"}. '''
+        labels = batch["labels"][:, [0, 2, 3]] # removing w2
+        return {"image": torch.from_numpy(batch["images"]), "labels": list(torch.from_numpy(labels.T.copy())),
+                "angle": torch.zeros(len(labels), dtype=torch.int64)}
+
+if __name__ == '__main__':
+    points_path = sys.argv[1]
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else IMAGE_SIZE
+    xy, offsets, labels, steps = load_point_list(points_path)
+    print(f'{len(steps)} samples, {len(xy)} points ({len(xy) / len(steps):.0f} per sample), '
+          f'{os.path.getsize(points_path) / len(steps) / 1024:.2f} KB per sample')
+    rasterizer = point_rasterizer(size)
+    start = time.perf_counter()
+    rasterizer.render_batch(xy, offsets)
+    print(f'rendered at {size}x{size}: {1e6 * (time.perf_counter() - start) / len(steps):.0f} us per image')
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Point-list file ("train{fid}.points.npz", see "point_dataset.py"), numpy only: the generator
+("utils/artificial_generator.py") writes it without importing torch, pandas or the dataloader.
+    - xy: (P, 2) float32, the points of all the samples concatenated, in the generator coordinates (0-224, y up)
+    - offsets: (N + 1,) int64, the points of the sample i are xy[offsets[i]:offsets[i + 1]]
+    - labels: (N, 4) float64 (m1, m2, b1, b2) and steps: (N,) int64, the same as the label csv
+The file is replaced atomically. The generator appends: every few samples it saves only the new ones to a part file
+("train{fid}.points.npz.part00003.npz", the same format), and the parts are merged into the point list at the end, so
+each sample is written twice instead of once per save. An interrupted run keeps its parts up to the last save:
+    python3 point_list.py ../data/artificial_data/train12.points.npz # merge the parts left by an interrupted run
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import glob
+import argparse
+import numpy as np
+
+def save_point_list(path, steps, points, labels):
+    ''' Save the samples: steps (N,), points: list of N (P_i, 2) arrays, labels (N, 4) (m1, m2, b1, b2). '''
+    lengths = np.array([len(p) for p in points], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    xy = np.concatenate([np.asarray(p, dtype=np.float32).reshape(-1, 2) for p in points] +
+                        [np.empty((0, 2), dtype=np.float32)])
+    # written next to the file and renamed: a reader sees the previous or the new point list, never a partial one
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file, xy=xy, offsets=offsets, labels=np.asarray(labels, dtype=np.float64).reshape(-1, 4),
+                 steps=np.asarray(steps, dtype=np.int64))
+    os.replace(path + '.tmp', path)
+    return path
+
+def load_point_list(path):
+    ''' xy (P, 2), offsets (N + 1,), labels (N, 4) and steps (N,) of a point list. '''
+    with np.load(path) as saved:
+        return saved['xy'], saved['offsets'], saved['labels'], saved['steps']
+
+def part_path(path, part):
+    ''' Path of the part (int) of a point list. '''
+    return f'{path}.part{part:05d}.npz'
+
+def save_point_part(path, part, steps, points, labels):
+    ''' Save only the new samples (same arguments as save_point_list) to a part of the point list. '''
+    return save_point_list(part_path(path, part), steps, points, labels)
+
+def merge_point_parts(path, parts=None):
+    ''' Concatenate the parts (paths, None: all the parts found next to path, in order) into the point list at path,
+    then remove them. Returns the number of samples. '''
+    if parts is None:
+        parts = sorted(glob.glob(glob.escape(path) + '.part*.npz'))
+    xys, lengths, labels, steps = [], [], [], []
+    for part in parts:
+        xy, offsets, part_labels, part_steps = load_point_list(part)
+        xys.append(xy)
+        lengths.append(np.diff(offsets))
+        labels.append(part_labels)
+        steps.append(part_steps)
+    lengths = np.concatenate(lengths + [np.empty(0, dtype=np.int64)])
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file, xy=np.concatenate(xys + [np.empty((0, 2), dtype=np.float32)]), offsets=offsets,
+                 labels=np.concatenate(labels + [np.empty((0, 4))]),
+                 steps=np.concatenate(steps + [np.empty(0, dtype=np.int64)]))
+    os.replace(path + '.tmp', path)
+    for part in parts:
+        os.remove(part)
+    return len(lengths)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the parts of a point list (interrupted generator run).')
+    parser.add_argument('path', help='point list (e.g. ../data/artificial_data/train12.points.npz)')
+    args = parser.parse_args()
+    print(f'{merge_point_parts(args.path)} samples merged into {args.path}')
@@ -19,6 +19,7 @@ import numpy as np
 import math
 import matplotlib.pyplot as plt
 import torch
+import torch.nn as nn
 import os
 import random
 
@@ -33,6 +34,31 @@ RAW_SIZE = 540
 MAX_M = 540 
 CROP_FACTOR_X = 0.17 #% # using this for square image assure
 DESIRED_SIZE = 224 #px
+SLOPE_EPS = 1e-6 # |m| or |w| below this is clamped to +-SLOPE_EPS before 1/m or 1/w (batch API)
+
+# empirical (w1, w2, q1, q2) ranges of the min-max normalization (extract_label and deprocess)
+MINMAX_LOW = [-0.58, -0.58, -56.06, 36.81]
+MINMAX_HIGH = [0.58, 0.58, 187.15, 299.99]
+
+def _as_labels(labels):
+    ''' numpy float64 array or floating torch tensor of the labels (lists are converted to numpy). '''
+    if torch.is_tensor(labels):
+        return labels if labels.is_floating_point() else labels.float()
+    return np.asarray(labels, dtype=np.float64)
+
+def _like(values, reference):
+    ''' values (mean, std, ...) with the type, dtype and device of the reference labels. '''
+    if torch.is_tensor(reference):
+        if torch.is_tensor(values):
+            return values.to(dtype=reference.dtype, device=reference.device)
+        return torch.as_tensor(np.asarray(values), dtype=reference.dtype, device=reference.device)
+    return np.asarray(values, dtype=np.float64)
+
+def _concat(first, second):
+    ''' Concatenate the columns (last axis) of two numpy arrays or torch tensors. '''
+    if torch.is_tensor(first):
+        return torch.cat((first, second), dim=-1)
+    return np.concatenate((first, second), axis=-1)
 
 class PreProcess:
 
@@ -78,11 +104,9 @@ class PreProcess:
 
         if len(label) == 3:
             # we suppose m1 = m2, so we can use the same deprocess
-            print('supposing m1 = m2')   
             w1, q1, q2 = label
             w2 = w1
         elif len(label) == 4:
-            print('not supposing m1 = m2')        
             w1, w2, q1, q2 = label
 
         # DEPROCESS THE LABEL
@@ -113,6 +137,50 @@ class PreProcess:
 
         return [w1, w2, q1, q2]
 
+    # ############################################################################################
+    #       (BATCH) VECTORIZED VERSIONS FOR (N, 4) OR (N, 3) NUMPY ARRAYS AND TORCH TENSORS
+    # ############################################################################################
+    # the labels are rows: (m1, m2, b1, b2) or (w1, w2, q1, q2), or (w1, q1, q2) when we suppose m1 = m2
+    # a single label (4,) or (3,) is also accepted and returned with the same shape
+    # near-zero slopes: |m| (or |w|) < eps is replaced by +-eps (the sign is kept, 0 -> +eps), so a vertical or
+    # horizontal line gives a large but finite value instead of inf/nan. The scalar functions above are unchanged.
+
+    @staticmethod
+    def clamp_slope(slope, eps=SLOPE_EPS):
+        ''' Returns the slopes with |slope| >= eps (numpy or torch). '''
+        lib = torch if torch.is_tensor(slope) else np
+        sign = lib.where(slope < 0, -1.0, 1.0)
+        return lib.where(abs(slope) < eps, sign * eps, slope)
+
+    @staticmethod
+    def expand_labels(labels):
+        ''' (N, 3) (w1, q1, q2) -> (N, 4) (w1, w1, q1, q2), we suppose m1 = m2. (N, 4) is returned as it is. '''
+        if labels.shape[-1] == 3:
+            return labels[..., [0, 0, 1, 2]]
+        if labels.shape[-1] != 4:
+            raise ValueError(f'labels must have 3 or 4 columns, got shape {tuple(labels.shape)}')
+        return labels
+
+    @staticmethod
+    def parametrization_batch(labels, eps=SLOPE_EPS):
+        ''' (N, 4) (m1, m2, b1, b2) <-> (w1, w2, q1, q2): w = 1/m and q = -b/m (the same operation both ways). '''
+        labels = _as_labels(labels)
+        slopes = PreProcess.clamp_slope(labels[..., :2], eps)
+        return _concat(1 / slopes, -labels[..., 2:] / slopes)
+
+    @staticmethod
+    def standard_extract_label_batch(labels, mean, std):
+        ''' (N, 4) (w1, w2, q1, q2) -> normalized (x - mean) / std, as standard_extract_label. '''
+        labels = _as_labels(labels)
+        return (labels - _like(mean, labels)) / _like(std, labels)
+
+    @staticmethod
+    def standard_deprocess_batch(labels, mean, std, eps=SLOPE_EPS):
+        ''' (N, 3 or 4) normalized network outputs -> (N, 4) lines (m1, m2, b1, b2), as standard_deprocess. '''
+        labels = PreProcess.expand_labels(_as_labels(labels))
+        wq = labels * _like(std, labels) + _like(mean, labels)
+        return PreProcess.parametrization_batch(wq, eps)
+
     # ############################################################################################
     #         (NON STANDARD) UTILITIES FUNCTIONS FOR DEPROCESSING AND ROUTINE OPERATIONS
     # ############################################################################################
@@ -123,11 +191,9 @@ class PreProcess:
 
         if len(label) == 3:
             # we suppose m1 = m2, so we can use the same deprocess
-            print('supposing m1 = m2')   
             w1, q1, q2 = label
             w2 = w1
         elif len(label) == 4:
-            print('not supposing m1 = m2')        
             w1, w2, q1, q2 = label
 
         # DEPROCESS THE LABEL
@@ -174,6 +240,21 @@ class PreProcess:
 
         return [w1, w2, q1, q2]
 
+    @staticmethod
+    def extract_label_batch(labels, eps=SLOPE_EPS):
+        ''' (N, 4) (m1, m2, b1, b2) -> parametrization + min-max normalization to [-1, 1], as extract_label. '''
+        wq = PreProcess.parametrization_batch(labels, eps)
+        low, high = _like(MINMAX_LOW, wq), _like(MINMAX_HIGH, wq)
+        return 2 * (wq - low) / (high - low) - 1
+
+    @staticmethod
+    def deprocess_batch(labels, eps=SLOPE_EPS):
+        ''' (N, 3 or 4) min-max normalized labels -> (N, 4) lines (m1, m2, b1, b2), as deprocess. '''
+        labels = PreProcess.expand_labels(_as_labels(labels))
+        low, high = _like(MINMAX_LOW, labels), _like(MINMAX_HIGH, labels)
+        wq = (labels + 1) * (high - low) / 2 + low
+        return PreProcess.parametrization_batch(wq, eps)
+
     #* ############################################################################################
     #* ############################################################################################
     #*             [[[             REAL-LIFE DATASET             ]]]
@@ -375,3 +456,130 @@ class PreProcess:
         contours_img = np.array(contours_img)
 
         return contours_img
+
+
+class ContourPreProcessor:
+    ''' Stateful fast path of PreProcess.contours_image (same output, bit for bit).
+    The masks (ellipse and borders) and the structuring elements are built once in the constructor, the 41x41 blur
+    only runs around the ellipse (the only region where it is used) and the visualization-only outputs (largest
+    contour, contours drawn over the images) are not computed. The Gaussian blurs of OpenCV are already separable
+    but the 61x61 one is still the most expensive step: approximate=True replaces each Gaussian blur by 3 box blurs
+    with the same variance (much faster, but not bit for bit anymore). '''
+
+    BOX_PASSES = 3
+
+    def __init__(self, size=224, border_size=6, approximate=False):
+        ''' Constructor of the class. '''
+        self.size = size
+        self.approximate = approximate
+        # (ksize, sigmaX, sigmaY) of each Gaussian blur -> box sizes of the approximation
+        self.boxes = {ksize: ContourPreProcessor.box_sizes(ksize, sigma_x, sigma_y)
+                      for ksize, sigma_x, sigma_y in [(61, 0, 40), (41, 0, 20), (11, 0, 0)]}
+
+        ####### KERNELS ########
+        self.kernel_dilate = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 11))
+        self.kernel_erode = cv2.getStructuringElement(cv2.MORPH_RECT, (18, 34))
+
+        ####### MASCARA CIRCULAR ########
+        mask = np.zeros((size, size), dtype=np.uint8)
+        cv2.ellipse(mask, center=(112, 157), axes=(85, 52), angle=0, startAngle=0, endAngle=360, color=255, thickness=-1)
+        self.mask = mask.astype(bool)
+
+        # region of the 41x41 blur: bounding box of the ellipse plus the kernel radius (20 px), clipped to the image.
+        # Inside the bounding box the result is the same of the full image blur, the clipped sides use the same
+        # border reflection of the full image
+        rows, cols = np.where(self.mask)
+        radius = 41 // 2
+        self.box = (rows.min(), rows.max() + 1, cols.min(), cols.max() + 1)
+        self.roi = (max(rows.min() - radius, 0), min(rows.max() + 1 + radius, size),
+                    max(cols.min() - radius, 0), min(cols.max() + 1 + radius, size))
+        self.mask_box = self.mask[self.box[0]:self.box[1], self.box[2]:self.box[3]]
+
+        ####### MASCARA DAS BORDAS ########
+        self.border = np.ones((size, size), dtype=bool)
+        self.border[border_size:-border_size, border_size:-border_size] = False
+
+    @staticmethod
+    def box_sizes(ksize, sigma_x, sigma_y, passes=BOX_PASSES):
+        ''' (width, height) of the box blur that, repeated "passes" times, has the variance of the Gaussian kernel
+        used by cv2.GaussianBlur (sigma 0 is computed from ksize, the kernel is truncated to ksize). '''
+        sizes = []
+        for sigma in (sigma_x, sigma_y):
+            kernel = cv2.getGaussianKernel(ksize, sigma if sigma > 0 else -1).ravel()
+            offsets = np.arange(ksize) - ksize // 2
+            variance = np.sum(kernel * offsets**2)
+            # variance of a box of width w: (w^2 - 1) / 12
+            width = int(round(np.sqrt(12 * variance / passes + 1)))
+            sizes.append(width + 1 - width % 2) # odd
+        return tuple(sizes)
+
+    def gaussian(self, image, ksize, sigma_x, sigma_y):
+        ''' cv2.GaussianBlur or its box approximation. '''
+        if not self.approximate:
+            return cv2.GaussianBlur(image, (ksize, ksize), sigmaX=sigma_x, sigmaY=sigma_y)
+        for _ in range(self.BOX_PASSES):
+            image = cv2.blur(image, self.boxes[ksize])
+        return image
+
+    def __call__(self, image):
+        ''' Returns the image with the contours (same as PreProcess.contours_image). '''
+        img = cv2.bitwise_not(image)
+
+        ####### DILATAÇÃO ########
+        img_blur = cv2.blur(img, (15, 15))
+        img_dilated = cv2.dilate(img_blur, self.kernel_dilate, iterations=1)
+
+        ####### SUAVIZAÇÃO ########
+        # desfoque mais forte na imagem toda e o mais leve somente na região circular
+        img_blur_final = self.gaussian(img_dilated, 61, 0, 40)
+        r0, r1, c0, c1 = self.roi
+        img_blur_circle = self.gaussian(img_dilated[r0:r1, c0:c1], 41, 0, 20)
+        b0, b1, d0, d1 = self.box
+        circle = img_blur_circle[b0 - r0:b1 - r0, d0 - c0:d1 - c0]
+        region = img_blur_final[b0:b1, d0:d1]
+        region[self.mask_box] = circle[self.mask_box]
+
+        ####### EROSÃO ########
+        img_eroded = cv2.erode(img_blur_final, self.kernel_erode, iterations=1)
+        img_eroded = self.gaussian(img_eroded, 11, 0, 0)
+
+        ####### BINARIZAÇÃO ########
+        ret, thresh = cv2.threshold(img_eroded, 50, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+        thresh = cv2.bitwise_not(thresh)
+
+        ####### CONTORNOS ########
+        contours, hierarchy = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        contours_img = np.zeros_like(img)
+        cv2.drawContours(contours_img, contours, -1, (255, 255, 255), 2)
+
+        # bordas internas em preto
+        contours_img[self.border] = 0
+        return contours_img
+
+    def process_batch(self, images):
+        ''' (N, size, size) uint8 images -> (N, size, size) images with the contours. '''
+        out = np.empty((len(images), self.size, self.size), dtype=np.uint8)
+        for i, image in enumerate(images):
+            out[i] = self(image)
+        return out
+
+
+class DeprocessLayer(nn.Module):
+    ''' Torch module with the standard deprocess: (N, 3 or 4) normalized outputs -> (N, 4) lines (m1, m2, b1, b2).
+    Appended to the model, the deprocessing runs in the graph (same device, no numpy round trip):
+        model = DeprocessLayer.append(model, mean, std) '''
+
+    def __init__(self, mean, std, eps=SLOPE_EPS):
+        ''' Constructor of the class. mean and std of (w1, w2, q1, q2) from "params.json". '''
+        super().__init__()
+        self.eps = eps
+        self.register_buffer('mean', torch.as_tensor(np.asarray(mean), dtype=torch.float32))
+        self.register_buffer('std', torch.as_tensor(np.asarray(std), dtype=torch.float32))
+
+    def forward(self, outputs):
+        return PreProcess.standard_deprocess_batch(outputs, self.mean, self.std, self.eps)
+
+    @staticmethod
+    def append(model, mean, std, eps=SLOPE_EPS):
+        ''' model -> nn.Sequential(model, DeprocessLayer). '''
+        return nn.Sequential(model, DeprocessLayer(mean, std, eps))
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Structured (channel) pruning of the MobileNetV2 regressor, for a faster CPU inference in the deploy node.
+Pruned channels are physically removed, so the result is a smaller dense network (no masks, no sparse kernels):
+    - inverted residual blocks: hidden (expanded) channels, i.e. expansion 1x1 conv outputs, depthwise conv and
+      projection 1x1 conv inputs. The block outputs (residual connections) are not touched.
+    - head: hidden units of the 512-unit Linear -> BatchNorm1d -> ReLU -> Linear
+Channels are ranked by the BatchNorm scale |gamma| ("bn", network slimming) or by the L1 norm of the filters ("l1").
+Each step removes "ratio" of the channels of every layer (kept counts multiple of 8), fine-tunes a few epochs with the
+training loop of "main.py" (same L1 loss) and measures the validation loss and the CPU latency (batch 1). It stops at
+the latency target, or before a step that increases the validation loss more than the accuracy budget.
+
+The pruned model is not a registered backbone, so it is saved as TorchScript "models/model_{runid}.pt" (architecture
+included, loaded by "model_factory.load_model" without building anything) with a new "params.json" entry.
+
+    python3 src/prune.py --runid 30-01-2024_02-31-35 --target-ms 12 --max-loss-increase 0.05
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import copy
+import json
+import argparse
+import warnings
+from datetime import datetime
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import DataLoader, Subset
+from torchvision.models.mobilenetv2 import InvertedResidual
+
+from dataloader import NnDataLoader, load_params_entry, update_params
+from data_split import load_split
+from validation import CachedValidation
+from model_factory import ResizeInput, load_model, model_info, model_file, count_params, count_flops, measure_latency
+from main import train_model, device
+
+CRITERIA = ('bn', 'l1')
+MULTIPLE = 8 # kept channels are a multiple of 8 (vectorized CPU kernels)
+MIN_CHANNELS = 8
+
+############ SCORES ############
+
+def channel_scores(conv, bn, criterion='bn'):
+    ''' Importance of each output channel of a conv/linear followed by a BatchNorm. '''
+    if criterion == 'bn':
+        return bn.weight.detach().abs()
+    if criterion == 'l1':
+        return conv.weight.detach().abs().flatten(1).sum(dim=1)
+    raise ValueError(f'unknown criterion: {criterion} (use one of {CRITERIA})')
+
+def keep_indices(scores, ratio, multiple=MULTIPLE, min_channels=MIN_CHANNELS):
+    ''' Sorted indices of the channels kept after removing "ratio" of them (lowest scores first). '''
+    total = len(scores)
+    keep = int(round(total * (1 - ratio) / multiple)) * multiple
+    keep = min(total, max(min_channels, keep))
+    return torch.sort(torch.topk(scores, keep).indices).values
+
+############ SURGERY ############
+
+def prune_conv(conv, out_idx=None, in_idx=None):
+    ''' Copy of the Conv2d with only the out_idx output and in_idx input channels (depthwise: groups follow). '''
+    weight = conv.weight.detach()
+    depthwise = conv.groups == conv.in_channels and conv.groups > 1
+    if out_idx is not None:
+        weight = weight[out_idx]
+    if in_idx is not None and not depthwise:
+        weight = weight[:, in_idx]
+    out_channels = weight.shape[0]
+    in_channels = out_channels if depthwise else weight.shape[1]
+    new = nn.Conv2d(in_channels, out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                    dilation=conv.dilation, groups=out_channels if depthwise else 1, bias=conv.bias is not None)
+    new.weight.data.copy_(weight)
+    if conv.bias is not None:
+        new.bias.data.copy_(conv.bias.detach() if out_idx is None else conv.bias.detach()[out_idx])
+    return new
+
+def prune_linear(linear, out_idx=None, in_idx=None):
+    ''' Copy of the Linear with only the out_idx outputs and in_idx inputs. '''
+    weight, bias = linear.weight.detach(), linear.bias.detach()
+    if out_idx is not None:
+        weight, bias = weight[out_idx], bias[out_idx]
+    if in_idx is not None:
+        weight = weight[:, in_idx]
+    new = nn.Linear(weight.shape[1], weight.shape[0])
+    new.weight.data.copy_(weight)
+    new.bias.data.copy_(bias)
+    return new
+
+def prune_bn(bn, idx):
+    ''' Copy of the BatchNorm (1d or 2d) with only the idx channels (affine and running statistics). '''
+    new = type(bn)(len(idx), eps=bn.eps, momentum=bn.momentum)
+    new.weight.data.copy_(bn.weight.detach()[idx])
+    new.bias.data.copy_(bn.bias.detach()[idx])
+    new.running_mean.copy_(bn.running_mean[idx])
+    new.running_var.copy_(bn.running_var[idx])
+    new.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return new
+
+def expanded_blocks(model):
+    ''' Inverted residual blocks with an expansion conv (all but the first one, expand ratio 1). '''
+    return [block for block in model.features if isinstance(block, InvertedResidual) and len(block.conv) == 4]
+
+def prune_block(block, ratio, criterion='bn'):
+    ''' Remove hidden channels of a block: expansion conv + BN, depthwise conv + BN, projection conv inputs. '''
+    expand, depthwise, project = block.conv[0], block.conv[1], block.conv[2]
+    idx = keep_indices(channel_scores(expand[0], expand[1], criterion), ratio)
+    if len(idx) == expand[0].out_channels:
+        return False
+    expand[0], expand[1] = prune_conv(expand[0], out_idx=idx), prune_bn(expand[1], idx)
+    depthwise[0], depthwise[1] = prune_conv(depthwise[0], out_idx=idx), prune_bn(depthwise[1], idx)
+    block.conv[2] = prune_conv(project, in_idx=idx)
+    return True
+
+def prune_head(head, ratio, criterion='bn'):
+    ''' Remove hidden units of the head: Linear -> BatchNorm1d -> ReLU -> Linear. '''
+    idx = keep_indices(channel_scores(head[0], head[1], criterion), ratio)
+    if len(idx) == head[0].out_features:
+        return False
+    head[0], head[1] = prune_linear(head[0], out_idx=idx), prune_bn(head[1], idx)
+    head[3] = prune_linear(head[3], in_idx=idx)
+    return True
+
+def base_network(model):
+    ''' MobileNetV2 inside the model (the smaller input sizes are wrapped in ResizeInput). '''
+    network = model.model if isinstance(model, ResizeInput) else model
+    if not expanded_blocks(network) or not isinstance(network.classifier[1], nn.Sequential):
+        raise ValueError('prune.py only prunes the mobilenet_v2 backbone (inverted residual blocks and the 512 head)')
+    return network
+
+def prune_step(model, ratio, criterion='bn'):
+    ''' One pruning step (in place) of every block and of the head, False if nothing was removed. '''
+    network = base_network(model)
+    changed = [prune_block(block, ratio, criterion) for block in expanded_blocks(network)]
+    changed.append(prune_head(network.classifier[1], ratio, criterion))
+    return any(changed)
+
+def hidden_channels(model):
+    ''' Hidden channels of each block and of the head (saved in "params.json"). '''
+    network = base_network(model)
+    return [block.conv[0][0].out_channels for block in expanded_blocks(network)] + \
+           [network.classifier[1][0].out_features]
+
+############ PRUNE AND FINE-TUNE ############
+
+def cpu_latency(model, repeat=20):
+    ''' Median CPU latency (ms) of one 224x224 image (the deploy node runs on CPU). '''
+    return measure_latency(copy.deepcopy(model).cpu(), 1, repeat=repeat)[0]
+
+def cpu_flops(model):
+    return count_flops(copy.deepcopy(model).cpu())
+
+def prune_model(model, train_loader, val_cache, target_ms=None, max_loss_increase=0.05, ratio=0.2, criterion='bn',
+                epochs=3, lr=1e-3, max_steps=10):
+    ''' Iterative prune + fine-tune until the latency target (or max_steps), the steps over the accuracy budget
+    (validation loss > initial loss * (1 + max_loss_increase)) are discarded and stop the pruning. '''
+    l1 = nn.L1Loss()
+    base_loss, _ = val_cache.evaluate(model, l1)
+    latency = cpu_latency(model)
+    history = [{'step': 0, 'params': count_params(model), 'flops': cpu_flops(model), 'latency_ms': latency,
+                'val_loss': base_loss, 'hidden_channels': hidden_channels(model)}]
+    print(f'initial: {history[0]["params"] / 1e6:.2f} M params, {latency:.2f} ms, val loss {base_loss:.5f}')
+
+    for step in range(1, max_steps + 1):
+        if target_ms is not None and latency <= target_ms:
+            print(f'Latency target reached ({latency:.2f} <= {target_ms} ms)')
+            break
+        candidate = copy.deepcopy(model)
+        if not prune_step(candidate, ratio, criterion):
+            print('Nothing left to prune')
+            break
+        candidate = candidate.to(device)
+
+        ############ FINE-TUNE ############
+        optimizer = optim.Adam(candidate.parameters(), lr=lr)
+        scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=epochs, gamma=1.0)
+        train_model(candidate, l1, optimizer, scheduler, train_loader, val_cache, epochs)
+
+        val_loss, metrics = val_cache.evaluate(candidate, l1)
+        candidate_latency = cpu_latency(candidate)
+        print(f'step {step}: {count_params(candidate) / 1e6:.2f} M params, {candidate_latency:.2f} ms, '
+              f'val loss {val_loss:.5f} ({100 * (val_loss / base_loss - 1):+.1f}%)')
+        if val_loss > base_loss * (1 + max_loss_increase):
+            print(f'Accuracy budget exceeded (+{100 * max_loss_increase:.0f}%), keeping the model of step {step - 1}')
+            break
+        model, latency = candidate, candidate_latency
+        history.append({'step': step, 'params': count_params(model), 'flops': cpu_flops(model), 'latency_ms': latency,
+                        'val_loss': val_loss, 'hidden_channels': hidden_channels(model), **metrics})
+    return model, history
+
+def save_scripted(model, path):
+    ''' Save the model as TorchScript (no code needed to load it) and check it against the eager model. '''
+    model = model.cpu().eval()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning) # torch.jit is deprecated in favor of torch.export
+        scripted = torch.jit.script(model)
+        scripted.save(path)
+        loaded = torch.jit.load(path, map_location='cpu')
+    images = torch.rand(2, 1, 224, 224) * 255
+    with torch.inference_mode():
+        error = (loaded(images) - model(images)).abs().max().item()
+    print(f'Saved the TorchScript model to:\n{path} (max difference {error:.2e})')
+    return path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Channel pruning + fine-tune of a trained mobilenet_v2 model.')
+    parser.add_argument('--runid', required=True, help='model_{runid}.pth and params.json entry to prune')
+    parser.add_argument('--csv', default=os.path.join('data', 'artificial_data', 'tags', 'Artificial_Label_Data11.csv'))
+    parser.add_argument('--train', default=os.path.join('data', 'artificial_data', 'train11'))
+    parser.add_argument('--target-ms', type=float, default=None, help='CPU latency target (batch 1, ms)')
+    parser.add_argument('--max-loss-increase', type=float, default=0.05, help='accuracy budget (relative val loss)')
+    parser.add_argument('--ratio', type=float, default=0.2, help='fraction of the channels removed per step')
+    parser.add_argument('--criterion', default='bn', choices=CRITERIA)
+    parser.add_argument('--epochs', type=int, default=3, help='fine-tune epochs per step')
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--batch', type=int, default=140)
+    parser.add_argument('--max-steps', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0, help='train/val split seed')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads of the latency (as in the robot)')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    ############ MODEL ############
+    entry = load_params_entry(args.runid)
+    backbone, input_size = model_info(entry)
+    model = load_model(model_file(os.path.join(os.getcwd(), 'models'), args.runid), backbone, input_size=input_size)
+    model = model.to(device)
+
+    ############ DATA ############
+    # new runid: the dataset saves its mean and std, the pruned model is fine-tuned with them
+    runid = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+    dataset = NnDataLoader(args.csv, args.train, runid)
+    if not np.allclose(dataset.mean, [entry['mean' + str(i)] for i in range(4)]):
+        print('Warning: the dataset normalization is not the one of the model (the fine-tune adapts it)')
+    train_idx, val_idx = load_split(args.csv, args.train, val_fraction=0.3, seed=args.seed)
+    train_loader = DataLoader(Subset(dataset, train_idx), batch_size=args.batch, shuffle=True)
+    val_cache = CachedValidation.from_dataset(dataset, val_idx, device)
+
+    ############ PRUNING ############
+    model, history = prune_model(model, train_loader, val_cache, args.target_ms, args.max_loss_increase, args.ratio,
+                                 args.criterion, args.epochs, args.lr, args.max_steps)
+
+    print(f"{'step':>5}{'params (M)':>12}{'GFLOPs':>9}{'b1 (ms)':>10}{'val loss':>10}")
+    for h in history:
+        print(f"{h['step']:>5}{h['params'] / 1e6:>12.2f}{h['flops'] / 1e9:>9.3f}{h['latency_ms']:>10.2f}"
+              f"{h['val_loss']:>10.5f}")
+
+    ############ SAVE MODEL ############
+    path = save_scripted(model, os.path.join(os.getcwd(), 'models', f'model_{runid}.pt'))
+    update_params(runid, backbone=f'{backbone}_pruned', input_size=input_size, pruned_from=args.runid,
+                  hidden_channels=hidden_channels(model))
+    with open(os.path.join(os.getcwd(), 'models', f'prune_{runid}.json'), 'w') as file:
+        json.dump(history, file, indent=4)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fast rasterizer: LiDAR points -> 224x224 uint8 image without matplotlib.
+The deploy node used to plot the points with matplotlib, save a temporary png and read it back (~50 ms per frame).
+Here the points are mapped to pixels with the same geometry of that plot and each point is stamped as a black disk
+on a white background, vectorized over all the points of all the images of a batch.
+
+Geometry (measured on the matplotlib plot of "deploy/lidar_pipeline.py" after the resize to 224x224):
+    - xlim = [-1.5, 1.5] m and ylim = [0, 2.2] m, the lidar is on the bottom center of the image
+    - the axes leave a margin of ~6.5 px on each side (tight_layout)
+    - each marker (markersize=18) is a disk of ~3 px of radius
+The output is already the "green channel" used by the network: 0 for the points and 255 for the background.
+
+@author: Felipe-Tommaselli
+"""
+
+import numpy as np
+
+IMAGE_SIZE = 224 #px
+XLIM = (-1.5, 1.5) # m
+YLIM = (0.0, 2.2) # m
+MARGIN = 6.5 # px (in a 224 image)
+RADIUS = 3.0 # px (in a 224 image)
+FOV = (0.0, np.pi) # rad, the angles used by the deploy (0 to 180 degrees)
+MAX_RANGE = 10.0 # m
+
+def scan_angles(num_beams, fov=FOV):
+    ''' Angle of each beam, same as the deploy: np.linspace(0, 180, len(ranges), endpoint=False). '''
+    return np.linspace(fov[0], fov[1], num_beams, endpoint=False)
+
+def scan_to_points(ranges, fov=FOV):
+    ''' Polar -> cartesian for one scan (B,) or a batch (N, B). Non finite ranges become nan points. '''
+    ranges = np.asarray(ranges, dtype=np.float32)
+    angles = scan_angles(ranges.shape[-1], fov).astype(np.float32)
+    ranges = np.where(np.isfinite(ranges), ranges, np.nan)
+    x = ranges * np.cos(angles)
+    y = ranges * np.sin(angles)
+    return np.stack((x, y), axis=-1)
+
+
+class Rasterizer:
+    ''' Stamp points (in meters, or in any units with xlim/ylim) as disks on a white image. '''
+
+    def __init__(self, size=IMAGE_SIZE, xlim=XLIM, ylim=YLIM, margin=MARGIN, radius=RADIUS, scan_filter=None):
+        ''' Constructor of the class. margin and radius are given for a 224 image and scaled to "size".
+        scan_filter: optional callable ranges -> ranges (e.g. ScanFilter of "scan_filter.py") applied to the scans. '''
+        self.size = size
+        self.scan_filter = scan_filter
+        self.xlim = xlim
+        self.ylim = ylim
+        scale = size / IMAGE_SIZE
+        self.margin = margin * scale
+        self.radius = radius * scale
+
+        span = size - 2 * self.margin
+        self.sx = span / (xlim[1] - xlim[0])
+        self.sy = span / (ylim[1] - ylim[0])
+
+        ############ DISK STENCIL ############
+        r = int(np.ceil(self.radius))
+        dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+        inside = (dx**2 + dy**2) <= self.radius**2
+        self.stencil_x = dx[inside].astype(np.int64)
+        self.stencil_y = dy[inside].astype(np.int64)
+        self.reach = r
+
+    def to_pixels(self, points):
+        ''' (..., 2) points -> (..., 2) integer pixel (column, row). Rows grow downwards (image convention). '''
+        points = np.asarray(points, dtype=np.float32)
+        col = self.margin + (points[..., 0] - self.xlim[0]) * self.sx
+        row = self.margin + (self.ylim[1] - points[..., 1]) * self.sy
+        return np.floor(col), np.floor(row)
+
+    def render(self, points):
+        ''' Render one (P, 2) point cloud into a (size, size) uint8 image. '''
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        return self.render_batch(points, np.array([0, len(points)]))[0]
+
+    def render_batch(self, points, offsets, out=None):
+        ''' Render N point clouds at once. points: (P, 2) concatenated, offsets: (N+1,) where the points of the
+        sample i are points[offsets[i]:offsets[i+1]]. Returns (N, size, size) uint8. '''
+        offsets = np.asarray(offsets, dtype=np.int64)
+        num_images = len(offsets) - 1
+        size = self.size
+        if out is None:
+            out = np.empty((num_images, size, size), dtype=np.uint8)
+        out.fill(255)
+
+        col, row = self.to_pixels(points)
+        sample = np.repeat(np.arange(num_images, dtype=np.int64), np.diff(offsets))
+
+        # drop the nan points (no return) and the points whose disk can not reach the image
+        reach = self.reach
+        valid = np.isfinite(col) & np.isfinite(row)
+        valid &= (col > -reach - 1) & (col < size + reach) & (row > -reach - 1) & (row < size + reach)
+        col = col[valid].astype(np.int64)
+        row = row[valid].astype(np.int64)
+        sample = sample[valid]
+
+        ############ STAMP THE DISKS ############
+        cols = col[:, None] + self.stencil_x[None, :]
+        rows = row[:, None] + self.stencil_y[None, :]
+        inside = (cols >= 0) & (cols < size) & (rows >= 0) & (rows < size)
+        flat = (sample[:, None] * size + rows) * size + cols
+        out.reshape(-1)[flat[inside]] = 0
+        return out
+
+    def render_scan(self, ranges, fov=FOV):
+        ''' LaserScan ranges (B,) -> (size, size) image. '''
+        if self.scan_filter is not None:
+            ranges = self.scan_filter(ranges)
+        return self.render(scan_to_points(ranges, fov))
+
+    def render_scans(self, scans, fov=FOV, out=None):
+        ''' Batch of scans with the same number of beams (N, B) -> (N, size, size) images. '''
+        scans = np.asarray(scans, dtype=np.float32)
+        if self.scan_filter is not None:
+            scans = self.scan_filter(scans)
+        points = scan_to_points(scans, fov).reshape(-1, 2)
+        offsets = np.arange(len(scans) + 1) * scans.shape[1]
+        return self.render_batch(points, offsets, out=out)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scan-space augmentation: the LaserScan ranges are augmented in polar space, by batch, before the rasterizer
+("rasterizer.py"), instead of rotating the rendered images (PIL rotate of "test/rotate_dataset.py").
+    - AngularOffset: the scan is shifted by k beams (rotation of k * 180/beams degrees around the lidar, the beams that
+      leave the field of view are lost and the new ones have no return), exact and almost free (one gather)
+    - RangeNoise: gaussian noise on the ranges (sigma + relative part)
+    - BeamDropout: random beams without return (inf)
+    - Clutter: spurious returns at random ranges (leaves, weeds, dust)
+    - Occlusion: sectors blocked by a close object (the beams of the sector return the distance of the object)
+Each transform also transforms the labels: the labels are the (m1, m2, b1, b2) lines of the csv in the pixels of the
+224 image with y up (y = m * col + b, as the generator and evaluate.py write them, flipped by process_label), and the
+image is an affine map of the meters (the rasterizer geometry), so a rotation of the points is a closed-form update of
+the lines in the image rows (l' = T^-T l, T = P R P^-1 in homogeneous coordinates). The labels stay in the 224 frame
+at every input size (P of the 224 rasterizer). The other transforms do not move the lines.
+
+    augment = ScanAugment.default()
+    scans, labels = augment(scans, labels, rng) # (N, beams), (N, 4)
+    images = Rasterizer().render_scans(scans)
+
+    python3 scan_augment.py ../datasets/gazebo/Crop_Data5.csv
+
+@author: Felipe-Tommaselli
+"""
+
+import sys
+import time
+import copy
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from pre_process import PreProcess
+from label_index import LabelIndex
+from rasterizer import Rasterizer, IMAGE_SIZE, FOV
+from scan_dataset import load_scans, select_steps
+from dataloader import NnDataLoader, normalize_labels
+
+############ LABEL GEOMETRY ############
+
+def meters_to_pixels(rasterizer):
+    ''' (3, 3) homogeneous map of the points in meters (x, y, 1) to the image pixels (col, row, 1). '''
+    r = rasterizer
+    return np.array([[r.sx, 0.0, r.margin - r.xlim[0] * r.sx],
+                     [0.0, -r.sy, r.margin + r.ylim[1] * r.sy],
+                     [0.0, 0.0, 1.0]])
+
+def flip_rows(labels):
+    ''' (N, 4) csv lines (y up) <-> lines of the image rows (rows downwards): m -> -m, b -> 224 - b (own inverse). '''
+    labels = np.asarray(labels, dtype=np.float64)
+    return np.concatenate([-labels[:, :2], IMAGE_SIZE - labels[:, 2:]], axis=1)
+
+def rotate_labels(labels, angles):
+    ''' csv lines (N, 4) (m1, m2, b1, b2) of the points rotated by angles (N,) rad (counterclockwise around the
+    lidar). '''
+    labels = flip_rows(labels) # the rotation is computed on the image rows
+    P = meters_to_pixels(Rasterizer()) # the labels are in the 224 frame at every input size
+    c, s = np.cos(-np.asarray(angles)), np.sin(-np.asarray(angles))
+    R_inv = np.zeros((len(labels), 3, 3))
+    R_inv[:, 0, 0], R_inv[:, 0, 1], R_inv[:, 1, 0], R_inv[:, 1, 1], R_inv[:, 2, 2] = c, -s, s, c, 1.0
+    T_inv = P @ R_inv @ np.linalg.inv(P) # (N, 3, 3), maps the new points back to the old ones
+    # line (m, -1, b): m * col - row + b = 0 -> l' = T^-T l
+    lines = np.stack([labels[:, :2], -np.ones((len(labels), 2)), labels[:, 2:]], axis=-1) # (N, 2 lines, 3)
+    new = np.einsum('nij,nki->nkj', T_inv, lines)
+    m = -new[..., 0] / new[..., 1]
+    b = -new[..., 2] / new[..., 1]
+    return flip_rows(np.concatenate([m, b], axis=1))
+
+############ TRANSFORMS ############
+
+class ScanTransform:
+    ''' Transform of a batch of scans and labels, applied to each sample with probability p. '''
+    p = 1.0
+
+    def __call__(self, scans, labels, rng, rasterizer):
+        active = rng.random(len(scans)) < self.p
+        if not np.any(active):
+            return scans, labels
+        scans, labels = scans.copy(), labels.copy()
+        scans[active], labels[active] = self.apply(scans[active], labels[active], rng, rasterizer)
+        return scans, labels
+
+    def apply(self, scans, labels, rng, rasterizer):
+        ''' (scans, labels) transformed, all the samples. '''
+        raise NotImplementedError
+
+
+class AngularOffset(ScanTransform):
+    ''' Shift of the beams by up to max_deg degrees: rotation around the lidar (exact, with the labels). '''
+
+    def __init__(self, max_deg=10.0, p=0.5, fov=FOV):
+        self.max_deg, self.p, self.fov = max_deg, p, fov
+
+    def apply(self, scans, labels, rng, rasterizer):
+        num_beams = scans.shape[1]
+        step = (self.fov[1] - self.fov[0]) / num_beams # rad per beam
+        max_shift = int(np.deg2rad(self.max_deg) / step)
+        shift = rng.integers(-max_shift, max_shift + 1, size=len(scans))
+        # beam i sees the range of the beam i - shift: the points rotate by shift * step
+        source = np.arange(num_beams)[None, :] - shift[:, None]
+        inside = (source >= 0) & (source < num_beams)
+        rotated = np.take_along_axis(scans, np.clip(source, 0, num_beams - 1), axis=1)
+        rotated[~inside] = np.inf # beams out of the original field of view: no return
+        return rotated, rotate_labels(labels, shift * step)
+
+
+class RangeNoise(ScanTransform):
+    ''' Gaussian noise on the returns: sigma (m) + relative * range. '''
+
+    def __init__(self, sigma=0.01, relative=0.01, p=1.0):
+        self.sigma, self.relative, self.p = sigma, relative, p
+
+    def apply(self, scans, labels, rng, rasterizer):
+        finite = np.isfinite(scans)
+        noise = rng.standard_normal(scans.shape, dtype=np.float32)
+        noisy = scans + noise * (self.sigma + self.relative * np.where(finite, scans, 0))
+        return np.where(finite, np.maximum(noisy, 0), scans), labels
+
+
+class BeamDropout(ScanTransform):
+    ''' Each beam loses its return (inf) with probability rate. '''
+
+    def __init__(self, rate=0.05, p=0.5):
+        self.rate, self.p = rate, p
+
+    def apply(self, scans, labels, rng, rasterizer):
+        return np.where(rng.random(scans.shape) < self.rate, np.float32(np.inf), scans), labels
+
+
+class Clutter(ScanTransform):
+    ''' Up to max_points spurious returns per scan, at ranges uniform in [min_range, max_range]. '''
+
+    def __init__(self, max_points=20, min_range=0.1, max_range=2.5, p=0.5):
+        self.max_points, self.min_range, self.max_range, self.p = max_points, min_range, max_range, p
+
+    def apply(self, scans, labels, rng, rasterizer):
+        n = len(scans)
+        count = rng.integers(0, self.max_points + 1, size=n)
+        used = np.arange(self.max_points)[None, :] < count[:, None] # (N, max_points)
+        beams = rng.integers(0, scans.shape[1], size=(n, self.max_points))
+        ranges = rng.uniform(self.min_range, self.max_range, size=(n, self.max_points)).astype(np.float32)
+        rows = np.broadcast_to(np.arange(n)[:, None], used.shape)
+        scans = scans.copy()
+        scans[rows[used], beams[used]] = ranges[used]
+        return scans, labels
+
+
+class Occlusion(ScanTransform):
+    ''' Up to max_sectors sectors (min_deg to max_deg wide) blocked by an object at near_range (m) of the lidar. '''
+
+    def __init__(self, max_sectors=2, min_deg=3.0, max_deg=15.0, near_range=(0.1, 0.6), p=0.3, fov=FOV):
+        self.max_sectors, self.min_deg, self.max_deg = max_sectors, min_deg, max_deg
+        self.near_range, self.p, self.fov = near_range, p, fov
+
+    def apply(self, scans, labels, rng, rasterizer):
+        n, num_beams = scans.shape
+        step = np.rad2deg(self.fov[1] - self.fov[0]) / num_beams # degrees per beam
+        beams = np.arange(num_beams)[None, :]
+        sectors = rng.integers(1, self.max_sectors + 1, size=n)
+        scans = scans.copy()
+        for k in range(self.max_sectors):
+            center = rng.integers(0, num_beams, size=(n, 1))
+            half = rng.uniform(self.min_deg, self.max_deg, size=(n, 1)) / step / 2
+            distance = rng.uniform(*self.near_range, size=(n, 1)).astype(np.float32)
+            blocked = (np.abs(beams - center) <= half) & (k < sectors[:, None])
+            # the object only hides what is behind it
+            blocked &= ~(scans < distance)
+            scans = np.where(blocked, distance, scans)
+        return scans, labels
+
+
+class ScanAugment:
+    ''' The transforms in order, on a batch of scans (N, beams) and labels (N, 4). '''
+
+    def __init__(self, transforms, rasterizer=None):
+        self.transforms = list(transforms)
+        self.rasterizer = rasterizer or Rasterizer()
+
+    @classmethod
+    def default(cls, rasterizer=None):
+        ''' Rotation, noise, dropout, clutter and occlusion with the default parameters. '''
+        return cls([AngularOffset(), RangeNoise(), BeamDropout(), Clutter(), Occlusion()], rasterizer)
+
+    def __call__(self, scans, labels, rng):
+        scans = np.asarray(scans, dtype=np.float32)
+        labels = np.asarray(labels, dtype=np.float64)
+        for transform in self.transforms:
+            scans, labels = transform(scans, labels, rng, self.rasterizer)
+        return scans, labels
+
+
+class ScanImageDataset(Dataset):
+    ''' Dataset class for the images rendered from the scans (size x size), with the scan augmentation per batch. '''
+
+    def __init__(self, csv_path, scans_source, runid, augment=None, size=IMAGE_SIZE):
+        ''' Constructor of the class. csv_path: labels csv of the images, scans_source: scans csv or npz of the same
+        steps, augment: ScanAugment of the training batches (None: no augmentation). '''
+        self.index = LabelIndex.from_csv(csv_path)
+        steps, scans = load_scans(scans_source)
+        self.ranges = select_steps(steps, scans, self.index.steps) # (N, beams) float32
+        self.rasterizer = Rasterizer(size=size)
+        self.augment = augment
+        if augment is not None:
+            augment.rasterizer = self.rasterizer
+        print(f'{len(self.ranges)} scans loaded, rendered at {size}x{size}, augmentation: {augment is not None}')
+
+        ############ NORMALIZED LABELS, MEAN AND STD ("params.json") ############
+        # the augmented labels are normalized with the statistics of the original ones
+        self.labels_normalized, self.mean, self.std = normalize_labels(self.index.values, runid)
+
+    def __len__(self) -> int:
+        ''' Returns the length of the dataset (based on the labels). '''
+        return len(self.ranges)
+
+    def plain(self):
+        ''' The same dataset without the augmentation (validation split). '''
+        dataset = copy.copy(self)
+        dataset.augment = None
+        return dataset
+
+    def render(self, indices):
+        ''' (B, size, size) uint8 images of the scans of the indices, without augmentation. '''
+        return self.rasterizer.render_scans(self.ranges[np.asarray(indices)])
+
+    def __getitem__(self, idx: int) -> dict:
+        ''' Returns the sample image of the dataset (rendered, augmented), same format as NnDataLoader. '''
+        batch = self.__getitems__([idx])
+        #! suppose m1 = m2
+        w1, w2, q1, q2 = batch["labels"][0].tolist()
+        return {"labels": [w1, q1, q2], "image": batch["images"][0], "angle": 0}
+
+    def __getitems__(self, indices):
+        ''' Augmented (scan space) and rendered batch, see "collate". '''
+        indices = np.asarray(indices)
+        if self.augment is None:
+            return {"images": self.render(indices), "labels": self.labels_normalized[indices]}
+        # torch RNG: seeded per DataLoader worker and per epoch
+        rng = np.random.default_rng(int(torch.randint(0, 2**62, (1,))))
+        scans, labels = self.augment(self.ranges[indices], self.index.values[indices], rng)
+        labels_numpy = np.stack(NnDataLoader.process_label(labels.T), axis=1)
+        labels_normalized = PreProcess.standard_extract_label_batch(labels_numpy, self.mean, self.std)
+        return {"images": self.rasterizer.render_scans(scans), "labels": labels_normalized}
+
+    @staticmethod
+    def collate(batch):
+        ''' Rendered batch -> {"image": (B, size, size) uint8, "labels": [w1 (B,), q1 (B,), q2 (B,)], "angle"}. '''
+        labels = batch["labels"][:, [0, 2, 3]] # removing w2
+        return {"image": torch.from_numpy(batch["images"]), "labels": list(torch.from_numpy(labels.T.copy())),
+                "angle": torch.zeros(len(labels), dtype=torch.int64)}
+
+if __name__ == '__main__':
+    from PIL import Image
+    _, scans = load_scans(sys.argv[1])
+    batch = scans[:140]
+    rng = np.random.default_rng(0)
+    augment = ScanAugment.default()
+    rasterizer = augment.rasterizer
+    labels = np.tile([[-5.0, -5.0, 600.0, 900.0]], (len(batch), 1))
+
+    start = time.perf_counter()
+    rasterizer.render_scans(batch)
+    render_ms = 1e3 * (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    augmented, _ = augment(batch, labels, rng)
+    rasterizer.render_scans(augmented)
+    scan_ms = 1e3 * (time.perf_counter() - start)
+
+    images = rasterizer.render_scans(batch)
+    start = time.perf_counter()
+    for image, angle in zip(images, rng.uniform(-10, 10, len(images))):
+        np.asarray(Image.fromarray(image).rotate(angle, resample=Image.BILINEAR, fillcolor=255))
+    rotate_ms = 1e3 * (time.perf_counter() - start)
+    print(f'batch of {len(batch)}: rasterizer {render_ms:.1f} ms, scan augmentation + rasterizer {scan_ms:.1f} ms, '
+          f'rasterizer + PIL rotate {render_ms + rotate_ms:.1f} ms')
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Raw-scan dataset: the LaserScan ranges are the network input, without the rasterization to a 224x224 image.
+    - scans: (T, 1081) float32 array in meters (inf: no return), one row per message of the scans csv
+    - steps: (T,) int64, the line of each message in the csv (the "image{step}.png" of "lidar2images.py")
+The labels are the ones of the images ("Label_Data{fid}.csv", same (w1, q1, q2) targets and normalization), so a
+scan model (scan_cnn, scan_mlp of "model_factory.py") is trained by the same loop and metrics of "main.py".
+
+The csv is parsed once and saved as a npz next to it ("Crop_Data{fid}.scans.npz"), with the size and modification
+time of the csv (the same check as "label_index.py"):
+    python3 scan_dataset.py ../datasets/gazebo/Crop_Data5.csv
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import numpy as np
+from torch.utils.data import Dataset
+
+from label_index import LabelIndex, csv_signature
+from model_factory import NUM_BEAMS
+from dataloader import normalize_labels
+
+def scans_path(csv_path):
+    ''' "gazebo/Crop_Data5.csv" -> "gazebo/Crop_Data5.scans.npz" '''
+    return os.path.splitext(csv_path)[0] + '.scans.npz'
+
+def read_scans_csv(csv_path, num_beams=NUM_BEAMS):
+    ''' Scans csv (a message per line, the last num_beams values are the ranges) -> steps (T,), scans (T, beams).
+    The header, the blank lines and the incomplete messages are skipped. '''
+    steps, scans = [], []
+    with open(csv_path, 'r') as file:
+        for step, line in enumerate(file):
+            values = line.strip().replace('"', '').split(',')
+            if len(values) < num_beams:
+                continue
+            try:
+                scans.append(np.asarray(values[-num_beams:], dtype=np.float32)) # 'inf' and 'nan' are parsed
+            except ValueError:
+                continue # header
+            steps.append(step)
+    if not scans:
+        raise ValueError(f'{csv_path}: no scans with {num_beams} beams')
+    return np.asarray(steps, dtype=np.int64), np.stack(scans)
+
+def load_scans(path, cache=True):
+    ''' steps (T,) and scans (T, 1081) float32 of a scans csv (cached npz) or of a npz (e.g. the simulator). '''
+    if path.endswith('.npz'):
+        with np.load(path) as saved:
+            return saved['steps'], saved['scans'].astype(np.float32, copy=False)
+
+    cache_path = scans_path(path)
+    signature = csv_signature(path)
+    if cache and os.path.exists(cache_path):
+        with np.load(cache_path) as saved:
+            if np.array_equal(saved['signature'], signature):
+                return saved['steps'], saved['scans']
+
+    steps, scans = read_scans_csv(path)
+    if cache:
+        with open(cache_path, 'wb') as file:
+            np.savez(file, steps=steps, scans=scans, signature=signature)
+    return steps, scans
+
+def select_steps(steps, scans, wanted):
+    ''' Rows of the scans of the wanted steps (in the wanted order). Raises KeyError if a step has no scan. '''
+    order = np.argsort(steps)
+    positions = np.searchsorted(steps, wanted, sorter=order)
+    positions = np.minimum(positions, len(steps) - 1)
+    found = steps[order[positions]] == wanted
+    if not np.all(found):
+        raise KeyError(f'{np.count_nonzero(~found)} labels without scan, e.g. the steps {wanted[~found][:5].tolist()}')
+    return np.ascontiguousarray(scans[order[positions]])
+
+
+class ScanDataset(Dataset):
+    ''' Dataset class for the lidar data with the raw scans (no images). '''
+
+    def __init__(self, csv_path, scans_source, runid):
+        ''' Constructor of the class. csv_path: labels csv, scans_source: scans csv or npz (steps, scans). '''
+        self.index = LabelIndex.from_csv(csv_path)
+
+        ############ LOAD SCANS ############
+        steps, scans = load_scans(scans_source)
+        self.scans = select_steps(steps, scans, self.index.steps) # (N, 1081) float32
+        print(f'{len(self.scans)} scans loaded ({self.scans.shape[1]} beams)')
+
+        ############ NORMALIZED LABELS, MEAN AND STD ("params.json") ############
+        # the labels of the images: (N, 4) (m1, m2, b1, b2) -> (N, 4) (w1, w2, q1, q2)
+        self.labels_normalized, self.mean, self.std = normalize_labels(self.index.values, runid)
+
+    def __len__(self) -> int:
+        ''' Returns the length of the dataset (based on the labels). '''
+        return len(self.scans)
+
+    def __getitem__(self, idx: int) -> dict:
+        ''' Returns the sample scan of the dataset ("image" key: the input of the training loop). '''
+        #! suppose m1 = m2
+        w1, w2, q1, q2 = self.labels_normalized[idx].tolist()
+        labels = [w1, q1, q2] # removing w2
+        return {"labels": labels, "image": self.scans[idx], "angle": 0}
+
+if __name__ == '__main__':
+    steps, scans = load_scans(sys.argv[1])
+    finite = np.isfinite(scans)
+    print(f'{len(scans)} scans of {scans.shape[1]} beams')
+    print(f'returns: {100 * finite.mean():.1f}%, median range: {np.median(scans[finite]):.2f} m')
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scan filter: removes the isolated returns (dust, rain, single leaves) and the far clutter of a LaserScan before the
+rasterization, with a density test on the cartesian points (scipy cKDTree), instead of the Delaunay + NearestNeighbors
+loop of "test/alpha_hull.py" or the morphological filters on the image of "cv_detection.py".
+    - a return is kept if it has at least min_neighbors other returns closer than radius (m), the same test as
+      "the min_neighbors-th nearest neighbor is closer than radius"
+    - returns farther than max_range (m) are removed (outside of the image, sparse)
+Most returns of the crop rows already have min_neighbors neighbors among the NEIGHBOR_BEAMS next beams on each side
+(vectorized distances), so the tree (built once per scan) is only queried (kNN with distance_upper_bound) for the
+other returns. The removed beams become inf (no return), so the filtered scan is still a LaserScan (same beams) for
+the rasterizer, the raw-scan models and the engine.
+
+    scan_filter = ScanFilter(radius=0.05, min_neighbors=2)
+    ranges = scan_filter(ranges) # (B,) or (N, B)
+    engine = InferenceEngine.from_runid(runid, scan_filter=scan_filter)
+    rasterizer = Rasterizer(scan_filter=scan_filter)
+
+    python3 scan_filter.py
+
+@author: Felipe-Tommaselli
+"""
+
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+
+from rasterizer import scan_to_points, FOV
+
+RADIUS = 0.05 # m
+MIN_NEIGHBORS = 2
+MAX_RANGE = 3.0 # m, the image shows up to 2.2 m ahead and 1.5 m to each side
+NEIGHBOR_BEAMS = 2 # beams on each side checked before the tree
+
+
+class ScanFilter:
+    ''' Density (radius / kNN) and range filter of LaserScan ranges, removed beams -> inf. '''
+
+    def __init__(self, radius=RADIUS, min_neighbors=MIN_NEIGHBORS, max_range=MAX_RANGE, fov=FOV):
+        self.radius = radius
+        self.min_neighbors = min_neighbors
+        self.max_range = max_range
+        self.fov = fov
+
+    def keep(self, ranges):
+        ''' (B,) bool mask of the returns kept of one scan. '''
+        ranges = np.asarray(ranges, dtype=np.float32)
+        valid = np.isfinite(ranges) & (ranges > 0)
+        if self.max_range is not None:
+            valid &= ranges <= self.max_range
+        if self.min_neighbors <= 0:
+            return valid
+        points = scan_to_points(np.where(valid, ranges, np.nan), self.fov) # (B, 2), nan: no return
+
+        ############ NEIGHBOR BEAMS ############
+        # most returns (stalks, rows) already have enough neighbors among the next beams: no tree query for them
+        close = np.zeros(len(ranges), dtype=np.int64)
+        for k in range(1, NEIGHBOR_BEAMS + 1):
+            with np.errstate(invalid='ignore'):
+                near = np.hypot(*(points[k:] - points[:-k]).T) < self.radius
+            close[k:] += near
+            close[:-k] += near
+        keep = valid & (close >= self.min_neighbors)
+
+        ############ KD-TREE ############
+        unsure = valid & ~keep
+        if np.any(unsure):
+            tree = cKDTree(points[valid], balanced_tree=False, compact_nodes=False)
+            # the min_neighbors-th neighbor (the first one is the point itself) closer than radius
+            distances, _ = tree.query(points[unsure], k=self.min_neighbors + 1, distance_upper_bound=self.radius)
+            keep[unsure] = distances[:, self.min_neighbors] < self.radius
+        return keep
+
+    def filter(self, ranges):
+        ''' Ranges (B,) or (N, B) with the removed returns set to inf (float32). '''
+        ranges = np.asarray(ranges, dtype=np.float32)
+        scans = ranges.reshape(-1, ranges.shape[-1])
+        keep = np.stack([self.keep(scan) for scan in scans])
+        return np.where(keep, scans, np.float32(np.inf)).reshape(ranges.shape)
+
+    def __call__(self, ranges):
+        return self.filter(ranges)
+
+if __name__ == '__main__':
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+    from lidar_simulator import CropRowSimulator
+
+    rng = np.random.default_rng(0)
+    clean, _ = CropRowSimulator(weeds=(0, 0)).generate(200, rng)
+    # isolated returns: random beams at random ranges
+    noisy = clean.copy()
+    rows = np.repeat(np.arange(len(noisy)), 30)
+    beams = rng.integers(0, noisy.shape[1], len(rows))
+    noisy[rows, beams] = rng.uniform(0.2, 2.5, len(rows))
+    injected = np.zeros(noisy.shape, dtype=bool)
+    injected[rows, beams] = True
+
+    scan_filter = ScanFilter()
+    keep = np.isfinite(scan_filter(noisy))
+    returns = np.isfinite(clean) & (clean <= scan_filter.max_range) & ~injected
+    print(f'isolated returns removed: {100 * np.mean(~keep[injected]):.1f}%, '
+          f'crop returns kept: {100 * np.mean(keep[returns]):.1f}%')
+
+    times = []
+    for ranges in noisy:
+        start = time.perf_counter()
+        scan_filter(ranges)
+        times.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    scan_filter(noisy)
+    batch = (time.perf_counter() - start) / len(noisy)
+    print(f'per scan: p50 {1e3 * np.median(times):.3f} ms, p99 {1e3 * np.percentile(times, 99):.3f} ms, '
+          f'batch of {len(noisy)}: {1e3 * batch:.3f} ms per scan')
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Segmented dataset: a dataset grows by appending segments (e.g. train12 on top of train11) instead of being rebuilt.
+Folder "{name}.segments":
+    - manifest.json: the segments in the append order, the version of the dataset is the number of segments
+    - segment-000/, ...: steps.npy (N,) int64, labels.npy (N, 4) (m1, m2, b1, b2) and images.npy (N, 224, 224) uint8
+      (memory-mapped when loaded: opening a dataset does not read the images)
+Each segment carries the statistics of its normalization labels (w1, w2, q1, q2): count, mean and M2 (sum of the
+squared deviations, Welford). The statistics of the dataset are merged from the ones of its segments (Chan et al.),
+O(1) per segment, so appending a segment costs the decoding of the new images only: the existing segments, their
+statistics and their train/val split (stratified per segment) do not change.
+
+    python3 segments.py ../data/artificial_data/all.segments ../data/artificial_data/tags/Artificial_Label_Data11.csv ../data/artificial_data/train11
+    python3 segments.py ../data/artificial_data/all.segments ../data/artificial_data/tags/Artificial_Label_Data12.csv ../data/artificial_data/train12
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import json
+from datetime import datetime
+import numpy as np
+from torch.utils.data import Dataset
+
+from label_index import LabelIndex
+from image_io import IMAGE_SIZE, read_images
+from data_split import stratified_split, kfold_splits
+from dataloader import NnDataLoader, normalize_labels, update_params
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+CHUNK = 4096 # images decoded at once while appending
+
+
+class LabelStats:
+    ''' count, mean and M2 (sum of the squared deviations) of the (w1, w2, q1, q2) labels. '''
+
+    def __init__(self, count=0, mean=None, m2=None):
+        self.count = int(count)
+        self.mean = np.zeros(4) if mean is None else np.asarray(mean, dtype=np.float64)
+        self.m2 = np.zeros(4) if m2 is None else np.asarray(m2, dtype=np.float64)
+
+    @classmethod
+    def from_labels(cls, labels):
+        ''' Statistics of a (N, 4) array (the deviations from the mean of the array, no cancellation). '''
+        labels = np.asarray(labels, dtype=np.float64)
+        mean = labels.mean(axis=0)
+        return cls(len(labels), mean, np.sum((labels - mean) ** 2, axis=0))
+
+    def merge(self, other):
+        ''' Statistics of the union (Chan et al. parallel update of Welford). '''
+        count = self.count + other.count
+        if count == 0:
+            return LabelStats()
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / count
+        m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        return LabelStats(count, mean, m2)
+
+    @property
+    def std(self):
+        ''' Population std (the same as np.std of the other datasets). '''
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean.tolist(), 'm2': self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry['count'], entry['mean'], entry['m2'])
+
+############ MANIFEST ############
+
+def load_manifest(segments_dir):
+    ''' manifest.json of the folder (an empty manifest if it does not exist yet). '''
+    path = os.path.join(segments_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {'version': FORMAT_VERSION, 'segments': []}
+    with open(path, 'r') as file:
+        manifest = json.load(file)
+    if manifest['version'] != FORMAT_VERSION:
+        raise ValueError(f'{path}: version {manifest["version"]} (expected {FORMAT_VERSION})')
+    return manifest
+
+def save_manifest(segments_dir, manifest):
+    ''' Replace manifest.json atomically (a reader sees the old or the new list of segments). '''
+    path = os.path.join(segments_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(path + '.tmp', path)
+
+def append_segment(segments_dir, csv_path, train_path, name=None, num_workers=None, chunk=CHUNK):
+    ''' Decode the images of the csv (by chunks) into a new segment and add it to the manifest.
+    Returns the new version (number of segments). Raises ValueError if a segment has the same name. '''
+    name = name or os.path.basename(os.path.normpath(train_path))
+    manifest = load_manifest(segments_dir)
+    if any(segment['name'] == name for segment in manifest['segments']):
+        raise ValueError(f'{segments_dir} already has the segment {name}')
+    folder = f'segment-{len(manifest["segments"]):03d}'
+    path = os.path.join(segments_dir, folder)
+    os.makedirs(path, exist_ok=True)
+
+    ############ IMAGES ############
+    index = LabelIndex.from_csv(csv_path)
+    paths = index.image_paths(train_path)
+    images = np.lib.format.open_memmap(os.path.join(path, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), IMAGE_SIZE, IMAGE_SIZE))
+    for start in range(0, len(paths), chunk):
+        read_images(paths[start:start + chunk], num_workers=num_workers, out=images[start:start + chunk], check=True)
+        print(f'\r{name}: {min(start + chunk, len(paths))}/{len(paths)} images', end='', flush=True)
+    print()
+    images.flush()
+    del images
+    np.save(os.path.join(path, 'steps.npy'), index.steps)
+    np.save(os.path.join(path, 'labels.npy'), index.values)
+
+    ############ STATISTICS ############
+    stats = LabelStats.from_labels(np.stack(NnDataLoader.process_label(index.values.T), axis=1))
+
+    ############ MANIFEST ############
+    # written last: the segment is part of the dataset only once complete
+    manifest['segments'].append({'name': name, 'folder': folder, 'csv': os.path.abspath(csv_path),
+                                 'created': datetime.now().strftime("%d-%m-%Y_%H-%M-%S"), **stats.to_dict()})
+    save_manifest(segments_dir, manifest)
+    print(f'Appended {name} ({len(paths)} samples) to {segments_dir}: version {len(manifest["segments"])}')
+    return len(manifest['segments'])
+
+def merged_stats(segments):
+    ''' Statistics of a list of manifest entries, merged without reading the labels. '''
+    stats = LabelStats()
+    for segment in segments:
+        stats = stats.merge(LabelStats.from_dict(segment))
+    return stats
+
+
+class SegmentDataset(Dataset):
+    ''' Dataset class for a segmented dataset (the first "version" segments), same samples as NnDataLoader. '''
+
+    def __init__(self, segments_dir, runid, version=None):
+        ''' Constructor of the class. version: number of segments (None: all, the latest version). '''
+        manifest = load_manifest(segments_dir)
+        self.segments = manifest['segments'][:version]
+        if not self.segments:
+            raise ValueError(f'{segments_dir}: no segments')
+        self.version = len(self.segments)
+
+        ############ LOAD SEGMENTS ############
+        folders = [os.path.join(segments_dir, segment['folder']) for segment in self.segments]
+        self.segment_images = [np.load(os.path.join(folder, 'images.npy'), mmap_mode='r') for folder in folders]
+        self.raw_labels = np.concatenate([np.load(os.path.join(folder, 'labels.npy')) for folder in folders])
+        self.offsets = np.concatenate(([0], np.cumsum([len(images) for images in self.segment_images])))
+        print(f'{self.offsets[-1]} samples in {self.version} segments: '
+              f'{", ".join(segment["name"] for segment in self.segments)}')
+
+        ############ NORMALIZED LABELS, MEAN AND STD OF THE SEGMENTS (MERGED, "params.json") ############
+        stats = merged_stats(self.segments)
+        self.labels_normalized, self.mean, self.std = normalize_labels(self.raw_labels, runid, stats.mean, stats.std)
+        update_params(runid, segments=[segment['name'] for segment in self.segments])
+
+    def __len__(self) -> int:
+        ''' Returns the length of the dataset (all the segments). '''
+        return int(self.offsets[-1])
+
+    def locate(self, indices):
+        ''' (segment, index in the segment) of dataset indices. '''
+        indices = np.asarray(indices)
+        segment = np.searchsorted(self.offsets, indices, side='right') - 1
+        return segment, indices - self.offsets[segment]
+
+    def read(self, indices):
+        ''' (B, 224, 224) uint8 images of the indices (read from the memory-mapped segments). '''
+        segments, local = self.locate(indices)
+        images = np.empty((len(local), IMAGE_SIZE, IMAGE_SIZE), dtype=np.uint8)
+        for segment in np.unique(segments):
+            mask = segments == segment
+            images[mask] = self.segment_images[segment][local[mask]]
+        return images
+
+    def split(self, val_fraction=0.3, seed=0, fold=None, n_splits=5):
+        ''' (train_idx, val_idx) stratified per segment: the split of a segment does not change when the dataset grows.
+        fold=None: train/val split, fold=k: k-th fold of a stratified k-fold. '''
+        train, val = [], []
+        for segment, offset in enumerate(self.offsets[:-1]):
+            labels = self.labels_raw(segment)
+            if fold is None:
+                train_idx, val_idx = stratified_split(labels, val_fraction, seed)
+            else:
+                train_idx, val_idx = kfold_splits(labels, n_splits, seed)[fold]
+            train.append(train_idx + offset)
+            val.append(val_idx + offset)
+        return np.concatenate(train), np.concatenate(val)
+
+    def labels_raw(self, segment):
+        ''' (N, 4) (m1, m2, b1, b2) labels of a segment, as in its csv. '''
+        return self.raw_labels[self.offsets[segment]:self.offsets[segment + 1]]
+
+    def __getitem__(self, idx: int) -> dict:
+        ''' Returns the sample image of the dataset, same format as NnDataLoader. '''
+        segment, local = self.locate(idx)
+        #! suppose m1 = m2
+        w1, w2, q1, q2 = self.labels_normalized[idx].tolist()
+        return {"labels": [w1, q1, q2], "image": np.array(self.segment_images[segment][local]), "angle": 0}
+
+if __name__ == '__main__':
+    segments_dir, csv_path, train_path = sys.argv[1], sys.argv[2], sys.argv[3]
+    append_segment(segments_dir, csv_path, train_path)
+    segments = load_manifest(segments_dir)['segments']
+    stats = merged_stats(segments)
+    print(f"{'segment':<12}{'samples':>10}  mean (w1, w2, q1, q2)")
+    for segment in segments:
+        print(f"{segment['name']:<12}{segment['count']:>10}  {np.round(segment['mean'], 3).tolist()}")
+    print(f"{'all':<12}{stats.count:>10}  {np.round(stats.mean, 3).tolist()}, std {np.round(stats.std, 3).tolist()}")
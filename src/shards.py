@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sharded dataset: for the datasets bigger than the RAM of a node, the (step, labels, image) records are written in
+fixed-size records to a few shard files, and the training streams them with large sequential reads.
+Folder "train{fid}.shards":
+    - shard-00000.bin, ...: RECORDS_PER_SHARD records of record_dtype (no header, record i at i * record_bytes):
+      step int64, labels (m1, m2, b1, b2) float64, image (224, 224) uint8 -> 50 KB per record, ~200 MB per shard
+    - labels.npz: steps (N,) and labels (N, 4) of all the records in the shard order (32 B per record, in RAM)
+    - index.json: image shape, record size and the file and number of records of each shard (written last: a folder
+      without index.json is an interrupted export)
+The shards are written by the ShardWriter, from the pngs (decoded by chunks), the cache of "dataset_cache.py" or the
+point list of the generator (rendered by chunks, at any size).
+
+ShardedIterableDataset streams the shards:
+    - the shards are shuffled per epoch (seed, epoch: same order in all the processes) and their records are split in
+      contiguous equal parts between the DDP ranks (torch.distributed), then between the DataLoader workers of each
+      rank: every rank (and every worker of a rank) gets the same number of records, so no rank stops before the
+      others in the gradient all-reduce. The records are padded by repeating the first ones (drop_last=False, as a
+      DistributedSampler) or the last ones are dropped (drop_last=True)
+    - each worker reads its shards sequentially by blocks of READ_RECORDS records (~3 MB per read)
+    - the records are shuffled in a buffer of shuffle_buffer records (per worker)
+    - steps: only the records of these steps (e.g. the train or val steps of "data_split.py")
+The memory does not depend on the dataset size (buffer + one block per worker), so the throughput stays the same
+when the dataset no longer fits in the RAM (page cache).
+
+    python3 shards.py ../data/artificial_data/tags/Artificial_Label_Data11.csv ../data/artificial_data/train11
+    python3 shards.py ../data/artificial_data/train11.shards --workers 4
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+
+from label_index import LabelIndex
+from image_io import IMAGE_SIZE, read_images
+from dataloader import normalize_labels
+
+FORMAT_VERSION = 1
+RECORDS_PER_SHARD = 4096 # ~200 MB shards of 224x224 images
+READ_RECORDS = 64 # records per read (~3 MB)
+SHUFFLE_BUFFER = 2048 # records (~100 MB per worker)
+CHUNK = 4096 # images decoded (or rendered) at once while exporting
+INDEX_FILE = 'index.json'
+LABELS_FILE = 'labels.npz'
+
+def record_dtype(image_shape=(IMAGE_SIZE, IMAGE_SIZE)):
+    ''' Fixed-size record: step, labels (m1, m2, b1, b2) and the uint8 image. '''
+    return np.dtype([('step', np.int64), ('labels', np.float64, (4,)), ('image', np.uint8, tuple(image_shape))])
+
+def shards_path(train_path):
+    ''' "data/artificial_data/train11" -> "data/artificial_data/train11.shards" '''
+    return os.path.normpath(train_path) + '.shards'
+
+def load_index(shard_dir):
+    ''' index.json, steps (N,) and labels (N, 4) of a shard folder. Raises FileNotFoundError if not complete. '''
+    path = os.path.join(shard_dir, INDEX_FILE)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'{path} not found: not a shard folder or interrupted export')
+    with open(path, 'r') as file:
+        index = json.load(file)
+    if index['version'] != FORMAT_VERSION:
+        raise ValueError(f'{path}: version {index["version"]} (expected {FORMAT_VERSION})')
+    with np.load(os.path.join(shard_dir, LABELS_FILE)) as saved:
+        return index, saved['steps'], saved['labels']
+
+############ WRITE ############
+
+class ShardWriter:
+    ''' Writes the records in shards of records_per_shard records (one write per shard), index.json on close. '''
+
+    def __init__(self, shard_dir, records_per_shard=RECORDS_PER_SHARD, image_shape=(IMAGE_SIZE, IMAGE_SIZE)):
+        ''' Constructor of the class. Raises FileExistsError if shard_dir already has an index.json. '''
+        if os.path.exists(os.path.join(shard_dir, INDEX_FILE)):
+            raise FileExistsError(f'{shard_dir} already has shards')
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.image_shape = tuple(image_shape)
+        self.dtype = record_dtype(self.image_shape)
+        self.buffer = np.empty(records_per_shard, dtype=self.dtype)
+        self.filled = 0
+        self.shards = [] # {"file", "records"}
+        self.steps, self.labels = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # without index.json, an interrupted export is not read as a complete dataset
+        if exc_type is None:
+            self.close()
+
+    def write(self, steps, images, labels):
+        ''' Add a batch of records: steps (B,), images (B, H, W) uint8 and labels (B, 4) (m1, m2, b1, b2). '''
+        steps = np.asarray(steps, dtype=np.int64)
+        labels = np.asarray(labels, dtype=np.float64).reshape(-1, 4)
+        if images.shape[1:] != self.image_shape:
+            raise ValueError(f'images of shape {images.shape[1:]}, the shards have {self.image_shape}')
+        self.steps.append(steps)
+        self.labels.append(labels)
+        start = 0
+        while start < len(steps):
+            count = min(len(steps) - start, len(self.buffer) - self.filled)
+            records = self.buffer[self.filled:self.filled + count]
+            records['step'] = steps[start:start + count]
+            records['labels'] = labels[start:start + count]
+            records['image'] = images[start:start + count]
+            self.filled += count
+            start += count
+            if self.filled == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        ''' Write the buffered records as a new shard. '''
+        if self.filled == 0:
+            return
+        name = f'shard-{len(self.shards):05d}.bin'
+        self.buffer[:self.filled].tofile(os.path.join(self.shard_dir, name))
+        self.shards.append({'file': name, 'records': self.filled})
+        self.filled = 0
+
+    def close(self):
+        ''' Write the last shard, the labels and index.json. '''
+        self.flush()
+        steps = np.concatenate(self.steps) if self.steps else np.empty(0, dtype=np.int64)
+        labels = np.concatenate(self.labels) if self.labels else np.empty((0, 4))
+        with open(os.path.join(self.shard_dir, LABELS_FILE), 'wb') as file:
+            np.savez(file, steps=steps, labels=labels)
+        index = {'version': FORMAT_VERSION, 'image_shape': list(self.image_shape),
+                 'record_bytes': self.dtype.itemsize, 'records': int(len(steps)), 'shards': self.shards}
+        with open(os.path.join(self.shard_dir, INDEX_FILE), 'w') as file:
+            json.dump(index, file, indent=4)
+        print(f'Saved {len(steps)} records in {len(self.shards)} shards '
+              f'({len(steps) * self.dtype.itemsize / 2**30:.2f} GB) to {self.shard_dir}')
+
+def export_images(csv_path, train_path, shard_dir=None, records_per_shard=RECORDS_PER_SHARD, num_workers=None,
+                  chunk=CHUNK):
+    ''' Shards of the pngs of the csv, decoded by chunks (never the whole dataset in memory). Returns shard_dir. '''
+    shard_dir = shard_dir or shards_path(train_path)
+    index = LabelIndex.from_csv(csv_path)
+    paths = index.image_paths(train_path)
+    with ShardWriter(shard_dir, records_per_shard) as writer:
+        for start in range(0, len(paths), chunk):
+            images = read_images(paths[start:start + chunk], num_workers=num_workers, check=True)
+            writer.write(index.steps[start:start + chunk], images, index.values[start:start + chunk])
+            print(f'\rexporting images: {start + len(images)}/{len(paths)}', end='', flush=True)
+        print()
+    return shard_dir
+
+def export_cache(cache_path, shard_dir, records_per_shard=RECORDS_PER_SHARD):
+    ''' Shards of a cache of "dataset_cache.py" (steps, images, labels). Returns shard_dir. '''
+    from dataset_cache import load_cache
+    steps, images, labels = load_cache(cache_path)
+    with ShardWriter(shard_dir, records_per_shard) as writer:
+        writer.write(steps, images, labels)
+    return shard_dir
+
+def export_points(points_path, shard_dir, size=IMAGE_SIZE, records_per_shard=RECORDS_PER_SHARD, chunk=CHUNK):
+    ''' Shards of a point list of the generator, rendered at size x size by chunks. Returns shard_dir. '''
+    from point_dataset import load_point_list, point_rasterizer, gather
+    xy, offsets, labels, steps = load_point_list(points_path)
+    rasterizer = point_rasterizer(size)
+    with ShardWriter(shard_dir, records_per_shard, image_shape=(size, size)) as writer:
+        for start in range(0, len(steps), chunk):
+            rows = np.arange(start, min(start + chunk, len(steps)))
+            images = rasterizer.render_batch(*gather(xy, offsets, rows))
+            writer.write(steps[rows], images, labels[rows])
+    return shard_dir
+
+############ READ ############
+
+def distributed_rank():
+    ''' (rank, world size) of torch.distributed, (0, 1) without DDP. '''
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+class ShardedIterableDataset(IterableDataset):
+    ''' Streaming dataset of a shard folder, samples in the NnDataLoader format (default collate). '''
+
+    def __init__(self, shard_dir, runid, steps=None, shuffle_buffer=SHUFFLE_BUFFER, seed=0, read_records=READ_RECORDS,
+                 rank=None, world_size=None, drop_last=False):
+        ''' Constructor of the class. runid: entry of the mean and std in "params.json" (None: not saved),
+        steps: only the records of these steps (None: all), shuffle_buffer: 0 for the shard order without shuffle,
+        rank/world_size: None from torch.distributed, drop_last: equal parts by dropping records instead of padding. '''
+        self.shard_dir = shard_dir
+        index, self.steps, labels = load_index(shard_dir)
+        self.image_shape = tuple(index['image_shape'])
+        self.dtype = record_dtype(self.image_shape)
+        self.files = [os.path.join(shard_dir, shard['file']) for shard in index['shards']]
+        self.offsets = np.concatenate(([0], np.cumsum([shard['records'] for shard in index['shards']])))
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.read_records = read_records
+        self.rank, self.world_size = rank, world_size
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        ############ SELECTED STEPS ############
+        if steps is None:
+            self.keep = np.ones(len(self.steps), dtype=bool)
+        else:
+            steps = np.asarray(steps, dtype=np.int64)
+            self.keep = np.isin(self.steps, steps)
+            if np.count_nonzero(self.keep) != len(np.unique(steps)):
+                missing = steps[~np.isin(steps, self.steps)]
+                raise KeyError(f'{len(missing)} steps without record, e.g. the steps {missing[:5].tolist()}')
+        print(f'{np.count_nonzero(self.keep)} of {len(self.steps)} records in {len(self.files)} shards '
+              f'({self.image_shape[0]}x{self.image_shape[1]})')
+
+        ############ NORMALIZED LABELS, MEAN AND STD ("params.json") ############
+        # mean and std of all the records (as the other datasets, the train and val steps have the same normalization)
+        self.labels_normalized, self.mean, self.std = normalize_labels(labels, runid)
+
+    def set_epoch(self, epoch):
+        ''' New shard order and shuffle of the epoch (call it before each epoch, as a DistributedSampler). '''
+        self.epoch = epoch
+
+    def _rank(self):
+        if self.rank is not None:
+            return self.rank, self.world_size or 1
+        return distributed_rank()
+
+    def per_rank(self):
+        ''' Records of each rank (the same in all the ranks). '''
+        _, world_size = self._rank()
+        total = int(np.count_nonzero(self.keep))
+        return total // world_size if self.drop_last else -(-total // world_size)
+
+    def rank_positions(self):
+        ''' Global indices of the records of this rank in this epoch, in the stream order: the selected records of the
+        shards in the permutation of the epoch (the same in every rank), padded or cut to world_size equal parts. '''
+        rank, world_size = self._rank()
+        order = np.random.default_rng((self.seed, self.epoch)).permutation(len(self.files))
+        positions = np.concatenate([self.offsets[shard] + np.flatnonzero(self.keep[self.offsets[shard]:
+                                    self.offsets[shard + 1]]) for shard in order] + [np.zeros(0, dtype=np.int64)])
+        per_rank = self.per_rank()
+        # np.resize repeats the records from the first one (padding) or cuts the last ones
+        positions = np.resize(positions, per_rank * world_size) if len(positions) else positions
+        return positions[rank * per_rank:(rank + 1) * per_rank]
+
+    def __len__(self) -> int:
+        ''' Records of this rank in this epoch (the same in every rank). '''
+        return self.per_rank()
+
+    def read_shard(self, shard):
+        ''' (global index, record) of the selected records of a shard, read by blocks of read_records records. '''
+        keep = self.keep[self.offsets[shard]:self.offsets[shard + 1]]
+        block = np.empty(self.read_records, dtype=self.dtype)
+        start = 0
+        with open(self.files[shard], 'rb', buffering=0) as file:
+            while True:
+                count = file.readinto(block) // self.dtype.itemsize
+                if count == 0:
+                    break
+                for i in np.flatnonzero(keep[start:start + count]):
+                    yield self.offsets[shard] + start + i, block[i]
+                start += count
+
+    def read_positions(self, positions):
+        ''' (global index, record) of the records at the positions, in that order. Each run of increasing positions of
+        one shard is read by blocks of read_records records (one seek per block). '''
+        shards = np.searchsorted(self.offsets, positions, side='right') - 1
+        runs = np.flatnonzero((np.diff(shards) != 0) | (np.diff(positions) < 0)) + 1
+        block = np.empty(self.read_records, dtype=self.dtype)
+        for first, run in zip(np.concatenate(([0], runs)), np.split(positions, runs)):
+            if len(run) == 0:
+                continue
+            shard = shards[first]
+            local = run - self.offsets[shard]
+            with open(self.files[shard], 'rb', buffering=0) as file:
+                i = 0
+                while i < len(local):
+                    start = local[i]
+                    file.seek(int(start) * self.dtype.itemsize)
+                    count = file.readinto(block) // self.dtype.itemsize
+                    if count == 0: # the shard is shorter than its records in index.json
+                        raise IOError(f'{self.files[shard]}: truncated shard, no record {start} '
+                                      f'({self.offsets[shard + 1] - self.offsets[shard]} in index.json)')
+                    end = i + int(np.searchsorted(local[i:], start + count))
+                    for j in range(i, end):
+                        yield run[j], block[local[j] - start]
+                    i = end
+
+    def records(self, positions):
+        ''' (labels, image) of the records at the positions, the image is a copy (the read blocks are reused). '''
+        for position, record in self.read_positions(positions):
+            yield self.labels_normalized[position], record['image'].copy()
+
+    def shuffled(self, records, rng):
+        ''' Shuffle buffer: each new record replaces a random record of the buffer, which is returned. '''
+        buffer = []
+        for record in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = record
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+    def __iter__(self):
+        ''' Records of the shards of this rank and DataLoader worker. '''
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        # contiguous parts of the records of the rank, the same sizes in every rank (same batches per rank)
+        positions = np.array_split(self.rank_positions(), num_workers)[worker_id]
+        records = self.records(positions)
+        if self.shuffle_buffer > 0:
+            rank, _ = self._rank()
+            records = self.shuffled(records, np.random.default_rng((self.seed, self.epoch, rank, worker_id)))
+        for labels, image in records:
+            #! suppose m1 = m2
+            w1, w2, q1, q2 = labels.tolist()
+            yield {"labels": [w1, q1, q2], "image": image, "angle": 0}
+
+    def materialize(self):
+        ''' images (N, H, W) uint8 and normalized labels (N, 4) of all the selected records (e.g. CachedValidation). '''
+        images = np.empty((np.count_nonzero(self.keep),) + self.image_shape, dtype=np.uint8)
+        positions = np.empty(len(images), dtype=np.int64)
+        i = 0
+        for shard in range(len(self.files)):
+            for position, record in self.read_shard(shard):
+                images[i], positions[i] = record['image'], position
+                i += 1
+        return images, self.labels_normalized[positions]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a dataset to shards or measure the streaming throughput.')
+    parser.add_argument('paths', nargs='+', help='csv and train folder (export) or a shard folder (throughput)')
+    parser.add_argument('--out', default=None, help='shard folder of the export (default: train folder + .shards)')
+    parser.add_argument('--records', type=int, default=RECORDS_PER_SHARD, help='records per shard')
+    parser.add_argument('--workers', type=int, default=0, help='DataLoader workers of the throughput')
+    parser.add_argument('--batch', type=int, default=140)
+    args = parser.parse_args()
+
+    if len(args.paths) > 1:
+        shard_dir = export_images(args.paths[0], args.paths[1], args.out, args.records)
+    else:
+        shard_dir = args.paths[0]
+
+    ############ THROUGHPUT ############
+    dataset = ShardedIterableDataset(shard_dir, runid=None)
+    loader = DataLoader(dataset, batch_size=args.batch, num_workers=args.workers)
+    start = time.perf_counter()
+    count = sum(len(batch['image']) for batch in loader)
+    elapsed = time.perf_counter() - start
+    print(f'{count} records in {elapsed:.2f} s: {count / elapsed:.0f} records/s, '
+          f'{count * dataset.dtype.itemsize / elapsed / 2**20:.0f} MB/s ({args.workers} workers)')
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the contour pre-processing: PreProcess.contours_image vs ContourPreProcessor (exact and approximate).
+Checks that the exact fast path gives the same images (bit for bit), the fraction of different pixels of the box
+approximation, and the time per image of each one.
+    python3 benchmark_contours.py ../../data/artificial_data/train11 --num 500
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import time
+import glob
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pre_process import PreProcess, ContourPreProcessor
+from image_io import read_images
+
+def timed(function, images, repeat):
+    ''' Best time (ms per image) of "repeat" runs of function over all the images, and the last outputs. '''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [function(image) for image in images]
+        best = min(best, (time.perf_counter() - start) * 1000 / len(images))
+    return best, np.stack(outputs)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the contour pre-processing.')
+    parser.add_argument('images', help='png folder "train{fid}"')
+    parser.add_argument('--num', type=int, default=200, help='number of images')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.images, '*.png')))[:args.num]
+    if not paths:
+        sys.exit(f'No png images in {args.images}')
+    images = read_images(paths)
+
+    original_ms, original = timed(PreProcess.contours_image, images, args.repeat)
+    exact_ms, exact = timed(ContourPreProcessor(), images, args.repeat)
+    approx_ms, approx = timed(ContourPreProcessor(approximate=True), images, args.repeat)
+
+    mismatches = int(np.sum(np.any(original != exact, axis=(1, 2))))
+    different = float(np.mean(original != approx))
+
+    print(f'{len(images)} images')
+    print(f"{'method':<24}{'ms/image':>10}{'speedup':>10}")
+    print(f"{'contours_image':<24}{original_ms:>10.3f}{1:>10.2f}")
+    print(f"{'fast path (exact)':<24}{exact_ms:>10.3f}{original_ms / exact_ms:>10.2f}")
+    print(f"{'fast path (approximate)':<24}{approx_ms:>10.3f}{original_ms / approx_ms:>10.2f}")
+    print(f'exact: {mismatches} different images | approximate: {100 * different:.2f}% different pixels')
@@ -8,6 +8,8 @@ import os
 import sys
 from sys import platform
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 # Configurações
 image_size = 224  # Tamanho da imagem
@@ -31,6 +33,13 @@ NAME = 'Artificial_Label_Data' + FID + '.csv'
 
 IMAGE_DIR = os.getcwd() + '/' + 'data' + '/' + 'artificial_data' + '/' + 'train' + FID + '/'
 
+# point list of all the samples (see "point_dataset.py"), rendered at load time at any resolution
+POINTS_PATH = os.getcwd() + '/' + 'data' + '/' + 'artificial_data' + '/' + 'train' + FID + '.points.npz'
+SAVE_IMAGES = True # False: only the point list and the labels (much faster, no matplotlib figure per sample)
+POINTS_EVERY = 500 # samples per part of the point list (an interrupted run keeps the saved parts)
+
+from point_list import save_point_part, merge_point_parts
+
 
 if not os.path.exists(IMAGE_DIR):
     os.makedirs(IMAGE_DIR)
@@ -82,6 +91,15 @@ RND_COLOR = 'black'
 
 #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 
+def scatter(ax, x_coords, y_coords, color, sample_points):
+    ''' Plot the points (only with SAVE_IMAGES) and keep them in the point list of the sample. '''
+    if SAVE_IMAGES:
+        ax.scatter(x_coords, y_coords, s=90, c=color)
+    sample_points.extend(zip(x_coords, y_coords))
+
+# point lists of the samples not saved yet, and the parts already saved (merged at the end)
+all_steps, all_points, all_labels = [], [], []
+parts = []
 
 # rotacionar as retas
 for angle in range(RANGE1, RANGE2, STEP):
@@ -174,9 +192,11 @@ for angle in range(RANGE1, RANGE2, STEP):
         #* ################ GENERATE POINTS ################
 
         # PLOT
-        fig, ax = plt.subplots(figsize=(5, 5), dpi=58)
-        ax.set_xlim(0, image_size)
-        ax.set_ylim(0, image_size)
+        sample_points = [] # (x, y) of all the points of the sample
+        fig, ax = plt.subplots(figsize=(5, 5), dpi=58) if SAVE_IMAGES else (None, None)
+        if SAVE_IMAGES:
+            ax.set_xlim(0, image_size)
+            ax.set_ylim(0, image_size)
 
         #################### Dentro Baixo ####################
 
@@ -196,7 +216,7 @@ for angle in range(RANGE1, RANGE2, STEP):
             x = np.random.choice([np.random.randint(x1_boundary, x1_boundary + boundary), np.random.randint(x2_boundary - boundary, x2_boundary)])
             x_coords.append(x)
             y_coords.append(y)
-        ax.scatter(x_coords, y_coords, s=90, c=DB_COLOR)
+        scatter(ax, x_coords, y_coords, DB_COLOR, sample_points)
         x_coords = []
         y_coords = []
 
@@ -226,7 +246,7 @@ for angle in range(RANGE1, RANGE2, STEP):
                 y = int(round(central_y + dy))
                 x_coords.append(x)
                 y_coords.append(y)
-        ax.scatter(x_coords, y_coords, s=90, c=DT_COLOR)
+        scatter(ax, x_coords, y_coords, DT_COLOR, sample_points)
         x_coords = []
         y_coords = []
 
@@ -259,7 +279,7 @@ for angle in range(RANGE1, RANGE2, STEP):
                 y = int(round(central_y + dy))
                 x_coords.append(x)
                 y_coords.append(y)
-        ax.scatter(x_coords, y_coords, s=90, c=F1_COLOR)
+        scatter(ax, x_coords, y_coords, F1_COLOR, sample_points)
         x_coords = []
         y_coords = []
 
@@ -315,7 +335,7 @@ for angle in range(RANGE1, RANGE2, STEP):
             x = np.random.choice([x1_boundary - boundary, x2_boundary + boundary])
             x_coords.append(x)
             y_coords.append(y)
-        ax.scatter(x_coords, y_coords, s=90, c=FC_COLOR)
+        scatter(ax, x_coords, y_coords, FC_COLOR, sample_points)
         x_coords = []
         y_coords = []
 
@@ -347,7 +367,7 @@ for angle in range(RANGE1, RANGE2, STEP):
                 y = int(round(central_y + dy))
                 x_coords.append(x)
                 y_coords.append(y)
-        ax.scatter(x_coords, y_coords, s=90, c=FB_COLOR)
+        scatter(ax, x_coords, y_coords, FB_COLOR, sample_points)
         x_coords = []
         y_coords = []
 
@@ -359,14 +379,15 @@ for angle in range(RANGE1, RANGE2, STEP):
             y = np.random.randint(0, image_size)
             x_coords.append(x)
             y_coords.append(y)
-        ax.scatter(x_coords, y_coords, s=90, c=RND_COLOR)
+        scatter(ax, x_coords, y_coords, RND_COLOR, sample_points)
         x_coords = []
         y_coords = []
 
         #* ################ PLOT ################
 
-        ax.set_xlim(0, image_size)
-        ax.set_ylim(0, image_size)
+        if SAVE_IMAGES:
+            ax.set_xlim(0, image_size)
+            ax.set_ylim(0, image_size)
         
         # Desenhar as retas rotacionadas (com pontos de início e fim)
         #ax.plot(x_line, y1_line_rotated, 'r')
@@ -381,9 +402,10 @@ for angle in range(RANGE1, RANGE2, STEP):
         # ax.plot(x2line, yline, 'c')
         
         # Remover as bordas e ticks dos eixos
-        ax.set_xticks([])
-        ax.set_yticks([])
-        ax.axis('off')
+        if SAVE_IMAGES:
+            ax.set_xticks([])
+            ax.set_yticks([])
+            ax.axis('off')
         
         # Mostrar a imagem na tela
         #plt.show()
@@ -403,10 +425,24 @@ for angle in range(RANGE1, RANGE2, STEP):
         label_file.write('\n' + labels)
         label_file.close()
 
-        img_name = IMAGE_DIR + 'image' + str(count_step) + '.png'
-        plt.savefig(img_name, bbox_inches='tight', pad_inches=0)
+        all_steps.append(count_step)
+        all_points.append(sample_points)
+        all_labels.append([m1r, m2r, b1r, b2r])
+
+        if SAVE_IMAGES:
+            img_name = IMAGE_DIR + 'image' + str(count_step) + '.png'
+            plt.savefig(img_name, bbox_inches='tight', pad_inches=0)
+            plt.close()
         if count_step % 100 == 0:
             print('File saved: ', count_step)
-        
-        plt.close()
+        if len(all_steps) == POINTS_EVERY:
+            # only the new samples: each part is written once
+            parts.append(save_point_part(POINTS_PATH, len(parts), all_steps, all_points, all_labels))
+            all_steps, all_points, all_labels = [], [], []
+
+#* ################ SAVE POINT LIST ################
+if all_steps:
+    parts.append(save_point_part(POINTS_PATH, len(parts), all_steps, all_points, all_labels))
+num_samples = merge_point_parts(POINTS_PATH, parts)
+print(f'Point list of {num_samples} samples saved to: {POINTS_PATH}')
 
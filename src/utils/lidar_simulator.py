@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Crop-row LiDAR simulator: raw LaserScan ranges by 2D ray casting, instead of the point clusters drawn in pixels by
+"artificial_generator.py".
+Scene of each scan (meters, lidar at the origin looking to +y, the frame of "rasterizer.py"):
+    - two crop rows around the robot: row spacing, heading (angle to +y) and lateral offset of the robot
+    - the rows are lines of stalks: cylinders every stalk_spacing (jitter and missing stalks), random radius
+    - adjacent rows (same spacing) and weeds (small cylinders anywhere)
+The beams of the 180 degrees scan (np.linspace(0, 180, beams, endpoint=False), as the deploy) are cast against all
+the cylinders of the batch at once: each cylinder only covers the beams of its angular width (asin(r / d)), so the
+intersections are computed for the (cylinder, beam) pairs of these widths (~10 beams per stalk) instead of the
+(scans, cylinders, all the beams) broadcast. The range of a beam is the nearest hit (np.minimum.at), so the occlusion
+is exact. No hit (or beyond max_range): inf.
+
+The labels are the exact lines of the two rows in the csv convention of "artificial_generator.py": pixels of the
+rendered 224 image with y up (y = 224 - row = m * col + b, flipped back to the rows by process_label), so the
+simulation feeds both training paths:
+    - raw scans: scans = "sim{fid}.scans.npz" (ScanDataset), csv_path = "Sim_Label_Data{fid}.csv"
+    - images: scan_images = "sim{fid}.scans.npz" (ScanImageDataset: rendered by the rasterizer, augmented)
+
+    python3 lidar_simulator.py --samples 10000 --fid 1
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rasterizer import Rasterizer, scan_angles, FOV, MAX_RANGE
+from scan_augment import meters_to_pixels, flip_rows
+from model_factory import NUM_BEAMS
+
+MIN_DISTANCE = 0.1 # m, no obstacle closer to the lidar (the robot itself)
+
+
+class CropRowSimulator:
+    ''' Random crop-row scenes and their scans (vectorized over a batch of scans). '''
+
+    def __init__(self, row_spacing=(0.6, 0.9), heading_deg=20.0, lateral=0.2, stalk_spacing=0.12, stalk_jitter=0.03,
+                 stalk_radius=(0.01, 0.03), missing=0.15, row_length=(-0.5, 4.0), adjacent_rows=1, weeds=(0, 15),
+                 weed_radius=(0.005, 0.02), noise=0.005, num_beams=NUM_BEAMS, fov=FOV, max_range=MAX_RANGE):
+        ''' Constructor of the class. Ranges (low, high) are sampled uniformly per scan, the lengths are in meters:
+        heading_deg: max |heading| of the rows, lateral: max |offset| of the robot from the middle of the rows,
+        missing: fraction of missing stalks, row_length: extent of the rows along their direction (from the lidar),
+        weeds: number of weeds per scan, noise: std of the range noise. '''
+        self.row_spacing, self.heading = row_spacing, np.deg2rad(heading_deg)
+        self.lateral, self.stalk_spacing, self.stalk_jitter = lateral, stalk_spacing, stalk_jitter
+        self.stalk_radius, self.missing, self.row_length = stalk_radius, missing, row_length
+        self.adjacent_rows, self.weeds, self.weed_radius = adjacent_rows, weeds, weed_radius
+        self.noise, self.max_range = noise, max_range
+        self.angles = scan_angles(num_beams, fov)
+        self.step = (fov[1] - fov[0]) / num_beams
+        self.fov = fov
+        self.cos, self.sin = np.cos(self.angles), np.sin(self.angles)
+        self.pixels = meters_to_pixels(Rasterizer())
+
+    ############ SCENE ############
+
+    def scenes(self, n, rng):
+        ''' Cylinders (n, M, 3) (x, y, r; r = 0: no cylinder) and the parameters (heading, lateral, spacing) (n,). '''
+        heading = rng.uniform(-self.heading, self.heading, n)
+        heading = np.where(np.abs(heading) < 1e-6, 1e-6, heading) # vertical line in the image: infinite m
+        lateral = rng.uniform(-self.lateral, self.lateral, n)
+        spacing = rng.uniform(*self.row_spacing, n)
+
+        ############ STALKS ############
+        # rows k = -adjacent .. 1 + adjacent, the robot rows are k = 0 (left) and k = 1 (right)
+        rows = np.arange(-self.adjacent_rows, 2 + self.adjacent_rows)
+        offsets = lateral[:, None] + (rows[None, :] - 0.5) * spacing[:, None] # (n, R) perpendicular offset
+        count = int(np.ceil((self.row_length[1] - self.row_length[0]) / self.stalk_spacing))
+        shape = (n, len(rows), count)
+        along = self.row_length[0] + (np.arange(count) + rng.uniform(0, 1, (n, 1, 1))) * self.stalk_spacing
+        along = along + rng.normal(0, self.stalk_jitter, shape)
+        across = offsets[:, :, None] + rng.normal(0, self.stalk_jitter / 3, shape)
+        # direction of the rows d = (sin h, cos h), normal n = (cos h, -sin h)
+        s, c = np.sin(heading)[:, None, None], np.cos(heading)[:, None, None]
+        x = across * c + along * s
+        y = -across * s + along * c
+        radius = rng.uniform(*self.stalk_radius, shape) * (rng.random(shape) >= self.missing)
+        stalks = np.stack([x, y, radius], axis=-1).reshape(n, -1, 3)
+
+        ############ WEEDS ############
+        max_weeds = self.weeds[1]
+        weeds = np.stack([rng.uniform(-1.5, 1.5, (n, max_weeds)), rng.uniform(0, 2.5, (n, max_weeds)),
+                          rng.uniform(*self.weed_radius, (n, max_weeds))], axis=-1)
+        number = rng.integers(self.weeds[0], max_weeds + 1, n)
+        weeds[..., 2] *= np.arange(max_weeds)[None, :] < number[:, None]
+
+        cylinders = np.concatenate([stalks, weeds], axis=1)
+        distance = np.hypot(cylinders[..., 0], cylinders[..., 1])
+        cylinders[..., 2] *= distance - cylinders[..., 2] > MIN_DISTANCE
+        return cylinders, heading, lateral, spacing
+
+    ############ RAY CASTING ############
+
+    def cast(self, cylinders, rng=None):
+        ''' Ranges (n, beams) float32 of the scans of the cylinders (n, M, 3), nearest hit of each beam. '''
+        n, num_beams = len(cylinders), len(self.angles)
+        cx, cy, r = cylinders[..., 0], cylinders[..., 1], cylinders[..., 2]
+        valid = r > 0
+        distance2 = cx**2 + cy**2
+        center = np.arctan2(cy, cx)
+        center = np.where(center < -np.pi / 2, center + 2 * np.pi, center) # [-90, 270) degrees: no wrap in the fov
+        half = np.arcsin(np.clip(r / np.sqrt(np.maximum(distance2, 1e-12)), 0, 1))
+        # beams of the angular width of each cylinder (inside the fov): first .. last
+        first = np.maximum(np.ceil((center - half - self.fov[0]) / self.step), 0).astype(np.int64)
+        last = np.minimum(np.floor((center + half - self.fov[0]) / self.step), num_beams - 1).astype(np.int64)
+        cylinder = np.flatnonzero(valid & (last >= first)) # flat (scan, cylinder) index
+        width = (last - first + 1).reshape(-1)[cylinder]
+        # one (cylinder, beam) pair per beam of each cylinder, without the beams the cylinder can not hit
+        pair = np.repeat(cylinder, width)
+        starts = np.cumsum(width) - width
+        beams = np.repeat(first.reshape(-1)[cylinder] - starts, width) + np.arange(len(pair))
+        # ray t * u, |t u - c|^2 = r^2 -> t = u.c - sqrt(r^2 - |c|^2 + (u.c)^2)
+        cx, cy, r = cx.reshape(-1)[pair], cy.reshape(-1)[pair], r.reshape(-1)[pair]
+        distance2 = distance2.reshape(-1)[pair]
+        projection = self.cos[beams] * cx + self.sin[beams] * cy
+        discriminant = r**2 - distance2 + projection**2
+        hit = discriminant >= 0
+        t = projection - np.sqrt(np.where(hit, discriminant, 0))
+        hit &= t > 0
+        flat = pair[hit] // cylinders.shape[1] * num_beams + beams[hit] # scan * beams + beam
+        ranges = np.full(n * num_beams, np.inf)
+        np.minimum.at(ranges, flat, t[hit])
+        ranges = ranges.reshape(n, num_beams)
+        if rng is not None and self.noise > 0:
+            ranges = ranges + rng.normal(0, self.noise, ranges.shape)
+        ranges[ranges > self.max_range] = np.inf
+        return ranges.astype(np.float32)
+
+    ############ LABELS ############
+
+    def labels(self, heading, lateral, spacing):
+        ''' (n, 4) (m1, m2, b1, b2) csv lines (y up) of the left (1) and right (2) rows in the image pixels. '''
+        lines = []
+        for side in (-0.5, 0.5):
+            x0 = (lateral + side * spacing) / np.cos(heading) # x of the row at y = 0
+            points = np.stack([np.stack([x0, np.zeros_like(x0), np.ones_like(x0)], axis=-1),
+                               np.stack([x0 + np.tan(heading), np.ones_like(x0), np.ones_like(x0)], axis=-1)])
+            pixels = points @ self.pixels.T # (2, n, 3) (col, row, 1)
+            m = (pixels[1, :, 1] - pixels[0, :, 1]) / (pixels[1, :, 0] - pixels[0, :, 0])
+            lines.append((m, pixels[0, :, 1] - m * pixels[0, :, 0]))
+        (m1, b1), (m2, b2) = lines
+        return flip_rows(np.stack([m1, m2, b1, b2], axis=1)) # lines of the image rows -> csv (y up)
+
+    def generate(self, n, rng):
+        ''' n scans (n, beams) float32 and their labels (n, 4). '''
+        cylinders, heading, lateral, spacing = self.scenes(n, rng)
+        return self.cast(cylinders, rng), self.labels(heading, lateral, spacing)
+
+def save_simulation(csv_path, scans_path, scans, labels):
+    ''' Labels csv ("step, m1, m2, b1, b2", steps 0 .. n-1) and scans npz (steps, scans) of ScanDataset. '''
+    steps = np.arange(len(scans), dtype=np.int64)
+    np.savetxt(csv_path, np.column_stack([steps, labels]), delimiter=', ', header='step, m1, m2, b1, b2',
+               comments='', fmt=['%d'] + ['%.17g'] * 4)
+    with open(scans_path, 'wb') as file:
+        np.savez(file, steps=steps, scans=scans)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crop-row LiDAR simulator (raw scans and exact labels).')
+    parser.add_argument('--samples', type=int, default=10000)
+    parser.add_argument('--fid', default='1', help='Sim_Label_Data{fid}.csv and sim{fid}.scans.npz')
+    parser.add_argument('--out', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data',
+                                                      'simulated_data'))
+    parser.add_argument('--batch', type=int, default=256, help='scans cast at once')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    simulator = CropRowSimulator()
+    rng = np.random.default_rng(args.seed)
+    scans, labels = [], []
+    start = time.perf_counter()
+    for first in range(0, args.samples, args.batch):
+        batch_scans, batch_labels = simulator.generate(min(args.batch, args.samples - first), rng)
+        scans.append(batch_scans)
+        labels.append(batch_labels)
+    elapsed = time.perf_counter() - start
+    scans, labels = np.concatenate(scans), np.concatenate(labels)
+    print(f'{len(scans)} scans in {elapsed:.2f} s ({len(scans) / elapsed:.0f} scans/s), '
+          f'returns: {100 * np.isfinite(scans).mean():.1f}% of the beams')
+
+    os.makedirs(os.path.join(args.out, 'tags'), exist_ok=True)
+    csv_path = os.path.join(args.out, 'tags', f'Sim_Label_Data{args.fid}.csv')
+    scans_path = os.path.join(args.out, f'sim{args.fid}.scans.npz')
+    save_simulation(csv_path, scans_path, scans, labels)
+    print(f'Saved {csv_path} and {scans_path}')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cached validation set: the validation split never changes between epochs, so it is built once and kept on the device.
+    - images: (N, 1, 224, 224) uint8 tensor, contiguous, on the device (4x smaller than float32, cast per chunk),
+      or the (N, 1, 1081) float32 ranges of a ScanDataset
+    - labels: (N, 3 or 4) float32 normalized labels on the device, in the order of the network outputs
+The evaluation runs in large fixed chunks under torch.inference_mode(), without DataLoader, collate, cast and
+restack per batch. The same pass gives the loss and the metrics of "metrics.py" (L1 per output, angle error,
+intercept error in pixels).
+
+    val_cache = CachedValidation.from_dataset(dataset, val_idx, device)
+    val_loss, metrics = val_cache.evaluate(model, criterion)
+
+@author: Felipe-Tommaselli
+"""
+
+import numpy as np
+import torch
+
+from image_io import read_images
+from metrics import line_errors
+
+CHUNK_SIZE = 512
+
+class CachedValidation:
+    ''' Validation split materialized once as device tensors. '''
+
+    def __init__(self, images, labels, mean, std, device, chunk_size=CHUNK_SIZE):
+        ''' Constructor of the class.
+        images: (N, 224, 224) uint8, labels: (N, 4) normalized (w1, w2, q1, q2), mean and std of the normalization. '''
+        self.device = torch.device(device)
+        self.chunk_size = chunk_size
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.labels_normalized = np.asarray(labels, dtype=np.float64)
+        self.images = torch.from_numpy(np.ascontiguousarray(images)).unsqueeze(1).to(self.device)
+        self.labels = {
+            # we suppose m1 = m2: the network has 3 outputs (w1, q1, q2)
+            3: torch.as_tensor(self.labels_normalized[:, [0, 2, 3]], dtype=torch.float32, device=self.device),
+            4: torch.as_tensor(self.labels_normalized, dtype=torch.float32, device=self.device),
+        }
+
+    @classmethod
+    def from_dataset(cls, dataset, indices, device, chunk_size=CHUNK_SIZE):
+        ''' Validation split (indices) of a NnDataLoader (images in RAM), LazyNnDataLoader (decoded here),
+        PackedDataset (unpacked here), PointListDataset (rendered here), SegmentDataset (read from the segments) or
+        ScanDataset (raw scans). '''
+        indices = np.asarray(indices)
+        if hasattr(dataset, 'scans'):
+            images = dataset.scans[indices]
+        elif hasattr(dataset, 'segments'):
+            images = dataset.read(indices)
+        elif hasattr(dataset, 'images'):
+            images = dataset.images[indices]
+        elif hasattr(dataset, 'bits'):
+            images = dataset.unpack(indices)
+        elif hasattr(dataset, 'rasterizer'):
+            images = dataset.render(indices)
+        else:
+            images = read_images([dataset.paths[i] for i in indices])
+        labels = dataset.labels_normalized[indices]
+        return cls(images, labels, dataset.mean, dataset.std, device, chunk_size)
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def predict(self, model):
+        ''' (N, outputs) network outputs of the whole validation set. '''
+        model.eval()
+        outputs = []
+        with torch.inference_mode():
+            for start in range(0, len(self.images), self.chunk_size):
+                images = self.images[start:start + self.chunk_size].float()
+                outputs.append(model(images))
+        return torch.cat(outputs)
+
+    def evaluate(self, model, criterion):
+        ''' Returns the validation loss (mean over the samples) and the mean of each metric. '''
+        outputs = self.predict(model)
+        labels = self.labels[outputs.shape[1]]
+        with torch.inference_mode():
+            loss = criterion(outputs, labels).item() # mean over the whole validation set
+        labels_wq = self.labels_normalized * self.std + self.mean
+        errors = line_errors(outputs.cpu().numpy(), labels_wq, self.mean, self.std)
+        metrics = {name: float(np.mean(values)) for name, values in errors.items()}
+        return loss, metrics
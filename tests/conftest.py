@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+The modules of "src" (and "src/utils", "deploy") import each other by name, as when the scripts run from "src".
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'utils'))
+sys.path.insert(0, os.path.join(ROOT, 'deploy'))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Dynamic-batching server of "deploy/batch_server.py": each source gets the lines of its own scans, and a failing batch
+or an oversized request closes the connections of its sources instead of blocking them.
+
+@author: Felipe-Tommaselli
+"""
+
+import threading
+import numpy as np
+import pytest
+
+from batch_server import BatchServer, BatchClient, MAX_BEAMS
+
+class EchoEngine:
+    ''' Lines identifying the scan: the first range of each scan (an error for a negative one). '''
+
+    def predict_batch(self, ranges):
+        if np.any(ranges[:, 0] < 0):
+            raise ValueError('negative range')
+        return np.repeat(ranges[:, :1].astype(np.float64), 4, axis=1)
+
+@pytest.fixture
+def server():
+    with BatchServer(EchoEngine(), port=0, max_wait=0.02) as server:
+        yield server
+
+def test_sources_get_their_own_lines(server):
+    clients = [BatchClient(*server.address) for _ in range(2)]
+    results = [[], []]
+
+    def run(i):
+        for k in range(20):
+            results[i].append(clients[i].predict(np.full(8, 100 * i + k, dtype=np.float32)))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    for i, client in enumerate(clients):
+        assert results[i] == [[100 * i + k] * 4 for k in range(20)]
+        client.close()
+
+def test_failed_batch_and_oversized_request_close_the_source(server):
+    bad, big, good = (BatchClient(*server.address) for _ in range(3))
+    with pytest.raises(ConnectionError):
+        bad.predict(np.full(8, -1, dtype=np.float32))
+    with pytest.raises(ConnectionError):
+        big.predict(np.zeros(MAX_BEAMS + 1, dtype=np.float32))
+    # the batcher still runs
+    assert good.predict(np.full(8, 7, dtype=np.float32)) == [7] * 4
+    for client in (bad, big, good):
+        client.close()
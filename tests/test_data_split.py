@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Splits of "data_split.py": the same seed gives the same samples, so every experiment validates on the same ones.
+
+@author: Felipe-Tommaselli
+"""
+
+import numpy as np
+
+from data_split import stratified_split, kfold_splits
+
+def random_labels(n=200, seed=0):
+    ''' (n, 4) csv labels (m1, m2, b1, b2) of parallel lines with random angles and dividers. '''
+    rng = np.random.default_rng(seed)
+    m = np.tan(rng.uniform(0.3, 1.4, n)) * rng.choice([-1, 1], n)
+    b1 = rng.uniform(-200, 200, n)
+    return np.stack([m, m, b1, b1 + rng.uniform(40, 120, n)], axis=1)
+
+def test_stratified_split_is_deterministic():
+    labels = random_labels()
+    train_idx, val_idx = stratified_split(labels, 0.3, seed=7)
+    again_train, again_val = stratified_split(labels, 0.3, seed=7)
+    assert np.array_equal(train_idx, again_train) and np.array_equal(val_idx, again_val)
+    assert len(val_idx) == 60 and np.array_equal(np.sort(np.concatenate([train_idx, val_idx])), np.arange(200))
+    assert not np.array_equal(val_idx, stratified_split(labels, 0.3, seed=8)[1])
+
+def test_kfold_splits_are_deterministic():
+    labels = random_labels()
+    folds = kfold_splits(labels, 5, seed=7)
+    for (train_idx, val_idx), (again_train, again_val) in zip(folds, kfold_splits(labels, 5, seed=7)):
+        assert np.array_equal(train_idx, again_train) and np.array_equal(val_idx, again_val)
+    # every sample is validated exactly once
+    assert np.array_equal(np.sort(np.concatenate([val_idx for _, val_idx in folds])), np.arange(200))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Labels of the simulator: after process_label (as every dataset reads the csv) they must lie on the rendered rows.
+
+@author: Felipe-Tommaselli
+"""
+
+import numpy as np
+
+from rasterizer import Rasterizer, scan_to_points
+from scan_augment import meters_to_pixels
+from dataloader import NnDataLoader
+from lidar_simulator import CropRowSimulator
+
+def test_simulated_labels_round_trip_through_process_label():
+    simulator = CropRowSimulator(adjacent_rows=0, weeds=(0, 0), stalk_jitter=0.0, noise=0.0,
+                                 stalk_radius=(0.005, 0.005))
+    cylinders, heading, lateral, spacing = simulator.scenes(20, np.random.default_rng(0))
+    scans = simulator.cast(cylinders)
+    labels = simulator.labels(heading, lateral, spacing)
+    # w = d col / d row and q = col at row 0 of the image rows (what the network learns)
+    w1, w2, q1, q2 = NnDataLoader.process_label(labels.T)
+
+    pixels = meters_to_pixels(Rasterizer())
+    for i, scan in enumerate(scans):
+        points = scan_to_points(scan)
+        valid = np.isfinite(points[:, 0]) & (points[:, 1] < 2.2)
+        col, row, _ = (np.column_stack([points[valid], np.ones(np.count_nonzero(valid))]) @ pixels.T).T
+        # each stalk return is on one of the two rows, up to the stalk radius (5 mm, ~0.4 px)
+        error = np.minimum(np.abs(w1[i] * row + q1[i] - col), np.abs(w2[i] * row + q2[i] - col))
+        assert np.max(error) < 1.0
+        # left row (1) on the left of the right row (2) at the bottom of the image
+        assert w1[i] * 224 + q1[i] < w2[i] * 224 + q2[i]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Labels of the scan augmentation: the rotated csv labels (y up, 224 frame) must follow the rotated points.
+
+@author: Felipe-Tommaselli
+"""
+
+import numpy as np
+
+from rasterizer import Rasterizer, scan_to_points, scan_angles
+from scan_augment import AngularOffset, meters_to_pixels, flip_rows, rotate_labels
+
+NUM_BEAMS = 1081
+A, K = 0.4, 0.2 # line x = A + K * y (m)
+
+def line_scan():
+    ''' (1, beams) scan of the line x = A + K * y up to 3 m. '''
+    angles = scan_angles(NUM_BEAMS)
+    with np.errstate(divide='ignore'):
+        ranges = A / (np.cos(angles) - K * np.sin(angles))
+    ranges[(ranges <= 0) | (ranges > 3.0)] = np.inf
+    return ranges.astype(np.float32)[None]
+
+def csv_label():
+    ''' (1, 4) csv label (y up) of the line for both rows. '''
+    P = meters_to_pixels(Rasterizer())
+    (c0, r0, _), (c1, r1, _) = np.array([[A, 0.0, 1.0], [A + K, 1.0, 1.0]]) @ P.T
+    m = (r1 - r0) / (c1 - c0)
+    return flip_rows([[m, m, r0 - m * c0, r0 - m * c0]])
+
+def rows_of(labels, cols):
+    ''' Image rows (downwards) of the first line of csv labels at the columns. '''
+    m, _, b, _ = flip_rows(labels)[0]
+    return m * cols + b
+
+def test_rotate_labels_inverse_and_identity():
+    labels = np.repeat(csv_label(), 3, axis=0)
+    angles = np.array([0.1, -0.05, 30 * np.pi / NUM_BEAMS])
+    assert np.allclose(rotate_labels(rotate_labels(labels, angles), -angles), labels)
+    assert np.allclose(rotate_labels(labels, np.zeros(3)), labels)
+
+def test_rotated_label_follows_rendered_points():
+    scans, labels = line_scan(), csv_label()
+    rotated_scans, rotated_labels = AngularOffset(max_deg=10.0, p=1.0).apply(scans, labels, np.random.default_rng(1),
+                                                                             Rasterizer())
+    assert not np.array_equal(rotated_labels, labels)
+
+    # exact points of the rotated scan in the image
+    points = scan_to_points(rotated_scans[0])
+    points = points[np.isfinite(points[:, 0])]
+    pixels = np.column_stack([points, np.ones(len(points))]) @ meters_to_pixels(Rasterizer()).T
+    assert np.max(np.abs(rows_of(rotated_labels, pixels[:, 0]) - pixels[:, 1])) < 0.05
+
+    # rendered disks of the rotated scan around the line (pixel floor + disk radius)
+    rows, cols = np.nonzero(Rasterizer().render_scans(rotated_scans)[0] == 0)
+    m = flip_rows(rotated_labels)[0, 0]
+    distance = np.abs(rows_of(rotated_labels, cols + 0.5) - (rows + 0.5)) / np.hypot(1.0, m)
+    assert np.median(distance) < 2.0 and np.max(distance) < 5.0
+
+def test_labels_do_not_depend_on_the_input_size():
+    labels = csv_label()
+    rng = np.random.default_rng(2)
+    _, small = AngularOffset(p=1.0).apply(line_scan(), labels, np.random.default_rng(2), Rasterizer(size=112))
+    _, full = AngularOffset(p=1.0).apply(line_scan(), labels, rng, Rasterizer())
+    assert np.allclose(small, full)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Shards of "shards.py": every selected record is read by one rank and one worker, the same number in every rank.
+
+@author: Felipe-Tommaselli
+"""
+
+import os
+import numpy as np
+import pytest
+
+from shards import ShardWriter, ShardedIterableDataset
+
+RECORDS, PER_SHARD, SHAPE = 23, 5, (4, 4)
+
+@pytest.fixture
+def shard_dir(tmp_path):
+    ''' 23 records in 5 shards of 5 records, 4x4 images. '''
+    path = str(tmp_path / 'train.shards')
+    rng = np.random.default_rng(0)
+    labels = np.column_stack([rng.uniform(1, 3, (RECORDS, 2)), rng.uniform(0, 200, (RECORDS, 2))])
+    images = rng.integers(0, 256, (RECORDS,) + SHAPE, dtype=np.uint8)
+    with ShardWriter(path, PER_SHARD, image_shape=SHAPE) as writer:
+        writer.write(np.arange(100, 100 + RECORDS), images, labels)
+    return path
+
+def read_steps(dataset, positions):
+    return [int(record['step']) for _, record in dataset.read_positions(positions)]
+
+@pytest.mark.parametrize('world_size, num_workers', [(1, 1), (2, 3), (3, 2), (4, 1)])
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_ranks_and_workers_cover_the_records(shard_dir, world_size, num_workers, drop_last):
+    steps = np.arange(100, 100 + RECORDS, 2) # 12 of the 23 records
+    read = []
+    for rank in range(world_size):
+        dataset = ShardedIterableDataset(shard_dir, None, steps=steps, shuffle_buffer=0, seed=1, rank=rank,
+                                         world_size=world_size, drop_last=drop_last)
+        positions = dataset.rank_positions()
+        assert len(positions) == len(dataset) == dataset.per_rank()
+        for part in np.array_split(positions, num_workers):
+            assert read_steps(dataset, part) == dataset.steps[part].tolist()
+            read.extend(read_steps(dataset, part))
+    if drop_last:
+        assert len(read) == len(set(read)) and set(read) <= set(steps.tolist())
+        assert len(read) == len(steps) // world_size * world_size
+    else:
+        assert set(read) == set(steps.tolist()) # the padding repeats records, none is missing
+        assert len(read) == -(-len(steps) // world_size) * world_size
+
+def test_truncated_shard_raises(shard_dir):
+    dataset = ShardedIterableDataset(shard_dir, None, shuffle_buffer=0)
+    path = os.path.join(shard_dir, 'shard-00002.bin')
+    with open(path, 'r+b') as file:
+        file.truncate(2 * dataset.dtype.itemsize)
+    with pytest.raises(IOError, match='truncated shard'):
+        read_steps(dataset, np.arange(RECORDS))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+SharedRing of "deploy/shm_ring.py": in-order and latest reads, drop-oldest counting and torn slots.
+
+@author: Felipe-Tommaselli
+"""
+
+import numpy as np
+import pytest
+
+from shm_ring import SharedRing
+
+@pytest.fixture
+def rings():
+    ''' Writer ring (owner) and a reader attached to the same block. '''
+    writer = SharedRing((2,), np.float64, slots=3)
+    reader = SharedRing(**writer.spec)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+def read_value(ring, **kwargs):
+    sequence, stamp, view = ring.read(timeout=0.01, **kwargs)
+    value = float(view[0])
+    assert ring.release()
+    return sequence, stamp, value
+
+def test_push_read_and_drop_oldest(rings):
+    writer, reader = rings
+    for i in range(1, 4):
+        assert writer.push([10 * i, i], stamp=i) == i
+    assert read_value(reader) == (1, 1.0, 10.0)
+    for i in range(4, 7): # the full ring overwrites its oldest slots (2 and 3)
+        writer.push([10 * i, i], stamp=i)
+    assert [read_value(reader)[0] for _ in range(3)] == [4, 5, 6]
+    assert reader.dropped == 2 and reader.torn == 0
+    assert reader.read(timeout=0.01) is None
+
+def test_latest_read_drops_the_older_slots(rings):
+    writer, reader = rings
+    for i in range(1, 4):
+        writer.push([10 * i, i], stamp=i)
+    assert read_value(reader, latest=True) == (3, 3.0, 30.0)
+    assert reader.dropped == 2
+
+def test_pinned_slot_is_kept_and_torn_slots_are_counted(rings):
+    writer, reader = rings
+    writer.push([1, 1], stamp=1)
+    _, _, view = reader.read(timeout=0.01)
+    for i in range(2, 8): # the writer never takes the pinned slot
+        writer.push([10 * i, i], stamp=i)
+    assert view[0] == 1 and reader.release()
+    reader.read(timeout=0.01)
+    writer.sequences[reader.pinned[0]] = 99 # overwritten during the read (no fence in the handshake)
+    assert not reader.release()
+    assert reader.torn == 1 and reader.dropped == 4